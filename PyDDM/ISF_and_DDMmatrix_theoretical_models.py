@@ -11,6 +11,51 @@ Mathematical models for the DDM matrix and the ISF
 
 import numpy as np
 
+# All models below are written with numpy operations only, so they broadcast.
+# Passing `lagtime` with shape (T,1) and each parameter with shape (1,Q) returns
+# the (T,Q) surface for all wavevectors in a single call. See `theory_surface`.
+
+def theory_surface(model_function, lagtime, parameters):
+    r"""Evaluates a model for many wavevectors at once
+    
+    Parameters
+    ----------
+    model_function : function
+        One of the models in this module
+    lagtime : array
+        1D array of the lagtimes (length T)
+    parameters : array
+        Array of shape (number of parameters, Q) where each column has the 
+        parameters for one wavevector. The order of the parameters is the 
+        order of the arguments of `model_function`. A 1D array (one value 
+        per parameter) is also accepted. 
+
+    Returns
+    -------
+    surface : array
+        Model evaluated at all lagtimes for all wavevectors. Shape of (T,Q), 
+        or (T,) if `parameters` was 1D. 
+
+    """
+    lagtime = np.asarray(lagtime, dtype=float).reshape(-1,1)
+    parameters = np.asarray(parameters, dtype=float)
+    one_q = (parameters.ndim == 1)
+    parameters = parameters.reshape(parameters.shape[0], -1)
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        surface = model_function(lagtime, *[p.reshape(1,-1) for p in parameters])
+    surface = np.broadcast_to(surface, (lagtime.shape[0], parameters.shape[1]))
+    if one_q:
+        return surface[:,0].copy()
+    return np.array(surface)
+
+def _schulz_velocity_term(lagtime, t1, Z):
+    r"""ISF for ballistic motion with a Schulz distribution of speeds.
+    Equal to 1 at zero lag time."""
+    theta = (lagtime / t1)/(Z + 1.0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        vdist = ((Z + 1.0)/((Z * lagtime)/t1)) * np.sin(Z*np.arctan(theta))/((1.0 + theta**2.0)**(Z/2.0))
+    return np.where(theta == 0, 1.0, vdist)
+
 def dTheorySingleExp_DDM(lagtime,amplitude,tau,bg,s=1.0):
     r"""Theoretical model for the  DDM matrix with one exponential term
     
@@ -285,8 +330,7 @@ def dTheoryExpAndBallistic_ISF(lagtime,tau1,s,tau2,a,Z):
     .. [1] Wilson, L. G. et al. Differential Dynamic Microscopy of Bacterial Motility. *Phys. Rev. Lett.* 106, 018101 (2011). https://doi.org/10.1103/PhysRevLett.106.018101
 
     '''
-    theta = (lagtime / tau2)/(Z + 1.0)
-    VDist = ((Z + 1.0)/((Z * lagtime)/tau2)) * np.sin(Z*np.arctan(theta))/((1.0 + theta**2.0)**(Z/2.0))
+    VDist = _schulz_velocity_term(lagtime, tau2, Z)
     g1 = np.exp(-1.0*(lagtime/tau1)**s)
     isf = g1*((1.0-a)+a*VDist)
     return isf
@@ -328,8 +372,7 @@ def dTheoryExpAndBallistic_DDM(lagtime,amplitude,bg,tau1,s,tau2,a,Z):
     .. [1] Wilson, L. G. et al. Differential Dynamic Microscopy of Bacterial Motility. *Phys. Rev. Lett.* 106, 018101 (2011). https://doi.org/10.1103/PhysRevLett.106.018101
 
     '''
-    theta = (lagtime / tau2)/(Z + 1.0)
-    VDist = ((Z + 1.0)/((Z * lagtime)/tau2)) * np.sin(Z*np.arctan(theta))/((1.0 + theta**2.0)**(Z/2.0))
+    VDist = _schulz_velocity_term(lagtime, tau2, Z)
     g1 = np.exp(-1.0*(lagtime/tau1)**s)
     isf = g1*((1.0-a)+a*VDist)
     ddmmatrix = amplitude * (1-isf) + bg
@@ -350,8 +393,7 @@ def dTheoryBallistic_ISF(lagtime,t1,Z):
     t1: ballistic relaxation time, 1/qv
     Z: Schulz distribution number
     '''
-    theta = (lagtime / t1)/(Z + 1.0)
-    isf = ((Z + 1.0)/((Z * lagtime)/t1)) * np.sin(Z*np.arctan(theta))/((1.0 + theta**2.0)**(Z/2.0))
+    isf = _schulz_velocity_term(lagtime, t1, Z)
     return isf
 
 def dTheoryBallistic_DDM(lagtime,amp,bg,t1,Z):
@@ -363,8 +405,7 @@ def dTheoryBallistic_DDM(lagtime,amp,bg,t1,Z):
     t1: ballistic relaxation time, 1/qv
     Z: Schulz distribution number
     '''
-    theta = (lagtime / t1)/(Z + 1.0)
-    isf = ((Z + 1.0)/((Z * lagtime)/t1)) * np.sin(Z*np.arctan(theta))/((1.0 + theta**2.0)**(Z/2.0))
+    isf = _schulz_velocity_term(lagtime, t1, Z)
     ddm_matrix = amp * (1 - isf) + bg
     return ddm_matrix
 
@@ -380,10 +421,8 @@ def dTheoryTwoBallistic_ISF(lagtime,t1,Z1,t2,Z2,f):
     Z2:
     f: fraction that is of type 1
     '''
-    theta1 = (lagtime / t1)/(Z1 + 1.0)
-    VDist1 = ((Z1 + 1.0)/((Z1 * lagtime)/t1)) * np.sin(Z1*np.arctan(theta1))/((1.0 + theta1**2.0)**(Z1/2.0))
-    theta2 = (lagtime / t2)/(Z2 + 1.0)
-    VDist2 = ((Z2 + 1.0)/((Z2 * lagtime)/t2)) * np.sin(Z2*np.arctan(theta2))/((1.0 + theta2**2.0)**(Z2/2.0))
+    VDist1 = _schulz_velocity_term(lagtime, t1, Z1)
+    VDist2 = _schulz_velocity_term(lagtime, t2, Z2)
     isf = (f*VDist1)+((1-f)*VDist2)
     return isf
 
@@ -399,10 +438,8 @@ def dTheoryTwoBallistic_DDM(lagtime,amp,bg,t1,Z1,t2,Z2,f):
     Z2:
     f: fraction that is of type 1
     '''
-    theta1 = (lagtime / t1)/(Z1 + 1.0)
-    VDist1 = ((Z1 + 1.0)/((Z1 * lagtime)/t1)) * np.sin(Z1*np.arctan(theta1))/((1.0 + theta1**2.0)**(Z1/2.0))
-    theta2 = (lagtime / t2)/(Z2 + 1.0)
-    VDist2 = ((Z2 + 1.0)/((Z2 * lagtime)/t2)) * np.sin(Z2*np.arctan(theta2))/((1.0 + theta2**2.0)**(Z2/2.0))
+    VDist1 = _schulz_velocity_term(lagtime, t1, Z1)
+    VDist2 = _schulz_velocity_term(lagtime, t2, Z2)
     isf = (f*VDist1)+((1-f)*VDist2)
     ddm_matrix = amp*(1-isf) + bg
     return ddm_matrix
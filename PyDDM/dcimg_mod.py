@@ -596,6 +596,71 @@ file_name=input_file.dcimg>
 
         return a
 
+    def read_block(self, start=0, stop=None, roi=None, copy=True, step=1):
+        """Return a block of frames, optionally cropped.
+
+        Unlike `__getitem__`, the 4px correction is applied to the whole block
+        at once instead of being worked out from the requested slices.
+
+        Parameters
+        ----------
+        start : int
+            First frame of the block
+        stop : int
+            Frames up to (but not including) `stop` are returned. If None, up
+            to the last frame.
+        roi : list
+            Region of each frame to return, as [y1, y2, x1, x2]. If None, the
+            whole frame.
+        copy : bool
+            If True, the block is copied to memory as a single contiguous
+            array. Otherwise a strided view of the memory mapped file is
+            returned, unless the 4px correction needs to be applied, in which
+            case a copy is returned.
+        step : int
+            Only every `step`-th frame from `start` is returned. Frames in
+            between are not read from the file.
+
+        Returns
+        -------
+        `numpy.ndarray`
+            A numpy array of shape (number of frames, `y2` - `y1`,
+            `x2` - `x1`).
+        """
+        frames = slice(*slice(start, stop, step).indices(self.nfrms))
+        if roi is None:
+            ys = slice(0, self.ysize)
+            xs = slice(0, self.xsize)
+        else:
+            ys = slice(*slice(roi[0], roi[1]).indices(self.ysize))
+            xs = slice(*slice(roi[2], roi[3]).indices(self.xsize))
+
+        a = self.mma[frames, ys, xs]
+
+        # columns of the target line holding the 4px data that fall in the roi
+        n = 8 // self.byte_depth
+        if self._4px is not None:
+            n = min(n, self._4px.shape[1])
+        needs_4px = (self.first_4px_correction_enabled is not None
+                     and self._has_4px_data
+                     and ys.start <= self._target_line < ys.stop
+                     and xs.start < min(n, xs.stop)
+                     and a.size > 0)
+
+        if copy or needs_4px:
+            a = np.array(a)
+
+        if needs_4px:
+            stopx = min(n, xs.stop)
+            a_index_exp = np.index_exp[:, self._target_line - ys.start,
+                                       0:stopx - xs.start]
+            if self.first_4px_correction_enabled:
+                a[a_index_exp] = self._4px[frames, xs.start:stopx]
+            else:
+                a[a_index_exp] = 0
+
+        return a
+
     @property
     def framestamps(self):
         """Framestamps of all frames.
@@ -616,7 +681,7 @@ file_name=input_file.dcimg>
         `numpy.ndarray`
             A numpy array of dtype `numpy.datetime64` with frame timestamps.
         """
-        return np.asarray([self.ts(i) for i in range(self.nfrms)])
+        return self._decode_timestamps(self._ts_data)
 
     def ts(self, frame):
         """
@@ -631,9 +696,16 @@ file_name=input_file.dcimg>
         -------
         `numpy.datetime64`
         """
-        whole = int.from_bytes(self._ts_data[frame, 0], 'little')
-        fraction = int.from_bytes(self._ts_data[frame, 1], 'little')
-        return np.datetime64(whole * 10**6 + fraction, 'us')
+        return self._decode_timestamps(self._ts_data[frame])
+
+    @staticmethod
+    def _decode_timestamps(ts_data):
+        """Convert (seconds, microseconds) pairs, along the last axis of
+        `ts_data`, to `numpy.datetime64`."""
+        ts_data = np.asarray(ts_data).astype('<u4')
+        microseconds = (ts_data[..., 0].astype(np.int64) * 10**6
+                        + ts_data[..., 1].astype(np.int64))
+        return microseconds.astype('datetime64[us]')
 
     @staticmethod
     def _args_to_slice(arg1, arg2=None, step=None):
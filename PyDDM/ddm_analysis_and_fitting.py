@@ -6,6 +6,10 @@ import yaml
 import os
 import glob
 import pickle
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import itertools
 import ddm_calc as ddm
@@ -34,16 +38,11 @@ try:
 except ModuleNotFoundError:
     print("dcimg readiner not found. try 'pip install dcimg'")
     able_to_open_dcimg = False
-try:
-    import imageio #use 'conda install -c conda-forge imageio' and 'conda install -c conda-forge imageio-mmpeg'
-    able_to_open_mp4 = True
-except ModuleNotFoundError:
-    print("imageio not installed.")
-    able_to_open_mp4 = False
 
 
 import fit_parameters_dictionaries as fpd
 import utils as hf #used to be called 'helper functions'
+import image_readers as readers
 from sklearn.metrics import r2_score
 from sklearn.linear_model import TheilSenRegressor, RANSACRegressor
 from IPython.display import display
@@ -68,6 +67,31 @@ def apply_binning(im, binsize):
     return binned_series
 
 
+def apply_integer_binning(im, binsize):
+    r"""Bin a series of integer images by summing blocks of pixels
+
+    Unlike :py:func:`apply_binning`, the binned images are not converted to floats. For 
+    8- or 16-bit unsigned images, the sums are stored as uint32 (for other integer types, 
+    as 64-bit integers). As with `apply_binning`, frames are padded with zeros if their 
+    size is not a multiple of `binsize`, so dividing the result by ``binsize**2`` gives 
+    the same as `apply_binning`.
+
+    :param im: The movie, a series of frames in ndarry format (of integer dtype).
+    :type im: ndarray
+
+    :param binsize: the number, n gives a square of n x n dimension that should be combined to one pixel
+    :type binsize: int
+
+
+    :return:
+        * binned_series (*ndarray*)- Binned time series
+
+    """
+    binned_series = readers.bin_by_summing(im, binsize)
+
+    return binned_series
+
+
 def recalculate_ISF_with_new_background(ddm_dataset, 
                                         background_method = None,
                                         background_val = None):
@@ -190,8 +214,18 @@ class DDM_Analysis:
         self.data_dir = None
         self.filename = None
         self.number_of_lag_times = None
+        self.im = None #image stack (or list of stacks) to analyze, once read
+        self.ddm_dataset = None
         
         self.loaded_mp4 = False #if loading mp4, image data handled a bit differently 
+        self.selected_at_read = False #if frames and ROI were already selected when the images were read
+        self.channel = None
+        self.timestamps = None #acquisition time of each frame (in seconds), if using the camera's timestamps
+        self.framestamps = None #camera's frame counter for each frame, if using the camera's timestamps
+        self.dropped_frames = None #number of frames dropped during acquisition, if using the camera's framestamps
+        self.pipeline_occupancy = None #fraction of time the read and FFT stages were busy, if using the prefetch pipeline
+        self.window_at_fft = False #if the windowing function is applied to the frames when Fourier transforming them
+        self.intensity_scale = 1 #scale of the frames' values (e.g., 1/binsize**2 when binned frames hold sums of pixels)
         
         if (isinstance(data_yaml, str)) or (isinstance(data_yaml, dict)):
             self.data_yaml=data_yaml
@@ -245,8 +279,12 @@ class DDM_Analysis:
         self.filename= self.content['FileName']
         
 
+        #The movie may also be a sequence of image files (given as a directory or glob pattern)
+        self.image_sequence = readers.is_image_sequence(self.data_dir+self.filename)
+
         #Make sure the path to the movie exists before proceeding
-        if os.path.exists(self.data_dir+self.filename):
+        if os.path.exists(self.data_dir+self.filename) or (self.image_sequence and
+                                                            len(readers.find_image_sequence(self.data_dir+self.filename)) > 0):
             #print('File path to image data exists.')
             #ddm.logger.info("File path to image data exists.")
             if 'Metadata' in self.content:
@@ -266,7 +304,7 @@ class DDM_Analysis:
             if 'filename_for_saved_data' in self.analysis_parameters:
                 self.filename_for_saving_data = self.analysis_parameters['filename_for_saved_data']
             else:
-                self.filename_for_saving_data = self.filename[:-4]
+                self.filename_for_saving_data = readers.name_for_saving(self.filename, self.data_dir)
                 if self.channel is not None:
                     if self.channel in [0,1,2,3]:
                         self.filename_for_saving_data = "%s_c=%i" % (self.filename_for_saving_data, self.channel)
@@ -302,6 +340,32 @@ class DDM_Analysis:
                 self.num_dif_max = self.analysis_parameters['number_differences_max']
             else:
                 self.num_dif_max = None
+            if 'use_timestamps' in self.analysis_parameters:
+                self.use_timestamps = self.analysis_parameters['use_timestamps']
+            else:
+                self.use_timestamps = False
+            if 'frame_stride' in self.analysis_parameters:
+                self.frame_stride = self.analysis_parameters['frame_stride']
+                if (not isinstance(self.frame_stride, int)) or (self.frame_stride < 1):
+                    print("Parameter 'frame_stride' must be a positive integer. Using every frame.")
+                    self.frame_stride = 1
+            else:
+                self.frame_stride = 1
+            self.frame_windows = None
+            if 'frame_windows' in self.analysis_parameters:
+                if self.analysis_parameters['frame_windows'] is not None:
+                    if all((len(window)==2) and (window[0] < window[1]) for window in self.analysis_parameters['frame_windows']):
+                        self.frame_windows = self.analysis_parameters['frame_windows']
+                    else:
+                        print("For 'frame_windows', each window must be a list [start, stop] with start < stop. Not using frame windows.")
+            if 'prefetch_pipeline' in self.analysis_parameters:
+                self.use_pipeline = self.analysis_parameters['prefetch_pipeline']
+            else:
+                self.use_pipeline = False
+            if 'pipeline_block_size' in self.analysis_parameters:
+                self.pipeline_block_size = self.analysis_parameters['pipeline_block_size']
+            else:
+                self.pipeline_block_size = 64
               
             self.crp_region = None
             if 'crop_to_roi' in self.analysis_parameters:
@@ -367,6 +431,27 @@ class DDM_Analysis:
         if not load_images:
             return None
 
+        is_tiff = (not self.image_sequence) and ((re.search(".\.tif$", self.filename) is not None) or
+                                                 (re.search(".\.tiff$", self.filename) is not None))
+        if (type(self.channel)==list) and not (is_tiff and readers.able_to_use_tifffile):
+            print("Reading several channels is only possible for TIFF stacks (with tifffile installed). Using c=%i." % self.channel[0])
+            self.channel = self.channel[0]
+        if self.use_timestamps and (re.search(".\.dcimg$", self.filename) is None):
+            print("Frame timestamps can only be read from .dcimg files. Lag times will be found with the frame rate.")
+
+        if self.image_sequence:
+            # Directory or glob pattern of image files. Files are decoded in a thread pool
+            #  and the frames (cropped as they are decoded) are put in a preallocated stack.
+            im = readers.read_image_sequence(self.data_dir + self.filename, first_frame=self.first_frame,
+                                             last_frame=self.last_frame, crop_region=self.crp_region,
+                                             frame_stride=self.frame_stride, frame_windows=self.frame_windows)
+            if im is not None:
+                self.image_for_report = readers.read_image_sequence(self.data_dir + self.filename,
+                                                                    first_frame=self.first_frame,
+                                                                    last_frame=self.first_frame+1)[0]
+                self.selected_at_read = True
+            return im
+
         if re.search(".\.nd2$", self.filename) is not None:
             if able_to_open_nd2:
                 # Files with nd2 extension will be read using the package
@@ -382,14 +467,38 @@ class DDM_Analysis:
                     print('\t%d x %d px' % (images.metadata['width'], images.metadata['height']))
                     print('\tPixel size of: %.2f microns' % images.metadata['pixel_microns'])
                     print('\tNumber of frames: %i' % images.sizes['t'])
-                    im = np.zeros((images.sizes['t'], images.metadata['width'], images.metadata['height']), dtype=np.uint16)
-                    for i in range(images.sizes['t']):
-                        im[i] = images.get_frame_2D(t=i, c=self.channel)
+                # Only the frames and region of interest to be analyzed are read, by several threads
+                with readers.ND2Stack(self.data_dir+self.filename, first_frame=self.first_frame,
+                                      last_frame=self.last_frame, channel=self.channel,
+                                      crop_region=self.crp_region, frame_stride=self.frame_stride,
+                                      frame_windows=self.frame_windows) as stack:
+                    if len(stack) == 0:
+                        return None
+                    im = stack.read()
+                    self.image_for_report = stack.frame(0, crop=False)
+                self.selected_at_read = True
             else:
                 print("It seems you have an nd2 file to open. But nd2reader not installed!")
                 return 
 
-        if (re.search(".\.tif$", self.filename) is not None) or (re.search(".\.tiff$", self.filename) is not None):
+        if is_tiff:
+            if readers.able_to_use_tifffile:
+                # Only the frames and region of interest to be analyzed are read (the file
+                #  is memory mapped if possible), rather than loading the whole stack. If
+                #  `channel` is a list, each channel is read (in one pass) into its own stack.
+                im = readers.read_tiff_stack(self.data_dir + self.filename, first_frame=self.first_frame,
+                                             last_frame=self.last_frame, crop_region=self.crp_region,
+                                             channel=self.channel, frame_stride=self.frame_stride,
+                                             frame_windows=self.frame_windows)
+                if im is None:
+                    return None
+                report_channel = self.channel[0] if type(self.channel)==list else self.channel
+                self.image_for_report = readers.read_tiff_stack(self.data_dir + self.filename,
+                                                                first_frame=self.first_frame,
+                                                                last_frame=self.first_frame+1,
+                                                                channel=report_channel)[0]
+                self.selected_at_read = True
+                return im
             im = io.imread(self.data_dir + self.filename)
             if len(im.shape)==4:
                 if self.channel is None:
@@ -402,36 +511,29 @@ class DDM_Analysis:
         if (re.search(".\.dcimg$", self.filename) is not None):
             if able_to_open_dcimg:
                 dcimg_loaded = dcimg.DCIMGFile(self.data_dir + self.filename)
-                im = np.zeros(dcimg_loaded.shape, dtype=np.uint16)
-                for i in range(im.shape[0]):
-                    im[i] = dcimg_loaded[i]
+                # The frames and region of interest are copied from the memory mapped
+                #  file in one block for each run of frames (with the 4px correction applied to the whole block)
+                frames = self._select_frames(dcimg_loaded.nfrms)
+                if len(frames) == 0:
+                    return None
+                im = np.concatenate([dcimg_loaded.read_block(start, stop, roi=self.crp_region, step=self.frame_stride)
+                                     for start, stop in readers.frame_runs(frames, self.frame_stride)])
+                self.image_for_report = dcimg_loaded.read_block(self.first_frame, self.first_frame+1)[0]
+                self.selected_at_read = True
+                if self.use_timestamps:
+                    self._read_timestamps(dcimg_loaded)
             else:
                 print("dcimg not loaded...")
                 return
             
         if (re.search(".\.mp4$", self.filename) is not None):
-            if able_to_open_mp4:
-                vid = imageio.get_reader(self.data_dir + self.filename)
-                numFrames = vid.count_frames()
-                im1 = vid.get_data(0)
-                if self.crp_region is not None:
-                    im1 = im1[self.crp_region[0]:self.crp_region[1], self.crp_region[2]:self.crp_region[3],:]
-                if self.binsize > 1:
-                    im1 = downscale_local_mean(im1[:,:,0], (self.binsize, self.binsize))
-                else:
-                    im1 = im1[:,:,0]
-                if self.last_frame is not None:
-                    numFrames = self.last_frame - self.first_frame
-                im = np.zeros((numFrames, im1.shape[0], im1.shape[1]), dtype=np.uint16)
-                for i in range(self.first_frame, self.first_frame + numFrames):
-                    temp = vid.get_data(i)
-                    if self.crp_region is not None:
-                        temp = temp[self.crp_region[0]:self.crp_region[1], self.crp_region[2]:self.crp_region[3],:]
-                    if self.binsize > 1:
-                        temp = downscale_local_mean(temp[:,:,0], (self.binsize, self.binsize))
-                    else:
-                        temp = temp[:,:,0]
-                    im[i-self.first_frame] = temp
+            if readers.able_to_use_imageio:
+                # Frame ranges are decoded in parallel, with cropping and binning done as
+                #  each frame is decoded. Readers seek to `first_frame` rather than decoding from the start.
+                im = readers.read_mp4_stack(self.data_dir + self.filename, first_frame=self.first_frame,
+                                            last_frame=self.last_frame, crop_region=self.crp_region,
+                                            binsize=self.binsize, frame_stride=self.frame_stride,
+                                            frame_windows=self.frame_windows)
                 self.loaded_mp4 = True
             else:
                 print("mp4 opener not loaded...")
@@ -440,6 +542,208 @@ class DDM_Analysis:
         return im
 
 
+    def _select_frames(self, number_of_frames):
+        r"""Indices of the frames to analyze, from 'starting_frame_number', 'ending_frame_number', 
+        'frame_stride' and 'frame_windows' (see :py:func:`PyDDM.image_readers.select_frames`). 
+        A message is printed if no frames are selected."""
+        frames = readers.select_frames(number_of_frames, self.first_frame, self.last_frame,
+                                       self.frame_stride, self.frame_windows)
+        readers.check_frames_selected(frames, number_of_frames)
+        return frames
+
+
+    def _frame_numbers_for_pairs(self):
+        r"""Frame numbers used to pair frames separated by each lag time.
+
+        With 'frame_windows', there are gaps between the frames read. The frames are then 
+        paired by their frame number (counted in units of 'frame_stride') rather than by 
+        their position in the stack. With the camera's framestamps, those are used. 
+
+        Returns
+        -------
+        frame_numbers : array or None
+            None if the frames analyzed are evenly spaced
+
+        """
+        if self.framestamps is not None:
+            if self.frame_stride == 1:
+                return self.framestamps
+            print("Framestamps are not used to pair frames when using 'frame_stride'.")
+        if self.frame_windows is None:
+            return None
+        frames = readers.select_frames(max(stop for start, stop in self.frame_windows), self.first_frame,
+                                       self.last_frame, self.frame_stride, self.frame_windows)
+        #Windows may extend past the end of the movie
+        if type(self.im)==list:
+            frames = frames[:self.im[0].shape[0]]
+        elif type(self.im)==np.ndarray:
+            frames = frames[:self.im.shape[0]]
+        elif self.timestamps is not None:
+            frames = frames[:len(self.timestamps)]
+        return (frames - frames[0]) // self.frame_stride
+
+
+    def _read_timestamps(self, dcimg_loaded):
+        r"""Reads the camera's timestamps and framestamps for the frames to analyze.
+
+        Sets `timestamps` (seconds since the first frame analyzed) and `framestamps`. 
+        Frames dropped during acquisition are found from gaps in the framestamps. 
+
+        Parameters
+        ----------
+        dcimg_loaded : DCIMGFile
+            The opened DCIMG file
+
+        """
+        frames = self._select_frames(dcimg_loaded.nfrms)
+        if len(frames) == 0:
+            return
+        timestamps = dcimg_loaded.timestamps[frames]
+        self.timestamps = (timestamps - timestamps[0]) / np.timedelta64(1, 's')
+        self.framestamps = np.asarray(dcimg_loaded.framestamps[frames]).astype(np.int64)
+
+        if (len(self.timestamps) < 2) or np.any(np.diff(self.timestamps) <= 0):
+            print("Frame timestamps are not increasing. Lag times will be found with the frame rate.")
+            self.timestamps = None
+            self.framestamps = None
+            return
+        if np.any(np.diff(self.framestamps) <= 0):
+            print("Framestamps are not increasing. Cannot check for dropped frames.")
+            self.framestamps = None
+        else:
+            gap_indices, number_dropped = ddm.find_dropped_frames(self.framestamps, frames)
+            self.dropped_frames = int(number_dropped.sum())
+            if len(gap_indices) > 0:
+                print("%i frames were dropped (in %i places), the first after frame %i." % (self.dropped_frames, len(gap_indices),
+                                                                                            frames[gap_indices[0]]))
+                if self.frame_stride == 1:
+                    print("Pairs of frames will be found using the framestamps.")
+            else:
+                print("No dropped frames found.")
+        frame_interval = np.median(np.diff(self.timestamps))
+        if self.framestamps is not None:
+            frame_interval = np.median(np.diff(self.timestamps) / np.diff(self.framestamps))
+        print("Frame rate from timestamps: %.4g (frame rate given: %.4g)." % (1./frame_interval, self.frame_rate))
+
+
+    def _iter_frame_blocks(self, first_frame, last_frame, crop_region=None, block_size=64, binsize=1,
+                           frame_stride=1, frame_windows=None):
+        r"""Generator of consecutive blocks of frames read from the movie.
+
+        Returns None if the movie's file type cannot be read a block at a time. 
+
+        Parameters
+        ----------
+        first_frame : int
+            First frame to read
+        last_frame : int or None
+            Frames up to (but not including) this one are read. If None, to the end.
+        crop_region : list or None, optional
+            Region to keep, as [y1,y2,x1,x2]. Default is None (the full frame).
+        block_size : int, optional
+            Number of frames in each block. Default is 64.
+        binsize : int, optional
+            Binning done as frames are decoded (only for mp4 files). Default is 1.
+        frame_stride : int, optional
+            Only every `frame_stride`-th frame is read. Default is 1.
+        frame_windows : list or None, optional
+            List of [start, stop] frame ranges to read. Default is None.
+
+        """
+        path = self.data_dir + self.filename
+        if self.image_sequence:
+            files = readers.find_image_sequence(path)
+            files = [files[i] for i in readers.select_frames(len(files), first_frame, last_frame, frame_stride, frame_windows)]
+            return readers.stack_in_blocks(readers.iter_image_sequence(files, crop_region=crop_region), block_size)
+        if (re.search(".\.nd2$", self.filename) is not None) and able_to_open_nd2:
+            def nd2_blocks():
+                with readers.ND2Stack(path, first_frame=first_frame, last_frame=last_frame,
+                                      channel=self.channel, crop_region=crop_region,
+                                      frame_stride=frame_stride, frame_windows=frame_windows) as stack:
+                    for block in stack.iter_blocks(block_size):
+                        yield block
+            return nd2_blocks()
+        if ((re.search(".\.tif$", self.filename) is not None) or (re.search(".\.tiff$", self.filename) is not None)) and readers.able_to_use_tifffile:
+            return readers.iter_tiff_blocks(path, first_frame=first_frame, last_frame=last_frame,
+                                            crop_region=crop_region, channel=self.channel, block_size=block_size,
+                                            frame_stride=frame_stride, frame_windows=frame_windows)
+        if (re.search(".\.dcimg$", self.filename) is not None) and able_to_open_dcimg:
+            def dcimg_blocks():
+                with dcimg.DCIMGFile(path) as dcimg_loaded:
+                    frames = readers.select_frames(dcimg_loaded.nfrms, first_frame, last_frame, frame_stride, frame_windows)
+                    for start in range(0, len(frames), block_size):
+                        runs = readers.frame_runs(frames[start:start+block_size], frame_stride)
+                        yield np.concatenate([dcimg_loaded.read_block(run_start, run_stop, roi=crop_region, step=frame_stride)
+                                              for run_start, run_stop in runs])
+            return dcimg_blocks()
+        if (re.search(".\.mp4$", self.filename) is not None) and readers.able_to_use_imageio:
+            return readers.iter_mp4_blocks(path, first_frame=first_frame, last_frame=last_frame,
+                                           crop_region=crop_region, binsize=binsize, block_size=block_size,
+                                           frame_stride=frame_stride, frame_windows=frame_windows)
+        return None
+
+
+    def _prepare_pipeline(self):
+        r"""Prepares to read the images while the DDM matrix is computed.
+
+        With the 'prefetch_pipeline' option, the images are not read when the analysis 
+        is set up. Instead, blocks of frames are read (and cropped and binned) 
+        in a background thread while the frames already read are Fourier transformed. 
+        Only the first frame is read here (for the report). 
+
+        Returns
+        -------
+        prepared : bool
+            False if the images cannot be read this way, in which case they should be read 
+            as usual. True if prepared, or if there are no frames to read. 
+
+        """
+        split_into_4_rois = ('split_into_4_rois' in self.analysis_parameters) and self.analysis_parameters['split_into_4_rois']
+        if split_into_4_rois or (type(self.channel)==list):
+            print("The prefetch pipeline does not split into tiles or read several channels. Reading the images first.")
+            return False
+        if (re.search(".\.nd2$", self.filename) is not None) and (self.channel is None):
+            print("Need to specify channel in yaml metadata. Defaulting to c=0.")
+            self.channel = 0
+        first_frame_blocks = self._iter_frame_blocks(self.first_frame, self.first_frame+1, block_size=1)
+        if first_frame_blocks is None:
+            print("The prefetch pipeline cannot read this type of file. Reading the images first.")
+            return False
+        first_block = next(first_frame_blocks, None)
+        if first_block is None:
+            #No frames to read (a message has been printed), with the pipeline or otherwise
+            print("Image not loaded.")
+            self.use_pipeline = False
+            return True
+        self.image_for_report = first_block[0]
+        first_frame_blocks.close()
+
+        if self.use_timestamps:
+            if (re.search(".\.dcimg$", self.filename) is not None):
+                with dcimg.DCIMGFile(self.data_dir + self.filename) as dcimg_loaded:
+                    self._read_timestamps(dcimg_loaded)
+            else:
+                print("Frame timestamps can only be read from .dcimg files. Lag times will be found with the frame rate.")
+
+        self.im = None
+        self.loaded_mp4 = re.search(".\.mp4$", self.filename) is not None
+        if 'binning' in self.analysis_parameters:
+            if self.analysis_parameters['binning'] and ('bin_size' not in self.analysis_parameters):
+                print("Bin size not set! Using 2x2 binning. Re-run with 'binning' as false if no binning desired.")
+                self.binsize = 2
+        if self.binsize > 1:
+            #The number of pixels will be reduced by binning, therefore the pixel size overwritten:
+            self.pixel_size = self.pixel_size*self.binsize
+        if (self.last_frame is not None) and (self.last_frame <= self.last_lag_time):
+            print('The last frame number should be higher than the frame for the last lag time')
+            self.last_lag_time = self.last_frame-1
+            print('Setting last_lag_time to %i.' % self.last_lag_time)
+        print("Frames will be read, %i at a time, while the DDM matrix is computed." % self.pipeline_block_size)
+        print('Maximum lag time (in frames): %i' % self.last_lag_time)
+        print('Number of lag times to compute DDM matrix: %i' % self.number_of_lag_times)
+        return True
+
+
     def setup(self, load_images):
         r"""Based off user-provided parameters, prepares images for the DDM analysis. 
         
@@ -450,22 +754,39 @@ class DDM_Analysis:
 
         """
 
+        if load_images and self.use_pipeline:
+            if self._prepare_pipeline():
+                return
 
         image_data = self._openImage(load_images)
         if image_data is None:
             print("Image not loaded.")
         else:
-            print("Image shape: %i-by-%i-by-%i" % image_data.shape)
+            if type(image_data)==list:
+                print("Read %i channels, each with image shape: %i-by-%i-by-%i" % ((len(image_data),) + image_data[0].shape))
+            else:
+                print("Image shape: %i-by-%i-by-%i" % image_data.shape)
             
             if self.loaded_mp4:
                 print("Loaded mp4 file.")
                 self.im=image_data
-                self.image_for_report = self.im[0]
+                #Integer frames were binned by summing pixels as they were decoded
+                if (self.binsize > 1) and np.issubdtype(self.im.dtype, np.integer):
+                    self.intensity_scale = 1./self.binsize**2
+                self.image_for_report = self.im[0]*self.intensity_scale
                 self.pixel_size = self.pixel_size*self.binsize
                 return
     
             #crops the number of frames based on given max frame numbers
-            if self.last_frame is None:
+            if self.selected_at_read:
+                self.im=image_data
+                if (self.last_frame is not None) and (self.last_frame <= self.last_lag_time):
+                    print('The last frame number should be higher than the frame for the last lag time')
+                    self.last_lag_time = self.last_frame-1
+                    print('Setting last_lag_time to %i.' % self.last_lag_time)
+            elif (self.frame_stride > 1) or (self.frame_windows is not None):
+                self.im=image_data[self._select_frames(image_data.shape[0])]
+            elif self.last_frame is None:
                 self.im=image_data[self.first_frame::,:,:]
             elif self.last_frame <= self.last_lag_time:
                 print('The last frame number should be higher than the frame for the last lag time')
@@ -473,50 +794,62 @@ class DDM_Analysis:
                 print('Setting last_lag_time to %i.' % self.last_lag_time)
             else:
                 self.im=image_data[self.first_frame:self.last_frame,:,:]
-            print('Number of frames to use for analysis: %i' % self.im.shape[0])
+            #With several channels, self.im is a list with a stack for each channel
+            image_shape = self.im[0].shape if type(self.im)==list else self.im.shape
+            if image_shape[0] == 0:
+                if not ((self.frame_stride > 1) or (self.frame_windows is not None)):
+                    readers.check_frames_selected([], image_data.shape[0])
+                self.im = None
+                return
+            print('Number of frames to use for analysis: %i' % image_shape[0])
             print('Maximum lag time (in frames): %i' % self.last_lag_time)
             print('Number of lag times to compute DDM matrix: %i' % self.number_of_lag_times)
     
-            self.image_for_report = self.im[0]
+            if not self.selected_at_read:
+                self.image_for_report = self.im[0]
 
             if 'crop_to_roi' in self.analysis_parameters:
                 if self.analysis_parameters['crop_to_roi'] is not None:
                     if len(self.analysis_parameters['crop_to_roi'])==4:
                         #if there is a list with pixel coordinates for cropping the new image will be cropped
                         crp_region = self.analysis_parameters['crop_to_roi']
-                        self.im = self.im[:, crp_region[0]:crp_region[1], crp_region[2]:crp_region[3]]
-                        print('New dimensions after cropping: %i-by-%i' % self.im.shape[1:])
+                        if not self.selected_at_read:
+                            self.im = self.im[:, crp_region[0]:crp_region[1], crp_region[2]:crp_region[3]]
+                            image_shape = self.im.shape
+                        print('New dimensions after cropping: %i-by-%i' % image_shape[1:])
                     else:
                         print("For cropping images, 'crop_to_roi' must be list of four integers.")
-                        print("Using the full frame, dimensions: %i-by-%i." % self.im.shape[1:])
+                        print("Using the full frame, dimensions: %i-by-%i." % image_shape[1:])
             else:
                 #Just keep the whole frame
-                print("Using the full frame, dimensions: %i-by-%i." % self.im.shape[1:])
-    
+                print("Using the full frame, dimensions: %i-by-%i." % image_shape[1:])
+
+            split_into_4_rois = False
             if 'split_into_4_rois' in self.analysis_parameters:
-                if self.analysis_parameters['split_into_4_rois']:
-                    print('Splitting into four tiles...')
-                    #split image into four tiles
-                    newarr = np.dsplit(self.im,2) #splits vertically
-                    roi0, roi1 = np.hsplit(newarr[0],2) #split horizontally
-                    roi2, roi3 = np.hsplit(newarr[1],2)
-                    print(f'New dimensions for ROIs: {roi0.shape}')
-                    
-                    if 'use_windowing_function' in self.analysis_parameters:
-                        if self.analysis_parameters['use_windowing_function']:
-                            print("Applying windowing function to each ROI...")
-                            roi0 = ddm.window_function(roi0)*roi0
-                            roi1 = ddm.window_function(roi1)*roi1
-                            roi2 = ddm.window_function(roi2)*roi2
-                            roi3 = ddm.window_function(roi3)*roi3
-        
-                    self.im = [roi0, roi1, roi2, roi3]
+                split_into_4_rois = self.analysis_parameters['split_into_4_rois']
+                if split_into_4_rois and (type(self.im)==list):
+                    print("Cannot split into four tiles when analyzing several channels. Using the full frame.")
+                    split_into_4_rois = False
     
-            else:
-                if 'use_windowing_function' in self.analysis_parameters:
-                    if self.analysis_parameters['use_windowing_function']:
-                        print("Applying windowing function...")
-                        self.im=ddm.window_function(self.im)*self.im
+            if split_into_4_rois:
+                print('Splitting into four tiles...')
+                #split image into four tiles
+                newarr = np.dsplit(self.im,2) #splits vertically
+                roi0, roi1 = np.hsplit(newarr[0],2) #split horizontally
+                roi2, roi3 = np.hsplit(newarr[1],2)
+                print(f'New dimensions for ROIs: {roi0.shape}')
+                    
+                self.im = [roi0, roi1, roi2, roi3]
+
+            #The windowing function is applied to each frame as it is Fourier transformed, 
+            # rather than to the whole stack here (which would make a float64 copy of it)
+            if 'use_windowing_function' in self.analysis_parameters:
+                if self.analysis_parameters['use_windowing_function']:
+                    if split_into_4_rois:
+                        print("Windowing function will be applied to each ROI when Fourier transforming...")
+                    else:
+                        print("Windowing function will be applied when Fourier transforming...")
+                    self.window_at_fft = True
     
             #After cropping, the images might be binned, this is done before splitting in tiles
             if 'binning' in self.analysis_parameters:
@@ -526,12 +859,17 @@ class DDM_Analysis:
                     else:
                         print("Bin size not set! Using 2x2 binning. Re-run with 'binning' as false if no binning desired.")
                         self.binsize = 2
+                    #Integer images are binned by summing pixels, keeping them as integers
+                    integer_images = np.issubdtype((self.im[0] if type(self.im)==list else self.im).dtype, np.integer)
+                    binning_function = apply_integer_binning if integer_images else apply_binning
+                    if integer_images:
+                        self.intensity_scale = 1./self.binsize**2
                     if type(self.im) == list:
                         for i,im in enumerate(self.im):
-                            self.im[i] = apply_binning(im, self.binsize)
+                            self.im[i] = binning_function(im, self.binsize)
                         dims_after_binning = self.im[0].shape
                     else:
-                        self.im = apply_binning(self.im, self.binsize)
+                        self.im = binning_function(self.im, self.binsize)
                         dims_after_binning = self.im.shape
     
                     #The number of pixels has been reduced by binning procedure, therefore the pixel size overwritten:
@@ -628,7 +966,13 @@ class DDM_Analysis:
             
         self.lag_times_frames = ddm.generateLogDistributionOfTimeLags(self.first_lag_time, self.last_lag_time,
                                                                       self.number_of_lag_times)
-        self.lag_times = self.lag_times_frames / self.frame_rate
+        #With 'frame_stride', one frame of the analyzed stack is `frame_stride` frames of the movie
+        self.lag_times = self.lag_times_frames * self.frame_stride / self.frame_rate
+        self.frame_numbers = self._frame_numbers_for_pairs()
+        if self.timestamps is not None:
+            #Lag times from when the frames were actually acquired
+            self.lag_times = ddm.lag_times_from_timestamps(self.timestamps, self.lag_times_frames,
+                                                           frame_numbers=self.frame_numbers)
 
         #print(f"Calculating the DDM matrix for {self.filename}...")
         self._computeDDMMatrix(quiet=quiet, velocity=velocity, bg_subtract_for_AB_determination=bg_subtract_for_AB_determination)
@@ -646,6 +990,19 @@ class DDM_Analysis:
         A, B and radial averages. The data set is saved as netCDF file and a
         pdf report is produced
         '''
+        pipelined = False
+        if (self.im is None) and self.use_pipeline:
+            if (abs(velocity[0]) > 0) or (abs(velocity[1]) > 0):
+                print("Cannot correct for velocity with the prefetch pipeline. Set 'prefetch_pipeline' to False.")
+                return False
+            pipelined = self._computeDDMMatrix_pipelined(quiet=quiet)
+            if not pipelined:
+                return False
+
+        if (type(self.im)!=list) and (type(self.im)!=np.ndarray):
+            print("Image data not yet read!")
+            return False
+
         #Calculate q_x and q_y and q which will function as coordinates
         if type(self.im)==list:
             self.q_y=np.sort(np.fft.fftfreq(self.im[0].shape[1], d=self.pixel_size))*2*np.pi
@@ -655,47 +1012,71 @@ class DDM_Analysis:
             self.q_y=np.sort(np.fft.fftfreq(self.im.shape[1], d=self.pixel_size))*2*np.pi
             self.q_x=self.q_y
             self.q=np.arange(0,self.im.shape[1]/2)*2*np.pi*(1./(self.im.shape[1]*self.pixel_size))
-            
-        if (type(self.im)==list) or (type(self.im)==np.ndarray):
-            pass
-        else:
-            print("Image data not yet read!")
-            return False
         
         start_time = time.time()
-        self.ddm_matrix = []
-        if (abs(velocity[0]) > 0) or (abs(velocity[1]) > 0):
+        if pipelined:
+            #DDM matrix already found while the images were read
+            pass
+        elif (abs(velocity[0]) > 0) or (abs(velocity[1]) > 0):
+            self.ddm_matrix = []
+            self.ddm_matrix_stderr = None #Not found when correcting for velocity
             print("Will run DDM computation to correct for velocity...")
             print(velocity)
-            vx = velocity[0] / self.frame_rate
-            vy = velocity[1] / self.frame_rate
+            if self.frame_numbers is not None:
+                print("Dropped frames (or gaps between frame windows) are not accounted for when correcting for velocity.")
+            vx = velocity[0] * self.frame_stride / self.frame_rate
+            vy = velocity[1] * self.frame_stride / self.frame_rate
             self.ddm_matrix, self.num_pairs_per_dt = ddm.computeDDMMatrix_correctVelocityPhase(self.im, self.lag_times_frames, 
                                                                             [vx,vy], self.pixel_size, quiet=quiet,
+                                                                            use_BH_windowing=self.window_at_fft,
                                                                             overlap_method=self.overlap_method, 
                                                                             number_differences_max=self.num_dif_max)
             end_time = time.time()
         else:
+            self.ddm_matrix = []
+            self.ddm_matrix_stderr = None
             try:
                 if type(self.im)==list:
+                    self.ddm_matrix_stderr = []
                     for i,im in enumerate(self.im):
                         print(f"Getting DDM matrix for {i+1} of {len(self.im)}...")
-                        d_matrix, num_pairs = ddm.computeDDMMatrix(im, self.lag_times_frames, quiet=quiet,
-                                                                   overlap_method=self.overlap_method,
-                                                                   number_differences_max=self.num_dif_max)
+                        d_matrix, num_pairs, d_stderr = ddm.computeDDMMatrix(im, self.lag_times_frames, quiet=quiet,
+                                                                             use_BH_windowing=self.window_at_fft,
+                                                                             overlap_method=self.overlap_method,
+                                                                             number_differences_max=self.num_dif_max,
+                                                                             return_stderr=True,
+                                                                             frame_numbers=self.frame_numbers)
                         self.ddm_matrix.append(d_matrix)
+                        self.ddm_matrix_stderr.append(d_stderr)
                     self.num_pairs_per_dt = num_pairs
                 else:
-                    self.ddm_matrix, self.num_pairs_per_dt = ddm.computeDDMMatrix(self.im, self.lag_times_frames, 
-                                                                                  quiet=quiet,
-                                                                                  overlap_method=self.overlap_method,
-                                                                                  number_differences_max=self.num_dif_max)
+                    self.ddm_matrix, self.num_pairs_per_dt, self.ddm_matrix_stderr = ddm.computeDDMMatrix(self.im, self.lag_times_frames, 
+                                                                                                          quiet=quiet,
+                                                                                                          use_BH_windowing=self.window_at_fft,
+                                                                                                          overlap_method=self.overlap_method,
+                                                                                                          number_differences_max=self.num_dif_max,
+                                                                                                          return_stderr=True,
+                                                                                                          frame_numbers=self.frame_numbers)
     
                 end_time = time.time()
             except:
                 print("Unable to get DDM matrix.")
                 return False
 
-        print("DDM matrix took %s seconds to compute." % (end_time - start_time))
+        if not pipelined:
+            print("DDM matrix took %s seconds to compute." % (end_time - start_time))
+
+        if self.intensity_scale != 1:
+            #Binned frames hold sums of pixels, so scale the DDM matrix to what it is for averaged pixels
+            scale = self.intensity_scale**2
+            if type(self.ddm_matrix)==list:
+                self.ddm_matrix = [d*scale for d in self.ddm_matrix]
+                if self.ddm_matrix_stderr is not None:
+                    self.ddm_matrix_stderr = [d*scale for d in self.ddm_matrix_stderr]
+            else:
+                self.ddm_matrix = self.ddm_matrix*scale
+                if self.ddm_matrix_stderr is not None:
+                    self.ddm_matrix_stderr = self.ddm_matrix_stderr*scale
 
         if type(self.im)==list:
             self.ravs = []
@@ -706,6 +1087,17 @@ class DDM_Analysis:
         else:
             self.ravs = ddm.radial_avg_ddm_matrix(self.ddm_matrix, centralAngle=self.central_angle,
                                                   angRange=self.angle_range)
+
+        #Standard error of the radially averaged DDM matrix (used to weight fits)
+        if self.ddm_matrix_stderr is None:
+            self.ravs_stderr = None
+        elif type(self.im)==list:
+            self.ravs_stderr = [ddm.radial_avg_ddm_stderr(d, centralAngle=self.central_angle,
+                                                          angRange=self.angle_range) for d in self.ddm_matrix_stderr]
+        else:
+            self.ravs_stderr = ddm.radial_avg_ddm_stderr(self.ddm_matrix_stderr, centralAngle=self.central_angle,
+                                                         angRange=self.angle_range)
+        self.ddm_matrix_stderr = None #Only the radial average is kept
             
             
         if type(self.im)==list:
@@ -719,25 +1111,39 @@ class DDM_Analysis:
             
 
         #Determine Amplitude and Background from radial averages of directly fourier transformed images (not difference images)
-        # Note: windowing (if applicable) already applied to self.im, so "use_BH_filter" should be False always
-        if type(self.im)==list:
+        # Note: windowing (if applicable) is applied to each frame as it is Fourier transformed
+        if pipelined and (bg_subtract_for_AB_determination is None):
+            #Average of the Fourier transformed images was found while computing the DDM matrix
+            ndx, ndy = self.av_fftsq_of_each_frame.shape
+            self.ravfft = ddm.radial_avg_ddm_matrix(self.av_fftsq_of_each_frame.reshape(1,ndx,ndy),
+                                                    centralAngle=self.central_angle,
+                                                    angRange=self.angle_range)
+        elif type(self.im)==list:
             self.ravfft = []
             for i,im in enumerate(self.im):
-                r = ddm.determining_A_and_B(im, use_BH_filter=False,centralAngle=self.central_angle,
+                r = ddm.determining_A_and_B(im, use_BH_filter=self.window_at_fft,centralAngle=self.central_angle,
                                             angRange=self.angle_range,
                                             subtract_bg = bg_subtract_for_AB_determination)
                 self.ravfft.append(r)
         else:
-            self.ravfft = ddm.determining_A_and_B(self.im, use_BH_filter=False,
+            self.ravfft = ddm.determining_A_and_B(self.im, use_BH_filter=self.window_at_fft,
                                                   centralAngle=self.central_angle,
                                                   angRange=self.angle_range,
                                                   subtract_bg = bg_subtract_for_AB_determination)
+        if self.intensity_scale != 1:
+            if type(self.ravfft)==list:
+                self.ravfft = [r*self.intensity_scale**2 for r in self.ravfft]
+            else:
+                self.ravfft = self.ravfft*self.intensity_scale**2
 
 
         if type(self.im)==list:
             self.ddm_dataset = []
             for i in range(len(self.im)):
-                filename = f"{self.data_dir}{self.filename_for_saving_data}_{i:02}"
+                if type(self.channel)==list:
+                    filename = f"{self.data_dir}{self.filename_for_saving_data}_c={self.channel[i]}"
+                else:
+                    filename = f"{self.data_dir}{self.filename_for_saving_data}_{i:02}"
                 ds = self._create_dataset_and_report(filename, num=i)
                 self.ddm_dataset.append(ds)
         else:
@@ -746,6 +1152,83 @@ class DDM_Analysis:
 
 
 
+    def _computeDDMMatrix_pipelined(self, quiet=False):
+        r"""Reads the images and computes the DDM matrix at the same time.
+
+        Blocks of frames are read (then binned, as set in the YAML file) in a background 
+        thread while the frames already read are (windowed and) Fourier transformed 
+        (see :py:func:`PyDDM.ddm_calc.computeDDMMatrix_pipelined`). The fraction of time 
+        each of these two stages was busy is printed and stored in `pipeline_occupancy`. 
+        If the read stage is busy most of the time, reading the images limits the 
+        computation; if the FFT stage is, computing is the limit. 
+
+        Parameters
+        ----------
+        quiet : boolean (optional)
+            If `False`, messages are printed as the computation proceeds
+
+        Returns
+        -------
+        success : bool
+
+        """
+        windowing = ('use_windowing_function' in self.analysis_parameters) and self.analysis_parameters['use_windowing_function']
+        binning = ('binning' in self.analysis_parameters) and self.analysis_parameters['binning']
+        if self.loaded_mp4:
+            #As when the whole video is read, mp4 frames are binned as they are decoded and not windowed
+            windowing = False
+            binning = False
+            if self.binsize > 1:
+                print("Binning mp4 frames as they are decoded...")
+        else:
+            if windowing:
+                print("Windowing function will be applied when Fourier transforming...")
+            if binning:
+                print("Applying binning to each block of frames...")
+
+        #Windowing is done in the FFT stage. Integer frames are binned by summing pixels (see `setup`).
+        self.window_at_fft = windowing
+        binned_when_decoded = self.loaded_mp4 and (self.binsize > 1)
+        def preprocess(block):
+            if binned_when_decoded and np.issubdtype(block.dtype, np.integer):
+                self.intensity_scale = 1./self.binsize**2
+            elif binning and np.issubdtype(block.dtype, np.integer):
+                self.intensity_scale = 1./self.binsize**2
+                block = apply_integer_binning(block, self.binsize)
+            elif binning:
+                block = apply_binning(block, self.binsize)
+            return block
+
+        frame_blocks = self._iter_frame_blocks(self.first_frame, self.last_frame, crop_region=self.crp_region,
+                                               block_size=self.pipeline_block_size, binsize=self.binsize,
+                                               frame_stride=self.frame_stride, frame_windows=self.frame_windows)
+        start_time = time.time()
+        try:
+            results = ddm.computeDDMMatrix_pipelined(frame_blocks, self.lag_times_frames, preprocess=preprocess,
+                                                     use_BH_windowing=windowing, quiet=quiet, overlap_method=self.overlap_method,
+                                                     return_stderr=True, number_differences_max=self.num_dif_max,
+                                                     frame_numbers=self.frame_numbers)
+        except Exception as e:
+            print("Unable to get DDM matrix.")
+            print(e)
+            return False
+        end_time = time.time()
+        if results is None:
+            print("Unable to get DDM matrix.")
+            return False
+
+        self.ddm_matrix, self.num_pairs_per_dt, self.ddm_matrix_stderr, pipeline_output = results
+        self.im = pipeline_output['frames']
+        self.av_fftsq_of_each_frame = pipeline_output['av_fftsq_of_each_frame']
+        self.pipeline_occupancy = pipeline_output['stage_occupancy']
+        print("Image shape: %i-by-%i-by-%i" % self.im.shape)
+        print("DDM matrix took %s seconds to compute." % (end_time - start_time))
+        print("Reading and Fourier transforming the images took %.3g seconds. Read stage busy %.0f%% of the time, FFT stage busy %.0f%%." % (self.pipeline_occupancy['seconds'],
+                                                                                                                                           100*self.pipeline_occupancy['read'],
+                                                                                                                                           100*self.pipeline_occupancy['fft']))
+        return True
+
+
     def _create_dataset_and_report(self, file_name, num=None):
         r"""
         Creates the xarray Dataset and PDF report.
@@ -781,6 +1264,8 @@ class DDM_Analysis:
             ravs = self.ravs
             image0 = self.im[0].astype(np.float64)
             AF = self.AF
+        #Frames binned by summing pixels are put back on the scale of the unbinned frames
+        image0 = image0*self.intensity_scale
 
         #Put ddm_matrix and radial averages in a dataset:
         ddm_dataset=xr.Dataset({'ddm_matrix_full':(['lagtime', 'q_y','q_x'], ddm_matrix), #was 'ddm_matrix'
@@ -807,6 +1292,13 @@ class DDM_Analysis:
         
         #Number of image differences used to calculate DDM matrix for each lagtime
         ddm_dataset['num_pairs_per_dt'] = (('lagtime'),self.num_pairs_per_dt)
+
+        #Standard error of the (radially averaged) DDM matrix
+        ravs_stderr = getattr(self, 'ravs_stderr', None)
+        if type(ravs_stderr)==list:
+            ravs_stderr = ravs_stderr[num]
+        if ravs_stderr is not None:
+            ddm_dataset['ddm_matrix_stderr'] = (('lagtime','q'), ravs_stderr)
         
         if self.background_method==0:
             ddm_dataset['B'] = 2*ddm_dataset.avg_image_ft[-1*number_of_hi_qs:].mean()
@@ -844,6 +1336,9 @@ class DDM_Analysis:
                         '''
                         if k is None:
                             ddm_dataset.attrs[j] = 'None'
+                        elif isinstance(k, list) and any(isinstance(v, (list, tuple)) for v in k):
+                            #netCDF attributes cannot be nested lists (e.g., 'frame_windows')
+                            ddm_dataset.attrs[j] = str(k)
                         elif isinstance(k, bool):
                             if k==True:
                                 ddm_dataset.attrs[j] = 'True'
@@ -854,6 +1349,13 @@ class DDM_Analysis:
                 except:
                     ddm_dataset.attrs[i]=self.content[i]
 
+        if (self.framestamps is not None) and (self.dropped_frames is not None):
+            ddm_dataset.attrs['dropped_frames'] = self.dropped_frames
+
+        #If several channels were analyzed, each dataset is for one of them
+        if (type(self.channel)==list) and (num is not None):
+            ddm_dataset.attrs['channel'] = self.channel[num]
+
 
         ## write the ddm matrix to disk to the folder where the movie is located
         try:
@@ -919,15 +1421,19 @@ class DDM_Analysis:
         if np.isscalar(lagtime):
             if abs(velocity[0]>0) or abs(velocity[1]>0):
                 print("Will run DDM computation to correct for velocity...")
-                vx = velocity[0] / self.frame_rate
-                vy = velocity[1] / self.frame_rate
-                ddmmat, radav_ddmmat = ddm.temporalVarianceDDMMatrix(self.im, lagtime, vel_corr=[vx, vy, self.pixel_size])
+                vx = velocity[0] * self.frame_stride / self.frame_rate
+                vy = velocity[1] * self.frame_stride / self.frame_rate
+                ddmmat, radav_ddmmat = ddm.temporalVarianceDDMMatrix(self.im, lagtime, use_BH_windowing=self.window_at_fft,
+                                                                     vel_corr=[vx, vy, self.pixel_size])
                 
             else:
-                ddmmat, radav_ddmmat = ddm.temporalVarianceDDMMatrix(self.im, lagtime)
+                ddmmat, radav_ddmmat = ddm.temporalVarianceDDMMatrix(self.im, lagtime, use_BH_windowing=self.window_at_fft)
+            #Binned frames may hold sums of pixels (see `setup`)
+            ddmmat = ddmmat*self.intensity_scale**2
+            radav_ddmmat = radav_ddmmat*self.intensity_scale**2
             
             number_of_times = ddmmat.shape[0]
-            times = np.arange(number_of_times) / self.frame_rate
+            times = np.arange(number_of_times) * self.frame_stride / self.frame_rate
             
             AF,af_axis = self.find_alignment_factor(ddmmat, orientation_axis=orientation_axis)
                 
@@ -936,7 +1442,7 @@ class DDM_Analysis:
                                     'ddm_matrix':(['time', 'q'], radav_ddmmat), 
                                     'alignment_factor':(['time','q'], AF),
                                     'lagtime_frames':(lagtime),
-                                    'lagtime':(lagtime/self.frame_rate)},
+                                    'lagtime':(lagtime * self.frame_stride / self.frame_rate)},
                                    coords={'time': times,
                                            'q_y':self.q_y, 'q_x':self.q_x, 'q':self.q})
             
@@ -948,7 +1454,7 @@ class DDM_Analysis:
             if number_of_lag_times >= number_of_frames:
                 lagtime = np.arange(1,number_of_frames-1)
                 number_of_lag_times = len(lagtime)
-            times = np.arange(number_of_frames-1) / self.frame_rate
+            times = np.arange(number_of_frames-1) * self.frame_stride / self.frame_rate
             if save_full_ddmmat:
                 ddmmat = np.empty((number_of_lag_times, number_of_frames-1, len(self.q_x), len(self.q_y)))
                 ddmmat.fill(np.nan)
@@ -961,11 +1467,14 @@ class DDM_Analysis:
                 if abs(velocity[0]>0) or abs(velocity[1]>0):
                     if i==0:
                         print("Will run DDM computation to correct for velocity...")
-                    vx = velocity[0] / self.frame_rate
-                    vy = velocity[1] / self.frame_rate
-                    ddmmat_temp, radav_ddmmat_temp = ddm.temporalVarianceDDMMatrix(self.im, lag, vel_corr=[vx, vy, self.pixel_size])
+                    vx = velocity[0] * self.frame_stride / self.frame_rate
+                    vy = velocity[1] * self.frame_stride / self.frame_rate
+                    ddmmat_temp, radav_ddmmat_temp = ddm.temporalVarianceDDMMatrix(self.im, lag, use_BH_windowing=self.window_at_fft,
+                                                                                   vel_corr=[vx, vy, self.pixel_size])
                 else:
-                    ddmmat_temp, radav_ddmmat_temp = ddm.temporalVarianceDDMMatrix(self.im, lag)
+                    ddmmat_temp, radav_ddmmat_temp = ddm.temporalVarianceDDMMatrix(self.im, lag, use_BH_windowing=self.window_at_fft)
+                ddmmat_temp = ddmmat_temp*self.intensity_scale**2
+                radav_ddmmat_temp = radav_ddmmat_temp*self.intensity_scale**2
                     
                 AF_temp,af_axis = self.find_alignment_factor(ddmmat_temp, orientation_axis=orientation_axis)
                 
@@ -1040,12 +1549,16 @@ class DDM_Analysis:
             self.q_x=self.q_y
             self.q=np.arange(0,self.im.shape[1]/2)*2*np.pi*(1./(self.im.shape[1]*self.pixel_size))
             
-        times = np.arange(self.im.shape[0]) / self.frame_rate
+        #With 'frame_stride', the frame rate of the analyzed stack is lower
+        frame_rate = self.frame_rate / self.frame_stride
+        times = np.arange(self.im.shape[0]) / frame_rate
         
-        phase = ddm.getPhase_phiDM(self.im, use_gf=use_gf, gfsize=gfsize)
+        #Windowing (if used) is applied when Fourier transforming, so apply it here
+        window = ddm.window_function(self.im) if self.window_at_fft else None
+        phase = ddm.getPhase_phiDM(self.im, use_gf=use_gf, gfsize=gfsize, window=window)
         vx,vy,er = ddm.getVel_phiDM(phase, lagt, self.pixel_size, 
-                                    self.frame_rate, halfsize=halfsize)
-        vtimes = np.arange(len(vx)) / self.frame_rate
+                                    frame_rate, halfsize=halfsize)
+        vtimes = np.arange(len(vx)) / frame_rate
         w = np.where(er < err_limit)
         vx_mean = np.mean(vx[w])
         vy_mean = np.mean(vy[w])
@@ -1332,6 +1845,107 @@ class DDM_Analysis:
                 pdf_to_save_to.savefig()
 
 
+class FitResultsCache:
+    """
+    Cache of fit results, keyed by a hash of everything that determines a fit. 
+
+    Entries are kept in memory, up to `max_entries`, with the least recently used 
+    entry removed first. If `cache_directory` is given, entries are also pickled to 
+    that directory (up to `max_disk_entries` files, again removing the least 
+    recently used) so that they persist between sessions. 
+    
+    :param max_entries: Maximum number of fit results kept in memory, default is 32
+    :type max_entries: int
+    :param cache_directory: Directory to save fit results to. Default is None (memory only)
+    :type cache_directory: None or str
+    :param max_disk_entries: Maximum number of fit results saved in `cache_directory`, default is 256
+    :type max_disk_entries: int
+
+    """
+
+    def __init__(self, max_entries=32, cache_directory=None, max_disk_entries=256):
+        self.max_entries = max_entries
+        self.cache_directory = cache_directory
+        self.max_disk_entries = max_disk_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock() #fits may be run from several threads (see DDM_Fit.fit_models)
+        if cache_directory is not None:
+            os.makedirs(cache_directory, exist_ok=True)
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def make_key(*items):
+        """
+        Returns a hash (hex string) of the items. Arrays (numpy or xarray) are 
+        hashed by their contents, dtype and shape. Other items by their `repr`. 
+        Dictionaries, lists, and tuples are hashed item by item. 
+        """
+        hasher = hashlib.sha256()
+        def add(item):
+            if isinstance(item, (xr.DataArray, np.ndarray)):
+                values = np.ascontiguousarray(np.asarray(item))
+                hasher.update(str((values.dtype, values.shape)).encode())
+                hasher.update(values.tobytes())
+            elif isinstance(item, dict):
+                for k in sorted(item, key=str):
+                    hasher.update(repr(k).encode())
+                    add(item[k])
+            elif isinstance(item, (list, tuple)):
+                hasher.update(b'[')
+                for element in item:
+                    add(element)
+                hasher.update(b']')
+            else:
+                hasher.update(repr(item).encode())
+        for item in items:
+            add(item)
+        return hasher.hexdigest()
+
+    def _filename(self, key):
+        return os.path.join(self.cache_directory, f"{key}.pkl")
+
+    def get(self, key):
+        """Returns the fit results for `key` (a copy), or None if not in the cache."""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key].copy(deep=True)
+            if self.cache_directory is not None:
+                filename = self._filename(key)
+                if os.path.exists(filename):
+                    with open(filename, 'rb') as f:
+                        fit_results = pickle.load(f)
+                    os.utime(filename) #marks it as recently used
+                    self._add_to_memory(key, fit_results)
+                    return fit_results.copy(deep=True)
+        return None
+
+    def put(self, key, fit_results):
+        """Stores (a copy of) `fit_results` under `key`."""
+        fit_results = fit_results.copy(deep=True)
+        with self._lock:
+            self._add_to_memory(key, fit_results)
+            if self.cache_directory is not None:
+                with open(self._filename(key), 'wb') as f:
+                    pickle.dump(fit_results, f)
+                cached_files = sorted(glob.glob(os.path.join(self.cache_directory, "*.pkl")), key=os.path.getmtime)
+                for filename in cached_files[:max(0, len(cached_files)-self.max_disk_entries)]:
+                    os.remove(filename)
+
+    def _add_to_memory(self, key, fit_results):
+        self._entries[key] = fit_results
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        """Removes all entries from memory (files in `cache_directory` are kept)."""
+        with self._lock:
+            self._entries.clear()
+
+
 class DDM_Fit:
     """
     Set of functions to fit DDM matrix (image structure function) or ISF, the user can choose from a 
@@ -1348,6 +1962,7 @@ class DDM_Fit:
         self.data_yaml = data_yaml
         self.loadYAML()
         self.fittings = {} #Stores fit_model,parameters and data set, key-value provided by user
+        self.fit_cache = FitResultsCache() #Fit results from previous calls to fit with identical data and settings
         display_table = not silent
         self.use_parameters_provided(display_params_table = display_table)
         self.load_data()
@@ -1404,16 +2019,16 @@ class DDM_Fit:
         self.data_dir = self.content['DataDirectory']
         self.filename = self.content['FileName']
         #Get file name without .extension for saving data
-        self.filename_noext = self.filename[:-4]
+        self.filename_noext = readers.name_for_saving(self.filename, self.data_dir)
         if self.subimage_num != None:
-            self.filename_noext = f"{self.filename[:-4]}_{self.subimage_num:02}"
+            self.filename_noext = f"{self.filename_noext}_{self.subimage_num:02}"
         elif 'split_into_4_rois' in self.content['Analysis_parameters']:
             if self.content['Analysis_parameters']['split_into_4_rois']:
                 print("Images were split into 4 ROIs. However, ROI number (0 to 3) not specified.")
                 answer = int(input("If you want to specify ROI #, enter now. If not, enter -1: "))
                 if answer>-1:
                     self.subimage_num = answer
-                    self.filename_noext = f"{self.filename[:-4]}_{self.subimage_num:02}"
+                    self.filename_noext = f"{self.filename_noext}_{self.subimage_num:02}"
         return 1
 
     def reload_fit_model_by_name(self, model_name, update_params=True):
@@ -1555,6 +2170,123 @@ class DDM_Fit:
 
 
 
+    def quick_estimate(self, q_range=None):
+        r"""Estimates decay times and diffusion coefficient without fitting.
+        
+        Decay times are estimated at all wavevectors from the ISF in the 
+        ddm_dataset in two ways: from where the ISF crosses 1/e (see 
+        :py:func:`PyDDM.ddm_calc.estimate_tau_from_isf_crossing`) and from 
+        the integral of the ISF (see :py:func:`PyDDM.ddm_calc.estimate_tau_from_isf_integral`). 
+        The latter gives the mean decay time, comparable to `newt` of a fit 
+        with a stretching exponent. A diffusion coefficient is estimated from 
+        each assuming :math:`\tau = 1/(D q^2)`.
+
+        Parameters
+        ----------
+        q_range : list or None, optional
+            Lower and upper index of the wavevectors used to estimate the diffusion 
+            coefficient (upper index not included). If None (default), the 'Good_q_range' in the 'Fitting_parameters' 
+            is used if given. Otherwise, all wavevectors are used. 
+
+        Returns
+        -------
+        estimates : xarray Dataset
+            Has variables 'tau_crossing' and 'tau_integral' (dimension of 'q') and 
+            attributes 'diffusion_coeff_crossing' and 'diffusion_coeff_integral'. 
+
+        """
+        if q_range is None:
+            if 'Good_q_range' in self.content['Fitting_parameters']:
+                q_range = self.content['Fitting_parameters']['Good_q_range']
+
+        isf = self.ddm_dataset.ISF.values
+        lagtimes = self.ddm_dataset.lagtime.values
+        q = self.ddm_dataset.q.values
+        tau_crossing = ddm.estimate_tau_from_isf_crossing(isf, lagtimes)
+        tau_integral = ddm.estimate_tau_from_isf_integral(isf, lagtimes)
+
+        estimates = xr.Dataset(dict(tau_crossing=(['q'], tau_crossing),
+                                    tau_integral=(['q'], tau_integral)),
+                               coords={'q': q})
+        estimates.attrs['diffusion_coeff_crossing'] = ddm.estimate_diffusion_coeff_from_taus(q, tau_crossing, q_range)
+        estimates.attrs['diffusion_coeff_integral'] = ddm.estimate_diffusion_coeff_from_taus(q, tau_integral, q_range)
+        if q_range is not None:
+            estimates.attrs['q_range'] = list(q_range)
+
+        if not self.silent:
+            print("Diffusion coefficient estimated from 1/e crossing of ISF: %.4f μm^2/s" % estimates.attrs['diffusion_coeff_crossing'])
+            print("Diffusion coefficient estimated from integral of ISF: %.4f μm^2/s" % estimates.attrs['diffusion_coeff_integral'])
+
+        return estimates
+
+
+    def relaxation_time_distribution(self, q_range=None, tau_grid=None, number_of_taus=100,
+                                     regularization=None, regularization_method='gcv',
+                                     fit_baseline=True):
+        r"""Finds the distribution of relaxation times at each q from the ISF.
+
+        Rather than fitting a model, the ISF is written as a non-negative, smooth,
+        combination of exponential decays over a grid of decay times (similar to
+        CONTIN). See :py:func:`PyDDM.ddm_calc.relaxation_time_distribution`.
+
+        Parameters
+        ----------
+        q_range : list or None, optional
+            Lower and upper index of q to use (upper index not included). If None
+            (default), all q except q=0.
+        tau_grid : array or None, optional
+            Decay times of the distribution. If None (default), `number_of_taus` values
+            logarithmically spaced from half the shortest to twice the longest lag time.
+        number_of_taus : int, optional
+            Default is 100.
+        regularization : float or None, optional
+            Strength of the smoothing. If None (default), chosen at each q with
+            `regularization_method`.
+        regularization_method : {'gcv', 'lcurve'}, optional
+            Generalized cross validation (default) or the corner of the L-curve.
+        fit_baseline : bool, optional
+            If True (default), a constant baseline is fit along with the distribution.
+
+        Returns
+        -------
+        distributions : xarray Dataset
+            Has the variable 'distribution' (dimensions of 'q' and 'tau'), the mean
+            (logarithmic) decay time 'tau_mean', the 'regularization' and 'baseline' at each
+            q, and the ISF from the distribution, 'isf_fit', along with the 'isf_data'.
+
+        """
+        if q_range is None:
+            q_range = [1, len(self.ddm_dataset.q)]
+        q_indices = np.arange(q_range[0], q_range[1])
+
+        isf = self.ddm_dataset.ISF
+        start_time = time.time()
+        results = ddm.relaxation_time_distribution(isf.values, self.ddm_dataset.lagtime.values,
+                                                   tau_grid=tau_grid, number_of_taus=number_of_taus,
+                                                   regularization=regularization,
+                                                   regularization_method=regularization_method,
+                                                   fit_baseline=fit_baseline, q_indices=q_indices)
+        if results is None:
+            return None
+        distribution, tau_grid, regularization_used, baseline, isf_fit = results
+        if not self.silent:
+            print(f"Relaxation time distributions found for {len(q_indices)} q in {time.time()-start_time:.2f} s.")
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            tau_mean = np.exp(np.sum(distribution*np.log(tau_grid), axis=1) / np.sum(distribution, axis=1))
+        distributions = xr.Dataset(dict(distribution=(['q', 'tau'], distribution),
+                                        tau_mean=(['q'], tau_mean),
+                                        regularization=(['q'], regularization_used),
+                                        baseline=(['q'], baseline),
+                                        isf_fit=(['lagtime', 'q'], isf_fit),
+                                        isf_data=isf),
+                                   coords={'q': self.ddm_dataset.q, 'tau': tau_grid,
+                                           'lagtime': self.ddm_dataset.lagtime})
+        distributions.attrs['regularization_method'] = regularization_method if regularization is None else 'fixed'
+        distributions.attrs['q_range'] = list(q_range)
+        return distributions
+
+
     def fit(self, quiet=True, save=True, name_fit=None,
             use_lsqr_cf = [False,True],
             update_tau_based_on_estimated_diffcoeff = False,
@@ -1567,9 +2299,21 @@ class DDM_Fit:
             estimated_velocity2=None,
             update_limits_on_tau=False,
             updated_lims_on_tau_fraction=0.1,
+            use_estimated_tau_as_guess=False,
+            tau_estimate_method='crossing',
             use_A_from_images_as_guess=False,
             update_limits_on_A=False,
             updated_lims_on_A_fraction=0.1,
+            last_times=None,
+            fit_q_band=None,
+            fill_outside_q_band=None,
+            min_amplitude_over_background=1.0,
+            number_of_starts=1,
+            number_of_starts_to_refine=None,
+            number_of_workers=1,
+            random_seed=None,
+            coarse_to_fine=False,
+            use_cache=True,
             debug=False,
             display_table=True):
 
@@ -1580,7 +2324,7 @@ class DDM_Fit:
         :type save: bool
         :param name_fit: Name to save the fit results under in the fittings dictionary
         :type name_fit: None or str
-        :param use_lsqr_cf: ???
+        :param use_lsqr_cf: Whether to use `scipy.optimize.least_squares` (first) and then `scipy.optimize.curve_fit` (second). With curve_fit, data are weighted by the standard error of the DDM matrix ('ddm_matrix_stderr' in the ddm_dataset) if available, otherwise by 1/sqrt(num_pairs_per_dt)
         :type use_lsqr_cf: List[bool]
         :param update_tau_based_on_estimated_diffcoeff: Use an estimation of diffusion coeffcient to set initial value of tau (delay time) for fitting procedure
         :type update_tau_based_on_estimated_diffcoeff: bool
@@ -1602,16 +2346,50 @@ class DDM_Fit:
         :type update_limits_on_tau: bool
         :param updated_lims_on_tau_fraction: Limits are set by adding and subtracting the given fraction of the estimated initial tau value, default is 0.1
         :type updated_lims_on_tau_fraction: float
+        :param use_estimated_tau_as_guess: If True, the initial guess for tau at each q is estimated from the ISF without fitting (see :py:meth:`quick_estimate`). Takes precedence over the estimated diffusion coefficient or velocity
+        :type use_estimated_tau_as_guess: bool
+        :param tau_estimate_method: Either 'crossing' (where the ISF crosses 1/e) or 'integral' (integral of the ISF, converted to tau using the initial guess of the stretching exponent), default is 'crossing'
+        :type tau_estimate_method: str
         :param use_A_from_images_as_guess: If True the amplitude value, determined from the direct Fourier transform of the frames/images, is used as initial guess
         :type use_A_from_images_as_guess: bool
         :param update_limits_on_A: Set bounds on the amplitude based on the given estimation
         :type update_limits_on_A: bool
         :param updated_lims_on_A_fraction: Fraction that determines to what extend the amplitude is bounded during the fitting procedure, default is 0.1
         :type updated_lims_on_A_fraction: float
+        :param last_times: Number of lag times to fit. Either a single integer, an array with one integer per q, or 'auto' in which case it is determined for each q from where the ISF reaches a plateau (see :py:func:`PyDDM.ddm_calc.find_last_times_from_isf_plateau`). Default is None (all lag times are fit)
+        :type last_times: None, int, array, or str
+        :param fit_q_band: Only fit wavevectors in this band. Either 'auto', in which case the band is found from the amplitude-to-background ratio and estimated decay times (see :py:func:`PyDDM.ddm_calc.find_informative_q_range`), or a list of the lower and upper index of q (upper index not included, as with 'Good_q_range'). If None (default), uses 'Fit_q_band' in the 'Fitting_parameters' if present, otherwise all wavevectors are fit
+        :type fit_q_band: None, str, or List[int]
+        :param fill_outside_q_band: Either 'nan' (parameters outside of the band are NaN) or 'estimate' (tau estimated from the ISF, amplitude and background from the dataset, other parameters set to their initial guess). If None (default), uses 'Fill_outside_q_band' in the 'Fitting_parameters' if present, otherwise 'nan'
+        :type fill_outside_q_band: None or str
+        :param min_amplitude_over_background: Used when `fit_q_band` is 'auto'. Minimum ratio of amplitude to background for a wavevector to be fit, default is 1
+        :type min_amplitude_over_background: float
+        :param number_of_starts: If greater than 1, each q is fit from the initial guess and from number_of_starts-1 other initial guesses spread over the bounds (Latin hypercube sampling); the best fit is kept. The costs of the fits from each start are stored in the fit results. Default is 1
+        :type number_of_starts: int
+        :param number_of_starts_to_refine: The cost at each of the initial guesses is evaluated for all starts at once. If given, only this many of the initial guesses with the lowest cost are then fit. Default is None (all are fit)
+        :type number_of_starts_to_refine: None or int
+        :param number_of_workers: Number of threads used to fit the q values in parallel, default is 1
+        :type number_of_workers: int
+        :param random_seed: Seed for generating the initial guesses when number_of_starts is greater than 1
+        :type random_seed: None or int
+        :param coarse_to_fine: If True, each q is first fit using a logarithmically spaced subset of the lag times and that result is the initial guess for fitting all lag times. Speeds up fits to data with many lag times. Default is False
+        :type coarse_to_fine: bool
+        :param use_cache: If True (default) and a fit with identical data, model, parameters and options was done before, the stored results are returned (see `fit_cache` attribute and :py:class:`FitResultsCache`). Not used when number_of_starts is greater than 1 with no random_seed
+        :type use_cache: bool
         :param display_table: Print table with fitted values
         :type display_table: bool
 
         """
+        #Options that determine the result of the fit (used to look up the fit in the cache)
+        fit_options = {key: value for key, value in locals().items()
+                       if key not in ('self', 'quiet', 'save', 'name_fit', 'debug', 'display_table',
+                                      'use_cache', 'number_of_workers')}
+        cache_key = None
+        if use_cache and (self.fit_cache is not None) and not ((number_of_starts > 1) and (random_seed is None)):
+            cache_key = self._fit_cache_key('fit', fit_options)
+            cached_fit = self.fit_cache.get(cache_key)
+            if cached_fit is not None:
+                return self._use_cached_fit(cached_fit, save, name_fit, display_table)
         
         #get the radially averaged ddm matrix data 
         # note that an older version called this 'ravs'
@@ -1631,58 +2409,72 @@ class DDM_Fit:
             data_to_fit = ddm_matrix_data
 
         if use_lsqr_cf[1]:
-            sigma = 1./np.sqrt(self.ddm_dataset.num_pairs_per_dt)
+            sigma = self._measured_sigma(self.model_dict['data_to_use'])
+            if sigma is None:
+                sigma = 1./np.sqrt(self.ddm_dataset.num_pairs_per_dt)
         else:
             sigma = None
 
-        best_fits, theories = ddm.fit_ddm_all_qs(data_to_fit, self.ddm_dataset.lagtime,
-                                                 copy.deepcopy(self.model_dict),
-                                                 self.ddm_dataset.Amplitude.values,
-                                                 quiet=quiet,
-                                                 first_use_leastsq = use_lsqr_cf[0],
-                                                 use_curvefit_method = use_lsqr_cf[1],
-                                                 sigma = sigma,
-                                                 update_tau_based_on_estimated_diffcoeff = update_tau_based_on_estimated_diffcoeff,
-                                                 estimated_diffcoeff = estimated_diffcoeff,
-                                                 update_tau_based_on_estimated_velocity=update_tau_based_on_estimated_velocity,
-                                                 estimated_velocity=estimated_velocity,
-                                                 update_tau2_based_on_estimated_diffcoeff=update_tau2_based_on_estimated_diffcoeff,
-                                                 estimated_diffcoeff2=estimated_diffcoeff2,
-                                                 update_tau2_based_on_estimated_velocity=update_tau2_based_on_estimated_velocity,
-                                                 estimated_velocity2=estimated_velocity2,
-                                                 update_limits_on_tau=update_limits_on_tau,
-                                                 updated_lims_on_tau_fraction=updated_lims_on_tau_fraction,
-                                                 use_A_from_images_as_guess=use_A_from_images_as_guess,
-                                                 update_limits_on_A=update_limits_on_A,
-                                                 updated_lims_on_A_fraction=updated_lims_on_A_fraction,
-                                                 debug=debug)
-
-        bestfit_dataarray = xr.DataArray(data = [*best_fits.values()],
-                                                 dims = ["parameter", "q"],
-                                                 coords = [[*best_fits], self.ddm_dataset.q],
-                                                 name = 'FitParameters')
-
-        theory_dataarray = xr.DataArray(data = theories,
-                                        dims = ["lagtime", "q"],
-                                        coords = [self.ddm_dataset.lagtime, self.ddm_dataset.q],
-                                        name = 'Theory')
+        #The model dictionary is compiled into arrays of initial guesses and bounds
+        #(one row per q). The fitting works on this and leaves self.model_dict untouched.
+        model_spec = fpd.ModelSpec(self.model_dict, len(self.ddm_dataset.q))
 
-        fit_results = xr.Dataset(dict(parameters=bestfit_dataarray, theory=theory_dataarray,
-                                      isf_data=self.ddm_dataset.ISF,
-                                      ddm_matrix_data=ddm_matrix_data,
-                                      A=self.ddm_dataset.Amplitude,
-                                      B=self.ddm_dataset.B))
-        fit_results.attrs['model'] = self.fit_model
-        fit_results.attrs['data_to_use'] = self.model_dict['data_to_use']
-        
-        #saving the initial parameters. but can't save xarray DataSet in netcdf format if
-        #  we have a list of dictionaries as attribute. So, we convert the dictionary
-        #  to a sring. 
-        init_params = copy.deepcopy(self.model_dict['parameter_info'])
-        init_params_as_string = []
-        for thing in init_params:
-            init_params_as_string.append(str(thing))
-        fit_results.attrs['initial_params_dict'] = init_params_as_string 
+        if isinstance(last_times, str):
+            if last_times == 'auto':
+                last_times = ddm.find_last_times_from_isf_plateau(self.ddm_dataset.ISF.values,
+                                                                  self.ddm_dataset.lagtime.values)
+            else:
+                print("The 'last_times' parameter must be None, an integer, an array, or 'auto'. Fitting all lag times.")
+                last_times = None
+
+        q_band, q_indices_to_fit, fill_unfit_qs = self._q_band_to_fit(model_spec, fit_q_band, fill_outside_q_band,
+                                                                      min_amplitude_over_background)
+
+        estimated_taus = None
+        if use_estimated_tau_as_guess:
+            estimated_taus = self._estimated_taus_for_guess(model_spec, tau_estimate_method)
+
+        best_fits, theories, fit_info = ddm.fit_ddm_all_qs(data_to_fit, self.ddm_dataset.lagtime,
+                                                           model_spec,
+                                                           self.ddm_dataset.Amplitude.values,
+                                                           quiet=quiet,
+                                                           first_use_leastsq = use_lsqr_cf[0],
+                                                           use_curvefit_method = use_lsqr_cf[1],
+                                                           sigma = sigma,
+                                                           update_tau_based_on_estimated_diffcoeff = update_tau_based_on_estimated_diffcoeff,
+                                                           estimated_diffcoeff = estimated_diffcoeff,
+                                                           update_tau_based_on_estimated_velocity=update_tau_based_on_estimated_velocity,
+                                                           estimated_velocity=estimated_velocity,
+                                                           update_tau2_based_on_estimated_diffcoeff=update_tau2_based_on_estimated_diffcoeff,
+                                                           estimated_diffcoeff2=estimated_diffcoeff2,
+                                                           update_tau2_based_on_estimated_velocity=update_tau2_based_on_estimated_velocity,
+                                                           estimated_velocity2=estimated_velocity2,
+                                                           update_limits_on_tau=update_limits_on_tau,
+                                                           updated_lims_on_tau_fraction=updated_lims_on_tau_fraction,
+                                                           estimated_taus=estimated_taus,
+                                                           use_A_from_images_as_guess=use_A_from_images_as_guess,
+                                                           update_limits_on_A=update_limits_on_A,
+                                                           updated_lims_on_A_fraction=updated_lims_on_A_fraction,
+                                                           last_times=last_times,
+                                                           q_indices=q_indices_to_fit,
+                                                           fill_unfit_qs=fill_unfit_qs,
+                                                           number_of_starts=number_of_starts,
+                                                           number_of_starts_to_refine=number_of_starts_to_refine,
+                                                           random_seed=random_seed,
+                                                           number_of_workers=number_of_workers,
+                                                           coarse_to_fine=coarse_to_fine,
+                                                           return_fit_info=True,
+                                                           debug=debug)
+
+        fit_results = self._create_fit_results(best_fits, theories, ddm_matrix_data, last_times=last_times)
+        if q_band is not None:
+            fit_results.attrs['fitted_q_range'] = q_band
+        if number_of_starts > 1:
+            fit_results['multistart_costs'] = xr.DataArray(fit_info['multistart_costs'], dims=['q', 'start'],
+                                                           coords={'q': self.ddm_dataset.q, 'start': np.arange(number_of_starts)})
+            fit_results['multistart_best_start'] = xr.DataArray(fit_info['best_start'], dims=['q'], coords=[self.ddm_dataset.q])
+            fit_results['multistart_number_near_best'] = xr.DataArray(fit_info['number_near_best'], dims=['q'], coords=[self.ddm_dataset.q])
+            fit_results.attrs['number_of_starts'] = number_of_starts
 
         if 'Good_q_range' in self.content['Fitting_parameters']:
             force_q_range = self.content['Fitting_parameters']['Good_q_range']
@@ -1695,6 +2487,12 @@ class DDM_Fit:
                 update_good_q_range = False
         else:
             update_good_q_range = True
+        if q_band is not None:
+            #Only the q values within the band were fit, so restrict the power law fitting to these
+            if force_q_range is None:
+                force_q_range = q_band
+            else:
+                force_q_range = [max(force_q_range[0], q_band[0]), min(force_q_range[1], q_band[1])]
 
         qrange, slope, d_eff, msd_alpha, msd_d_eff, d, d_std, v, v_std = get_tau_vs_q_fit(fit_results, forced_qs=force_q_range, 
                                                                                           update_good_q_range=update_good_q_range,
@@ -1732,6 +2530,94 @@ class DDM_Fit:
             pd = hf.generate_pandas_table_fit_results(fit_results)
             display(pd)
             
+        self._add_metadata_to_fit_results(fit_results)
+        if cache_key is not None:
+            self.fit_cache.put(cache_key, fit_results)
+
+        return fit_results
+
+
+    def _measured_sigma(self, data_to_use):
+        #Standard error of the DDM matrix (or ISF) at each lag time and q, if it
+        #  is in the ddm_dataset (see ddm_calc.computeDDMMatrix). Otherwise, None.
+        if 'ddm_matrix_stderr' not in self.ddm_dataset.data_vars:
+            return None
+        stderr = self.ddm_dataset.ddm_matrix_stderr.values.copy()
+        if data_to_use == 'ISF':
+            amplitude = np.broadcast_to(self.ddm_dataset.Amplitude.values, stderr.shape[1:])
+            stderr = stderr / np.abs(amplitude)[np.newaxis,:]
+        #Lag times with one pair of images have no estimate. Use the largest at that q.
+        invalid = ~np.isfinite(stderr) | (stderr <= 0)
+        stderr[invalid] = np.nan
+        all_invalid = np.all(invalid, axis=0)
+        largest = np.nanmax(np.where(all_invalid[np.newaxis,:], 1., stderr), axis=0)
+        largest[all_invalid] = 1.
+        return np.where(invalid, largest[np.newaxis,:], stderr)
+
+
+    def _fit_cache_key(self, kind, fit_options):
+        #Hash of the data, model, parameters and options for a fit
+        data_vars = [var for var in ('ravs', 'ddm_matrix', 'ISF', 'Amplitude', 'B', 'num_pairs_per_dt', 'ddm_matrix_stderr') 
+                     if var in self.ddm_dataset.data_vars]
+        model_spec = fpd.ModelSpec(self.model_dict)
+        return self.fit_cache.make_key(kind, self.fit_model, self.model_dict['data_to_use'],
+                                       [self.ddm_dataset[var] for var in data_vars],
+                                       self.ddm_dataset.lagtime, self.ddm_dataset.q,
+                                       model_spec.names, model_spec.guesses, model_spec.lower, 
+                                       model_spec.upper, model_spec.fixed,
+                                       self.content.get('Fitting_parameters', {}), fit_options)
+
+
+    def _use_cached_fit(self, fit_results, save, name_fit, display_table):
+        if not self.silent:
+            print("Using fit results from cache (same data, model, and options as a previous fit).")
+        if save:
+            name = self._save_fit(fit_results, name_fit = name_fit)
+            if not self.silent:
+                print(f"Fit is saved in fittings dictionary with key '{name}'.")
+        if display_table:
+            pd = hf.generate_pandas_table_fit_results(fit_results)
+            display(pd)
+        return fit_results
+
+
+    def _create_fit_results(self, best_fits, theories, ddm_matrix_data, last_times=None):
+        #Puts the best fit parameters and theory into an xarray Dataset along with the data
+        bestfit_dataarray = xr.DataArray(data = [*best_fits.values()],
+                                                 dims = ["parameter", "q"],
+                                                 coords = [[*best_fits], self.ddm_dataset.q],
+                                                 name = 'FitParameters')
+
+        theory_dataarray = xr.DataArray(data = theories,
+                                        dims = ["lagtime", "q"],
+                                        coords = [self.ddm_dataset.lagtime, self.ddm_dataset.q],
+                                        name = 'Theory')
+
+        fit_results = xr.Dataset(dict(parameters=bestfit_dataarray, theory=theory_dataarray,
+                                      isf_data=self.ddm_dataset.ISF,
+                                      ddm_matrix_data=ddm_matrix_data,
+                                      A=self.ddm_dataset.Amplitude,
+                                      B=self.ddm_dataset.B))
+        if last_times is not None:
+            #Number of lag times that were fit for each q. The theory is NaN beyond these.
+            fit_results['last_times'] = xr.DataArray(np.broadcast_to(np.asarray(last_times, dtype=int), 
+                                                                     (len(self.ddm_dataset.q),)).copy(),
+                                                     dims=['q'], coords=[self.ddm_dataset.q])
+        fit_results.attrs['model'] = self.fit_model
+        fit_results.attrs['data_to_use'] = self.model_dict['data_to_use']
+        
+        #saving the initial parameters. but can't save xarray DataSet in netcdf format if
+        #  we have a list of dictionaries as attribute. So, we convert the dictionary
+        #  to a sring. 
+        init_params = copy.deepcopy(self.model_dict['parameter_info'])
+        init_params_as_string = []
+        for thing in init_params:
+            init_params_as_string.append(str(thing))
+        fit_results.attrs['initial_params_dict'] = init_params_as_string 
+        return fit_results
+
+
+    def _add_metadata_to_fit_results(self, fit_results):
         #Placing other metadata in the fit_results Dataset
         fit_results.attrs['DataDirectory'] = self.ddm_dataset.DataDirectory
         fit_results.attrs['FileName'] = self.ddm_dataset.FileName
@@ -1742,9 +2628,666 @@ class DDM_Fit:
         if "OverlapMethod" in self.ddm_dataset.attrs:
             fit_results.attrs['OverlapMethod'] = self.ddm_dataset.OverlapMethod
 
+
+    def fit_global(self, tied_parameters={'Tau':'diffusive'}, q_range=None, 
+                   use_sigma=True, last_times=None, global_initial_guesses=None,
+                   use_estimated_tau_as_guess=True, save=True, name_fit=None, 
+                   use_cache=True, debug=False, display_table=True):
+        r"""Fits the DDM data at all q at once, with some parameters shared across q.
+        
+        Selected parameters are tied across wavevectors. For example, with the 
+        default `tied_parameters` the decay time is constrained to be :math:`\tau(q) = 1/(D q^2)` 
+        and a single diffusion coefficient, :math:`D`, is fit along with the other 
+        parameters (e.g., amplitude and background) at each q. See 
+        :py:func:`PyDDM.ddm_calc.fit_ddm_global`. 
+
+        Parameters
+        ----------
+        tied_parameters : dict, optional
+            Keys are names of parameters. Values are either 'shared' or, for decay 
+            times, one of 'diffusive', 'ballistic', or 'power_law'. The default is 
+            {'Tau':'diffusive'}. Another example: {'Tau':'power_law', 'StretchingExp':'shared'}. 
+        q_range : list or None, optional
+            Lower and upper index of q to fit (upper index not included). If None 
+            (default), uses 'Good_q_range' or, failing that, 'Fit_q_band' of the 
+            'Fitting_parameters' if given. Otherwise, the range of q is found from the 
+            amplitude-to-background ratio and estimated decay times (see 
+            :py:func:`PyDDM.ddm_calc.find_informative_q_range`). 
+        use_sigma : bool, optional
+            If True (default), residuals are divided by the standard error of the data 
+            ('ddm_matrix_stderr' in the ddm_dataset). If that is not available, they are 
+            weighted by :math:`1/\sqrt{N}` where N is the number of image pairs for each 
+            lag time and, when fitting the DDM matrix, also divided by the DDM matrix 
+            (so that all q contribute). 
+        last_times : None, int, array, or str, optional
+            As for :py:meth:`fit`. Default is None. 
+        global_initial_guesses : dict or None, optional
+            Initial guesses for the global parameters, e.g. {'DiffusionCoeff': 0.5}. 
+        use_estimated_tau_as_guess : bool, optional
+            If True (default), the initial guesses for global parameters of the decay 
+            times are based on decay times estimated from the ISF. 
+        save : bool, optional
+            Save the fit in the `fittings` dictionary. Default is True. 
+        name_fit : str or None, optional
+            Name to save the fit results under in the `fittings` dictionary
+        use_cache : bool, optional
+            If True (default), returns stored results of an identical previous fit. 
+        debug : bool, optional
+            Default is False.
+        display_table : bool, optional
+            Display table of fitted values. Default is True. 
+
+        Returns
+        -------
+        fit_results : xarray Dataset
+            Results of the fit. The global parameters and their standard deviations are 
+            stored as attributes (e.g., 'DiffusionCoeff' and 'DiffusionCoeff_std'). 
+
+        """
+        fit_options = {key: value for key, value in locals().items()
+                       if key not in ('self', 'save', 'name_fit', 'debug', 'display_table', 'use_cache')}
+        cache_key = None
+        if use_cache and (self.fit_cache is not None):
+            cache_key = self._fit_cache_key('fit_global', fit_options)
+            cached_fit = self.fit_cache.get(cache_key)
+            if cached_fit is not None:
+                return self._use_cached_fit(cached_fit, save, name_fit, display_table)
+        if 'ravs' in self.ddm_dataset.data_vars:
+            ddm_matrix_data = self.ddm_dataset.ravs
+        else:
+            ddm_matrix_data = self.ddm_dataset.ddm_matrix
+
+        if self.model_dict['data_to_use'] == 'ISF':
+            data_to_fit = self.ddm_dataset.ISF
+        elif self.model_dict['data_to_use'] == 'DDM Matrix':
+            data_to_fit = ddm_matrix_data
+
+        if q_range is None:
+            q_range = self.content['Fitting_parameters'].get('Good_q_range', None)
+        if q_range is None:
+            q_range = self.content['Fitting_parameters'].get('Fit_q_band', None)
+        if (q_range is None) or isinstance(q_range, str):
+            #Wavevectors where the ISF does not decay, or with little signal, would bias the global parameters
+            estimated_taus = ddm.estimate_tau_from_isf_crossing(self.ddm_dataset.ISF.values,
+                                                                self.ddm_dataset.lagtime.values)
+            q_range = ddm.find_informative_q_range(self.ddm_dataset.Amplitude.values, self.ddm_dataset.B.values,
+                                                   estimated_taus)
+            if q_range is None:
+                print("Could not find a range of q to fit. Fitting all q.")
+            elif not self.silent:
+                print("Fitting q indices from %i to %i." % (q_range[0], q_range[1]-1))
+        if q_range is None:
+            q_indices = np.arange(1, len(self.ddm_dataset.q))
+        else:
+            q_indices = np.arange(max(q_range[0], 1), min(q_range[1], len(self.ddm_dataset.q)))
+
+        if use_sigma:
+            sigma = self._measured_sigma(self.model_dict['data_to_use'])
+            if sigma is None:
+                sigma = 1./np.sqrt(self.ddm_dataset.num_pairs_per_dt.values)[:,np.newaxis]
+                if self.model_dict['data_to_use'] == 'DDM Matrix':
+                    sigma = sigma * np.abs(data_to_fit.values)
+        else:
+            sigma = None
+
+        if isinstance(last_times, str) and (last_times == 'auto'):
+            last_times = ddm.find_last_times_from_isf_plateau(self.ddm_dataset.ISF.values,
+                                                              self.ddm_dataset.lagtime.values)
+
+        model_spec = fpd.ModelSpec(self.model_dict, len(self.ddm_dataset.q))
+        if use_estimated_tau_as_guess:
+            model_spec.set_guesses_per_q('Tau', self._estimated_taus_for_guess(model_spec, 'crossing'),
+                                         update_limits=False)
+
+        best_fits, theories, global_params, global_params_std = ddm.fit_ddm_global(data_to_fit, self.ddm_dataset.lagtime.values,
+                                                                                    model_spec, tied_parameters,
+                                                                                    q_indices=q_indices, sigma=sigma,
+                                                                                    last_times=last_times,
+                                                                                    global_initial_guesses=global_initial_guesses,
+                                                                                    debug=debug)
+
+        fit_results = self._create_fit_results(best_fits, theories, ddm_matrix_data, last_times=last_times)
+        fit_results.attrs['fitted_q_range'] = [int(q_indices[0]), int(q_indices[-1])+1]
+        fit_results.attrs['tied_parameters'] = [f"{param_name}: {tie}" for param_name,tie in tied_parameters.items()]
+        for name in global_params:
+            fit_results.attrs[name] = global_params[name]
+            fit_results.attrs[name+'_std'] = global_params_std[name]
+            if not self.silent:
+                print("%s = %.5g +/- %.2g" % (name, global_params[name], global_params_std[name]))
+        #So that this fit can be used where the results of the usual fit are expected
+        if 'DiffusionCoeff' in global_params:
+            fit_results.attrs['diffusion_coeff'] = global_params['DiffusionCoeff']
+            fit_results.attrs['diffusion_coeff_std'] = global_params_std['DiffusionCoeff']
+        if 'Velocity' in global_params:
+            fit_results.attrs['velocity'] = global_params['Velocity']
+            fit_results.attrs['velocity_std'] = global_params_std['Velocity']
+        fit_results.attrs['good_q_range'] = fit_results.attrs['fitted_q_range']
+
+        if save:
+            name = self._save_fit(fit_results, name_fit = name_fit)
+            if not self.silent:
+                print(f"Fit is saved in fittings dictionary with key '{name}'.")
+
+        if display_table:
+            pd = hf.generate_pandas_table_fit_results(fit_results)
+            display(pd)
+
+        self._add_metadata_to_fit_results(fit_results)
+        if cache_key is not None:
+            self.fit_cache.put(cache_key, fit_results)
+
         return fit_results
 
 
+    def fit_directional(self, q_range=None, number_of_angles=12, use_sigma=True,
+                        initial_guesses=None, fit_diffusion=True, debug=False):
+        r"""Fits the full (not radially averaged) DDM matrix with a drift velocity vector.
+
+        For directed motion, the decay time depends on :math:`\vec{q} \cdot \vec{v}` rather
+        than on :math:`|\vec{q}|`. The full DDM matrix ('ddm_matrix_full' in the ddm_dataset)
+        is averaged over bins of wavevector magnitude and direction (see
+        :py:func:`PyDDM.ddm_calc.polar_bin_ddm_matrix`) and one diffusion coefficient and
+        one velocity vector are fit to all bins (see :py:func:`PyDDM.ddm_calc.fit_ddm_directional`).
+        Note that the sign of the velocity cannot be determined from the DDM matrix.
+
+        Parameters
+        ----------
+        q_range : list or None, optional
+            Lower and upper index of q (of the radially averaged data) to use, upper index
+            not included. If None (default), uses 'Good_q_range' of the 'Fitting_parameters'
+            if given. Otherwise, all q except q=0.
+        number_of_angles : int, optional
+            Number of bins of the direction of the wavevector. Default is 12.
+        use_sigma : bool, optional
+            If True (default), residuals are weighted by :math:`1/\sqrt{N}` where N is the
+            number of image pairs for each lag time.
+        initial_guesses : dict or None, optional
+            Initial guesses, with keys from 'DiffusionCoeff', 'Velocity_x' and 'Velocity_y'.
+        fit_diffusion : bool, optional
+            If False, the diffusion coefficient is fixed to its initial guess (default of 0). Default is True.
+        debug : bool, optional
+            Default is False.
+
+        Returns
+        -------
+        fit_results : xarray Dataset
+            Has the binned DDM matrix, 'ddm_matrix_data', and the 'theory' (dimensions of
+            lagtime, q and angle), the amplitude 'A' and background 'B' of each bin, and the
+            bin centers 'q_x_bin' and 'q_y_bin'. The diffusion coefficient and velocity
+            (and their standard deviations) are attributes.
+
+        """
+        if 'ddm_matrix_full' not in self.ddm_dataset.data_vars:
+            print("The ddm_dataset does not have the full DDM matrix ('ddm_matrix_full').")
+            return None
+        if q_range is None:
+            q_range = self.content['Fitting_parameters'].get('Good_q_range', None)
+        if q_range is None:
+            q_range = [1, len(self.ddm_dataset.q)]
+        q = self.ddm_dataset.q.values
+        q_indices = np.arange(max(q_range[0], 1), min(q_range[1], len(q)))
+        #Bins of wavevector magnitude centered on the q of the radially averaged data
+        midpoints = (q[1:] + q[:-1]) / 2
+        all_edges = np.concatenate([[q[0] - (q[1]-q[0])/2], midpoints, [q[-1] + (q[-1]-q[-2])/2]])
+        q_edges = all_edges[q_indices[0]:q_indices[-1]+2]
+
+        lagtimes = self.ddm_dataset.lagtime.values
+        binned, qx_bins, qy_bins, counts = ddm.polar_bin_ddm_matrix(self.ddm_dataset.ddm_matrix_full.values,
+                                                                    self.ddm_dataset.q_x.values,
+                                                                    self.ddm_dataset.q_y.values,
+                                                                    q_edges, number_of_angles=number_of_angles)
+        sigma = 1./np.sqrt(self.ddm_dataset.num_pairs_per_dt.values) if use_sigma else None
+        shape = binned.shape
+        global_params, global_params_std, amplitude, background, theory = ddm.fit_ddm_directional(binned.reshape(shape[0], -1),
+                                                                                                 lagtimes, qx_bins.ravel(), qy_bins.ravel(),
+                                                                                                 sigma=sigma, initial_guesses=initial_guesses,
+                                                                                                 fit_diffusion=fit_diffusion, debug=debug)
+
+        coords = {'lagtime': lagtimes, 'q': q[q_indices],
+                  'angle': (np.arange(number_of_angles) + 0.5) * np.pi / number_of_angles}
+        fit_results = xr.Dataset(dict(ddm_matrix_data=(['lagtime', 'q', 'angle'], binned),
+                                      theory=(['lagtime', 'q', 'angle'], theory.reshape(shape)),
+                                      A=(['q', 'angle'], amplitude.reshape(shape[1:])),
+                                      B=(['q', 'angle'], background.reshape(shape[1:])),
+                                      q_x_bin=(['q', 'angle'], qx_bins),
+                                      q_y_bin=(['q', 'angle'], qy_bins),
+                                      number_of_wavevectors=(['q', 'angle'], counts)),
+                                 coords=coords)
+        fit_results.attrs['model'] = 'DDM Matrix - Diffusion and Drift (2D)'
+        fit_results.attrs['fitted_q_range'] = [int(q_indices[0]), int(q_indices[-1])+1]
+        for name in global_params:
+            fit_results.attrs[name] = global_params[name]
+            fit_results.attrs[name+'_std'] = global_params_std[name]
+        speed = np.hypot(global_params['Velocity_x'], global_params['Velocity_y'])
+        fit_results.attrs['diffusion_coeff'] = global_params['DiffusionCoeff']
+        fit_results.attrs['diffusion_coeff_std'] = global_params_std['DiffusionCoeff']
+        fit_results.attrs['velocity'] = speed
+        fit_results.attrs['velocity_direction'] = np.degrees(np.arctan2(global_params['Velocity_y'], global_params['Velocity_x']))
+        fit_results.attrs['velocity_sign_note'] = "The DDM matrix is unchanged by v -> -v; the direction is only known modulo 180 degrees."
+        if not self.silent:
+            print("D = %.5g +/- %.2g" % (global_params['DiffusionCoeff'], global_params_std['DiffusionCoeff']))
+            print("v = (%.5g +/- %.2g, %.5g +/- %.2g)" % (global_params['Velocity_x'], global_params_std['Velocity_x'],
+                                                         global_params['Velocity_y'], global_params_std['Velocity_y']))
+            print("Speed %.5g along %.1f degrees (or %.1f degrees; the sign of v is not determined)." % (speed,
+                  fit_results.attrs['velocity_direction'], fit_results.attrs['velocity_direction']-180))
+        self._add_metadata_to_fit_results(fit_results)
+        return fit_results
+
+
+    def fit_series(self, series, window_dim='window', warm_start=True, use_lsqr_cf=[True,False],
+                   last_times=None, q_range=None, number_of_workers=1, quiet=True):
+        r"""Fits a series of DDM matrices, e.g. computed for consecutive time windows.
+
+        Uses the current model and parameters. With `warm_start`, each window is fit
+        starting from the best fit values of the previous window (see
+        :py:func:`PyDDM.ddm_calc.fit_ddm_series`).
+
+        Parameters
+        ----------
+        series : xarray Dataset or list
+            Dataset with the DDM matrix ('ddm_matrix' or 'ravs') with dimensions of
+            `window_dim`, 'lagtime' and 'q' (e.g., from :py:meth:`DDM_Analysis.variationInDDMMatrix`
+            with `window_dim` of 'time'). A list of ddm_datasets is stacked along `window_dim`.
+            The values of the 'lagtime' coordinate are used as the lag times. If fitting
+            the ISF and the series has no 'ISF', it is found from the DDM matrix using the
+            'Amplitude' and 'B' of the series or, if not there, of the ddm_dataset.
+        window_dim : str, optional
+            Name of the dimension of the windows. Default is 'window'.
+        warm_start : bool, optional
+            Default is True.
+        use_lsqr_cf : list, optional
+            Whether to use `scipy.optimize.least_squares` and `scipy.optimize.curve_fit`.
+            Default is [True, False].
+        last_times : int, array or None, optional
+            Number of lag times to fit. Default is None (all).
+        q_range : list or None, optional
+            Lower and upper index of q to fit (upper index not included). Default is None (all).
+        number_of_workers : int, optional
+            Number of windows fit at once if `warm_start` is False. Default is 1.
+        quiet : bool, optional
+            Default is True.
+
+        Returns
+        -------
+        series_fit : xarray Dataset
+            Has the best fit 'parameters' (dimensions of window, parameter and q) and
+            'theory' (window, lagtime and q). If the model has 'Tau', also the diffusion
+            coefficient of each window (from 'Tau' over 'Good_q_range', if given, with 
+            the upper index not included).
+
+        """
+        if isinstance(series, (list, tuple)):
+            series = xr.concat(series, dim=window_dim)
+        ddm_matrix_name = 'ravs' if 'ravs' in series.data_vars else 'ddm_matrix'
+        if self.model_dict['data_to_use'] == 'ISF':
+            if 'ISF' in series.data_vars:
+                data_to_fit = series.ISF
+            else:
+                amplitude = series.Amplitude if 'Amplitude' in series.data_vars else self.ddm_dataset.Amplitude
+                background = series.B if 'B' in series.data_vars else self.ddm_dataset.B
+                data_to_fit = 1 - (series[ddm_matrix_name] - background) / amplitude
+        else:
+            data_to_fit = series[ddm_matrix_name]
+        data_to_fit = data_to_fit.transpose(window_dim, 'lagtime', 'q')
+
+        if use_lsqr_cf[1] and ('num_pairs_per_dt' in series.data_vars) and (series.num_pairs_per_dt.ndim == 1):
+            sigma = 1./np.sqrt(series.num_pairs_per_dt.values)
+        else:
+            sigma = None
+        q_indices = None
+        if q_range is not None:
+            q_indices = np.arange(q_range[0], min(q_range[1], len(series.q)))
+
+        start_time = time.time()
+        parameters, theory, names = ddm.fit_ddm_series(data_to_fit, series.lagtime.values, self.model_dict,
+                                                       warm_start=warm_start, sigma=sigma, last_times=last_times,
+                                                       q_indices=q_indices, first_use_leastsq=use_lsqr_cf[0],
+                                                       use_curvefit_method=use_lsqr_cf[1],
+                                                       number_of_workers=number_of_workers, quiet=quiet)
+        if not self.silent:
+            print(f"Fit {data_to_fit.shape[0]} windows in {time.time()-start_time:.1f} s.")
+
+        windows = data_to_fit[window_dim].values
+        series_fit = xr.Dataset(dict(parameters=([window_dim, 'parameter', 'q'], parameters),
+                                     theory=([window_dim, 'lagtime', 'q'], theory),
+                                     data=data_to_fit),
+                                coords={window_dim: windows, 'parameter': names,
+                                        'lagtime': series.lagtime.values, 'q': series.q.values})
+        if 'Tau' in names:
+            good_q_range = self.content['Fitting_parameters'].get('Good_q_range', None)
+            tau = series_fit.parameters.sel(parameter='Tau').values
+            series_fit['diffusion_coeff'] = ([window_dim], [ddm.estimate_diffusion_coeff_from_taus(series.q.values, tau_w, good_q_range)
+                                                            for tau_w in tau])
+        series_fit.attrs['model'] = self.fit_model
+        series_fit.attrs['data_to_use'] = self.model_dict['data_to_use']
+        series_fit.attrs['warm_start'] = str(warm_start)
+        return series_fit
+
+
+    def fit_models(self, model_names, parameters=None, q_range=None, number_of_workers=None,
+                   save=True, display_table=True, **fit_kwargs):
+        r"""Fits the data with several models and ranks them by information criteria.
+
+        The data is loaded once and shared by all fits. The models are fit concurrently
+        (in a pool of threads). For each model, the Akaike (AIC) and Bayesian (BIC)
+        information criteria are found at each q (see :py:func:`PyDDM.ddm_calc.information_criteria`)
+        and summed over the q range. Only models fit to the same data (DDM matrix or ISF)
+        should be compared.
+
+        Parameters
+        ----------
+        model_names : list
+            Names of the models (see :py:func:`PyDDM.fit_parameters_dictionaries.return_possible_fitting_models`)
+        parameters : dict or None, optional
+            Initial guess, minimum and maximum of parameters for each model, e.g.
+            {'DDM Matrix - Double Exponential': {'Tau2': [10, 0.1, 1000]}}. Parameters not
+            given here are taken from the 'Fitting_parameters' of the YAML file or, if not
+            there, from the defaults of the model.
+        q_range : list or None, optional
+            Lower and upper index of q (upper index not included) over which the
+            information criteria are summed. If None (default), all q where every
+            model was fit are used.
+        number_of_workers : int or None, optional
+            Number of models fit at the same time. If None (default), the smaller of
+            the number of models and the number of CPUs.
+        save : bool, optional
+            Save each fit in the `fittings` dictionary under the name of its model. Default is True.
+        display_table : bool, optional
+            Display the table comparing the models. Default is True.
+        **fit_kwargs
+            Passed to :py:meth:`fit` for each model.
+
+        Returns
+        -------
+        comparison : pandas DataFrame or None
+            One row per model, ranked by the summed AIC (best first), with the summed
+            AIC and BIC, their differences from the best model, the Akaike weights, and
+            the fraction of q at which each model has the lowest AIC. Models without a 
+            finite AIC at any q are left out. None if fewer than two models can be compared.
+
+        """
+        if parameters is None:
+            parameters = {}
+        for name in model_names:
+            if name not in fpd.fitting_models:
+                print(f"Model '{name}' not found! Here are list of possible models:")
+                fpd.return_possible_fitting_models()
+                return None
+
+        #Each model is fit by a shallow copy of this object. They share the data and the cache.
+        fitters = []
+        for name in model_names:
+            fitter = copy.copy(self)
+            fitter.fit_model = name
+            fitter.model_dict = copy.deepcopy(fpd.fitting_models[name])
+            fitter.fittings = {}
+            fitter.silent = True
+            for p in fpd.return_parameter_names(fitter.model_dict, print_par_names=False):
+                if p in parameters.get(name, {}):
+                    fpd.set_parameter_guess_and_limits(fitter.model_dict, p, parameters[name][p])
+                elif (p in self.fit_options) and (len(self.fit_options[p])==3):
+                    fpd.set_parameter_guess_and_limits(fitter.model_dict, p, self.fit_options[p])
+            fitters.append(fitter)
+
+        fit_kwargs.update(save=False, display_table=False)
+        def fit_one_model(fitter):
+            try:
+                return fitter.fit(**fit_kwargs)
+            except Exception as e:
+                print(f"Fit with model '{fitter.fit_model}' failed: {e}")
+                return None
+
+        if number_of_workers is None:
+            number_of_workers = min(len(fitters), os.cpu_count() or 1)
+        start_time = time.time()
+        if number_of_workers > 1:
+            with ThreadPoolExecutor(max_workers=number_of_workers) as executor:
+                all_fit_results = list(executor.map(fit_one_model, fitters))
+        else:
+            all_fit_results = [fit_one_model(fitter) for fitter in fitters]
+        if not self.silent:
+            print(f"Fit {len(fitters)} models in {time.time()-start_time:.1f} s.")
+
+        names = []
+        aics = []
+        bics = []
+        rows = []
+        for fitter, fit_results in zip(fitters, all_fit_results):
+            if fit_results is None:
+                continue
+            if fit_results.data_to_use == 'ISF':
+                data = fit_results.isf_data
+            else:
+                data = fit_results.ddm_matrix_data
+            number_free = int(np.sum(~fpd.extract_array_of_fixed_or_not(fitter.model_dict)))
+            aic, bic, _ = ddm.information_criteria(data.values, fit_results.theory.values, number_free)
+            fit_results['AIC'] = xr.DataArray(aic, dims=['q'], coords=[fit_results.q])
+            fit_results['BIC'] = xr.DataArray(bic, dims=['q'], coords=[fit_results.q])
+            if save:
+                self.fittings[fitter.fit_model] = {'model':fitter.fit_model,
+                                                   'settings':copy.deepcopy(fitter.model_dict['parameter_info']),
+                                                   'fit':fit_results}
+            names.append(fitter.fit_model)
+            aics.append(aic)
+            bics.append(bic)
+            rows.append({'model':fitter.fit_model, 'data_to_use':fit_results.data_to_use,
+                         'free_parameters':number_free})
+        if len(names) == 0:
+            return None
+        if len(set(row['data_to_use'] for row in rows)) > 1:
+            print("Warning: models were fit to different data (DDM matrix and ISF). Their information criteria are not comparable.")
+
+        aics = np.array(aics)
+        bics = np.array(bics)
+        in_range = np.ones(aics.shape[1], dtype=bool)
+        if q_range is not None:
+            in_range[:] = False
+            in_range[q_range[0]:q_range[1]] = True
+        #A model that failed at every q would otherwise leave no q to compare the others at
+        has_aic = np.any(np.isfinite(aics[:,in_range]), axis=1)
+        if not np.all(has_aic):
+            print("Models without a finite AIC at any q are not compared: %s" % ", ".join(
+                name for name, keep in zip(names, has_aic) if not keep))
+            names = [name for name, keep in zip(names, has_aic) if keep]
+            rows = [row for row, keep in zip(rows, has_aic) if keep]
+            aics = aics[has_aic]
+            bics = bics[has_aic]
+        if len(names) < 2:
+            print("Fewer than two models to compare.")
+            return None
+        qs_to_compare = np.all(np.isfinite(aics), axis=0) & in_range
+        if not np.any(qs_to_compare):
+            print("No wavevectors where all models were fit.")
+            return None
+        total_aic = aics[:,qs_to_compare].sum(axis=1)
+        total_bic = bics[:,qs_to_compare].sum(axis=1)
+        best_at_each_q = np.argmin(aics[:,qs_to_compare], axis=0)
+        delta_aic = total_aic - total_aic.min()
+        akaike_weights = np.exp(-0.5*delta_aic)
+        akaike_weights = akaike_weights / akaike_weights.sum()
+        for i,row in enumerate(rows):
+            row.update(AIC=total_aic[i], BIC=total_bic[i], delta_AIC=delta_aic[i],
+                       delta_BIC=total_bic[i]-total_bic.min(), akaike_weight=akaike_weights[i],
+                       fraction_of_qs_best=np.mean(best_at_each_q==i))
+        comparison = pd.DataFrame(rows).sort_values('AIC').reset_index(drop=True)
+        comparison.index = comparison.index + 1
+        comparison.index.name = 'rank'
+        comparison.attrs['number_of_qs_compared'] = int(qs_to_compare.sum())
+
+        if display_table:
+            display(comparison)
+        return comparison
+
+
+    def bootstrap_uncertainties(self, fit_results=None, number_of_resamples=100,
+                                confidence_level=0.95, use_sigma=True, random_seed=None,
+                                number_of_workers=1, use_lsqr_cf=[False,True]):
+        r"""Finds uncertainties of the fit parameters by bootstrapping the residuals.
+
+        At each q, the residuals of the fit are resampled and added back to the best fit
+        theory. These resampled data sets are fit, starting from the best fit parameters.
+        See :py:func:`PyDDM.ddm_calc.bootstrap_fit_ddm`.
+
+        Parameters
+        ----------
+        fit_results : xarray Dataset or None, optional
+            Results of a fit with :py:meth:`fit`. If None (default), uses the fit most
+            recently saved in the `fittings` dictionary.
+        number_of_resamples : int, optional
+            Number of resampled data sets fit at each q. Default is 100.
+        confidence_level : float, optional
+            The intervals given are the central `confidence_level` of the bootstrap
+            samples. Default is 0.95.
+        use_sigma : bool, optional
+            If True (default), the residuals are divided by the uncertainty of the data 
+            before being resampled, and the fits are weighted by it, as in :py:meth:`fit`. 
+            This is the standard error of the DDM matrix ('ddm_matrix_stderr' in the 
+            ddm_dataset) if available, otherwise :math:`1/\sqrt{N}`, where N is the number 
+            of image pairs for each lag time.
+        random_seed : int or None, optional
+            Seed for the random number generator. Default is None.
+        number_of_workers : int, optional
+            Number of threads for fitting (q are fit in parallel). Default is 1.
+        use_lsqr_cf : list, optional
+            Whether to use `scipy.optimize.least_squares` (first) and then 
+            `scipy.optimize.curve_fit` (second) for each resampled fit. Default is 
+            [False,True], the same as :py:meth:`fit`.
+
+        Returns
+        -------
+        fit_results : xarray Dataset
+            The fit results with the variables 'parameters_bootstrap' (resample, parameter, q),
+            'parameters_lower' and 'parameters_upper' (parameter, q) added. The attributes
+            'diffusion_coeff_std' and 'velocity_std' are updated from the bootstrap samples,
+            and 'diffusion_coeff_interval' and 'velocity_interval' are added.
+
+        """
+        if fit_results is None:
+            if len(self.fittings) == 0:
+                print("No fits saved in the fittings dictionary.")
+                return None
+            fit_results = [*self.fittings.values()][-1]['fit']
+
+        #Model and parameter settings that were used for this fit
+        model_dict = copy.deepcopy(fpd.fitting_models[fit_results.model])
+        saved_settings = [f['settings'] for f in self.fittings.values() if f['fit'] is fit_results]
+        if len(saved_settings) > 0:
+            model_dict['parameter_info'] = copy.deepcopy(saved_settings[0])
+        elif fit_results.model == self.fit_model:
+            model_dict['parameter_info'] = copy.deepcopy(self.model_dict['parameter_info'])
+
+        if fit_results.data_to_use == 'ISF':
+            data = fit_results.isf_data
+        else:
+            data = fit_results.ddm_matrix_data
+        sigma = None
+        if use_sigma:
+            sigma = self._measured_sigma(fit_results.data_to_use)
+            if sigma is None:
+                sigma = 1./np.sqrt(self.ddm_dataset.num_pairs_per_dt.values)
+        q_indices = np.nonzero(np.all(np.isfinite(fit_results.parameters.values), axis=0) &
+                               np.any(np.isfinite(fit_results.theory.values), axis=0))[0]
+
+        start_time = time.time()
+        bootstrap_params = ddm.bootstrap_fit_ddm(data.values, fit_results.lagtime.values, model_dict,
+                                                 fit_results.parameters.values, fit_results.theory.values,
+                                                 number_of_resamples=number_of_resamples, q_indices=q_indices,
+                                                 sigma=sigma, random_seed=random_seed,
+                                                 number_of_workers=number_of_workers,
+                                                 first_use_leastsq=use_lsqr_cf[0],
+                                                 use_curvefit_method=use_lsqr_cf[1])
+        if not self.silent:
+            print(f"Bootstrap with {number_of_resamples} resamples took {time.time()-start_time:.1f} s.")
+
+        tail = 100 * (1 - confidence_level) / 2
+        fit_results['parameters_bootstrap'] = xr.DataArray(bootstrap_params, dims=['resample', 'parameter', 'q'],
+                                                           coords={'parameter': fit_results.parameter, 'q': fit_results.q})
+        fit_results['parameters_lower'] = fit_results.parameters_bootstrap.quantile(tail/100, dim='resample', skipna=True).drop_vars('quantile')
+        fit_results['parameters_upper'] = fit_results.parameters_bootstrap.quantile(1-tail/100, dim='resample', skipna=True).drop_vars('quantile')
+        fit_results.attrs['bootstrap_confidence_level'] = confidence_level
+        fit_results.attrs['number_of_resamples'] = number_of_resamples
+
+        tau_names = [name for name in ('Tau', 'Tau2') if name in fit_results.parameter]
+        for tau_name in tau_names:
+            prefix = 'tau2_' if tau_name == 'Tau2' else ''
+            if (prefix+'good_q_range') not in fit_results.attrs:
+                continue
+            good_q_range = fit_results.attrs[prefix+'good_q_range']
+            d_samples, v_samples = _bootstrap_diffusion_coeff_and_velocity(fit_results, good_q_range,
+                                                                          use_tau2=(tau_name=='Tau2'))
+            fit_results.attrs[prefix+'diffusion_coeff_std'] = np.nanstd(d_samples)
+            fit_results.attrs[prefix+'velocity_std'] = np.nanstd(v_samples)
+            fit_results.attrs[prefix+'diffusion_coeff_interval'] = list(np.nanpercentile(d_samples, [tail, 100-tail]))
+            fit_results.attrs[prefix+'velocity_interval'] = list(np.nanpercentile(v_samples, [tail, 100-tail]))
+        return fit_results
+
+
+    def _q_band_to_fit(self, model_spec, fit_q_band, fill_outside_q_band, min_amplitude_over_background):
+        #Determines which q values to fit. Returns the band (or None if fitting all q), 
+        #the indices of q to fit, and how the fitting function should fill the others
+        if fit_q_band is None:
+            fit_q_band = self.content['Fitting_parameters'].get('Fit_q_band', None)
+        if fill_outside_q_band is None:
+            fill_outside_q_band = self.content['Fitting_parameters'].get('Fill_outside_q_band', 'nan')
+        if (fit_q_band is None) or (fit_q_band is False):
+            return None, None, 'nan'
+
+        estimated_taus = ddm.estimate_tau_from_isf_crossing(self.ddm_dataset.ISF.values,
+                                                            self.ddm_dataset.lagtime.values)
+        if isinstance(fit_q_band, str):
+            if fit_q_band != 'auto':
+                print("The 'fit_q_band' parameter must be None, 'auto', or a list of two indices. Fitting all q.")
+                return None, None, 'nan'
+            q_band = ddm.find_informative_q_range(self.ddm_dataset.Amplitude.values, self.ddm_dataset.B.values,
+                                                  estimated_taus, min_amplitude_over_background)
+            if q_band is None:
+                print("Could not find a range of q to fit. Fitting all q.")
+                return None, None, 'nan'
+            if not self.silent:
+                print("Fitting q indices from %i to %i." % (q_band[0], q_band[1]-1))
+        else:
+            q_band = [int(fit_q_band[0]), int(fit_q_band[1])]
+        q_indices_to_fit = np.arange(q_band[0], min(q_band[1], len(self.ddm_dataset.q)))
+
+        if fill_outside_q_band == 'estimate':
+            #These rows of the initial guesses are not used for fitting, so set them to the estimates
+            outside_band = np.ones(model_spec.number_of_qs, dtype=bool)
+            outside_band[q_indices_to_fit] = False
+            estimates = {'Tau': estimated_taus,
+                         'Amplitude': self.ddm_dataset.Amplitude.values,
+                         'Background': np.broadcast_to(self.ddm_dataset.B.values, outside_band.shape)}
+            for param_name in estimates:
+                j = model_spec.index(param_name)
+                if j is not None:
+                    model_spec.guesses[outside_band,j] = estimates[param_name][outside_band]
+            fill_unfit_qs = 'guess'
+        else:
+            if fill_outside_q_band != 'nan':
+                print("Options for 'fill_outside_q_band' are 'nan' or 'estimate'. Using 'nan'.")
+            fill_unfit_qs = 'nan'
+        return q_band, q_indices_to_fit, fill_unfit_qs
+
+
+    def _estimated_taus_for_guess(self, model_spec, tau_estimate_method):
+        #Estimates of tau for each q to use as initial guesses
+        isf = self.ddm_dataset.ISF.values
+        lagtimes = self.ddm_dataset.lagtime.values
+        if tau_estimate_method == 'crossing':
+            return ddm.estimate_tau_from_isf_crossing(isf, lagtimes)
+        elif tau_estimate_method == 'integral':
+            mean_taus = ddm.estimate_tau_from_isf_integral(isf, lagtimes)
+            #The integral gives the mean decay time, newt(tau, s). Convert to tau. 
+            s_index = model_spec.index('StretchingExp')
+            if s_index is not None:
+                stretching_exp = model_spec.guesses[:,s_index]
+                stretching_exp = np.where(stretching_exp>0, stretching_exp, 1.0)
+                return mean_taus / newt(1.0, stretching_exp)
+            return mean_taus
+        else:
+            print("Options for 'tau_estimate_method' are 'crossing' or 'integral'. Not using estimated tau.")
+            return None
+
+
     def _save_fit(self, fit_results, name_fit=None):
 
         #Save the fit and parameter settings to a dictionary with a key value provided by the user
@@ -2110,7 +3653,8 @@ class DDM_Fit:
 
 
 def get_tau_vs_q_fit(fit_results, use_new_tau=True, use_tau2=False, 
-                     forced_qs=None, update_good_q_range=True, silent=False):
+                     forced_qs=None, update_good_q_range=True, silent=False,
+                     use_bootstrap=True):
     r"""From decay  time (tau) vs wavevector (q), gets effective diffusion coeff and scaling exponent
     
     This function looks at tau vs q and fits tau(q) to a powerlaw. From this we
@@ -2137,6 +3681,11 @@ def get_tau_vs_q_fit(fit_results, use_new_tau=True, use_tau2=False,
     update_good_q_range : bool, optional
         If True (default), then the range of good q values for which a power law 
         relationship is observed will be updated using a linear model estimator. 
+    use_bootstrap : bool, optional
+        If True (default) and `fit_results` has bootstrap samples of the parameters 
+        (see :py:meth:`DDM_Fit.bootstrap_uncertainties`), the standard deviations of the 
+        diffusion coefficient and velocity are found from the spread of these over the 
+        bootstrap samples. Otherwise, they are the spread of the values over q. 
     
 
     Returns
@@ -2239,10 +3788,31 @@ def get_tau_vs_q_fit(fit_results, use_new_tau=True, use_tau2=False,
     diffusion_coeff_std = np.std(1./(tau[good_q_range[0]:good_q_range[1]]*(q[good_q_range[0]:good_q_range[1]]**2)))
     velocity = np.mean(1./(tau[good_q_range[0]:good_q_range[1]]*(q[good_q_range[0]:good_q_range[1]])))
     velocity_std = np.std(1./(tau[good_q_range[0]:good_q_range[1]]*(q[good_q_range[0]:good_q_range[1]])))
+    if use_bootstrap and ('parameters_bootstrap' in fit_results.data_vars):
+        d_samples, v_samples = _bootstrap_diffusion_coeff_and_velocity(fit_results, good_q_range, 
+                                                                      use_new_tau=use_new_tau, use_tau2=use_tau2)
+        diffusion_coeff_std = xr.DataArray(np.nanstd(d_samples))
+        velocity_std = xr.DataArray(np.nanstd(v_samples))
 
     return good_q_range, slope, effective_diffconst, MSD_alpha, MSD_effective_diffconst, diffusion_coeff.values, diffusion_coeff_std.values, velocity.values, velocity_std.values
 
 
+def _bootstrap_diffusion_coeff_and_velocity(fit_results, good_q_range, use_new_tau=True, use_tau2=False):
+    #Diffusion coefficient and velocity (averaged over the good q range, as in 
+    #  get_tau_vs_q_fit) for each bootstrap sample of the parameters
+    tau_name = 'Tau2' if use_tau2 else 'Tau'
+    samples = fit_results.parameters_bootstrap
+    tau = samples.sel(parameter=tau_name)
+    if use_new_tau and ('StretchingExp' in samples.parameter):
+        stretch_name = 'StretchingExp2' if (use_tau2 and ('StretchingExp2' in samples.parameter)) else 'StretchingExp'
+        tau = newt(tau, samples.sel(parameter=stretch_name))
+    tau = tau.values[:, good_q_range[0]:good_q_range[1]]
+    q = fit_results.q.values[good_q_range[0]:good_q_range[1]]
+    d_samples = np.nanmean(1./(tau*q**2), axis=1)
+    v_samples = np.nanmean(1./(tau*q), axis=1)
+    return d_samples, v_samples
+
+
 def fit_report(fit_results, PDF_save=True, forced_qs=None, pdf_save_dir = "./", 
                forced_qs_for_tau2=None, q_indices=[10,20,30,40], use_new_tau=True, 
                fit_report_name=None, show=True):
@@ -2533,13 +4103,15 @@ class Browse_DDM_Fits:
     """
 
     #def __init__(self, ax, ax2, q, t, ddm_matrix, lagtimes, thry):
-    def __init__(self, fig, ax, ax2, fit):
+    def __init__(self, fig, ax, ax2, fit, dense_theory=False):
         """
         Class for interactive inspection of fits.
         
         
         :param q: Name of the model for fitting
         :type q: ndarray
+        :param dense_theory: If True, fits are drawn as smooth curves evaluated at finely spaced lag times
+        :type dense_theory: bool
 
         ...
         """
@@ -2563,6 +4135,12 @@ class Browse_DDM_Fits:
             self.data = fit.isf_data
         self.lagtimes = fit.lagtime.values
         self.theory = fit.theory.values
+        self.theory_lagtimes = self.lagtimes
+        if dense_theory:
+            dense = hf.get_dense_theory(fit)
+            if dense is not None:
+                self.theory = dense.values
+                self.theory_lagtimes = dense.lagtime.values
         self.q = fit.q.values
         self.t = fit.parameters.loc['Tau'].values
         
@@ -2621,7 +4199,7 @@ class Browse_DDM_Fits:
 
         self.ax2.cla()
         self.ax2.semilogx(self.lagtimes,self.data[:,dataind],'ro')
-        self.ax2.semilogx(self.lagtimes,self.theory[:,dataind],'-b')
+        self.ax2.semilogx(self.theory_lagtimes,self.theory[:,dataind],'-b')
         self.ax2.set_xlabel("Lag time (s)")
 
         self.ax2.text(0.05, 0.9, f'q={self.q[dataind]:1.3f}',
@@ -2635,7 +4213,7 @@ class Browse_DDM_Fits:
         self.fig.canvas.draw()
         
 
-def interactive_fit_inspection(fit):
+def interactive_fit_inspection(fit, dense_theory=False):
     r"""Interactive plot of tau vs q to inspect each fit.
     
     Generates a decay time (tau) vs wavevector (q) plot on a log-log scale. Click 
@@ -2648,6 +4226,9 @@ def interactive_fit_inspection(fit):
     ----------
     fit : xarray dataset
         Results of fit to either DDM matrix or ISF.
+    dense_theory : bool, optional
+        If True, fits are drawn as smooth curves evaluated at finely spaced 
+        lag times. Default is False. 
 
     Returns
     -------
@@ -2662,7 +4243,7 @@ def interactive_fit_inspection(fit):
     ax.set_ylabel("tau (s)")
     #line, = ax.loglog(qvals, taus, 'o', picker=True, pickradius=150)
     
-    browser = Browse_DDM_Fits(fig, ax, ax2, fit)# qvals, taus, ddm_matrix, lagtimes, thry)
+    browser = Browse_DDM_Fits(fig, ax, ax2, fit, dense_theory=dense_theory)# qvals, taus, ddm_matrix, lagtimes, thry)
     
     fig.canvas.mpl_connect('pick_event', browser.on_pick)
     fig.canvas.mpl_connect('key_press_event', browser.on_press)
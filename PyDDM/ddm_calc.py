@@ -15,14 +15,21 @@ with the functions here.
 import sys
 import copy
 import numpy as np
-from scipy.optimize import least_squares, curve_fit
+from scipy.optimize import least_squares, curve_fit, nnls
+from scipy.stats import qmc
 from scipy.special import gamma
 from scipy.signal import blackmanharris #for Blackman-Harris windowing
 from scipy.ndimage import gaussian_filter as gf
 from scipy import stats
+from scipy import sparse
 import socket
+import time
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import skimage
 import fit_parameters_dictionaries as fpd
+import ISF_and_DDMmatrix_theoretical_models as models
 import logging
 from IPython.core.display import clear_output
 
@@ -176,6 +183,84 @@ def generateLogDistributionOfTimeLags(start,stop,numPoints):
             numberOfPoints = len(np.unique(listOfLagTimes))
         return np.unique(listOfLagTimes)
 
+
+def _pairs_separated_by(frame_numbers, dt):
+    #Indices of the pairs of frames whose frame numbers differ by exactly dt
+    first = np.arange(len(frame_numbers))
+    second = np.searchsorted(frame_numbers, frame_numbers + dt)
+    paired = second < len(frame_numbers)
+    paired[paired] = frame_numbers[second[paired]] == (frame_numbers[paired] + dt)
+    return first[paired], second[paired]
+
+
+def find_dropped_frames(framestamps, frames=None):
+    r"""Finds frames dropped during acquisition from the camera's framestamps.
+
+    Parameters
+    ----------
+    framestamps : array
+        1D array of the framestamp (frame counter) recorded by the camera for each
+        saved frame. If no frames were dropped, these increase by one from frame to frame.
+    frames : array or None, optional
+        1D array of the index, in the saved movie, of each frame in `framestamps`. Use when
+        only some of the frames were selected (e.g., with a frame stride or frame windows):
+        the framestamps are then expected to increase by the same step as these indices.
+        If None (default), the frames are assumed to be consecutive.
+
+    Returns
+    -------
+    gap_indices : array
+        Indices of the frames (in `framestamps`) that are followed by one or more dropped frames
+    number_dropped : array
+        Number of frames dropped after each of the frames in `gap_indices`
+
+    """
+    steps = np.diff(np.asarray(framestamps).astype(np.int64))
+    if frames is None:
+        expected_steps = 1
+    else:
+        expected_steps = np.diff(np.asarray(frames).astype(np.int64))
+    extra_steps = steps - expected_steps
+    gap_indices = np.nonzero(extra_steps > 0)[0]
+    number_dropped = extra_steps[gap_indices]
+    return gap_indices, number_dropped
+
+
+def lag_times_from_timestamps(timestamps, dts, frame_numbers=None):
+    r"""Lag times from the acquisition time of each frame.
+
+    For each lag time (in frames), finds the mean time elapsed between all pairs
+    of frames separated by that many frames. 
+
+    Parameters
+    ----------
+    timestamps : array
+        1D array of the acquisition time of each frame, in seconds
+    dts : array
+        1D array of the lag times, in frames
+    frame_numbers : array or None, optional
+        1D array with the frame number (e.g., the camera's framestamp) of each frame. 
+        If given, frames are paired by their frame numbers, so that dropped frames 
+        are accounted for. If None (default), frames are assumed to be consecutive.
+
+    Returns
+    -------
+    lag_times : array
+        1D array of the lag times, in seconds. NaN for lag times without any pairs of frames.
+
+    """
+    timestamps = np.asarray(timestamps, dtype=float)
+    if frame_numbers is None:
+        frame_numbers = np.arange(len(timestamps))
+    frame_numbers = np.asarray(frame_numbers).astype(np.int64)
+    lag_times = np.full(len(dts), np.nan)
+    for k,dt in enumerate(dts):
+        first, second = _pairs_separated_by(frame_numbers, dt)
+        if len(first) > 0:
+            lag_times[k] = np.mean(timestamps[second] - timestamps[first])
+    return lag_times
+
+
 def _new_ddm_matrix(imageArray):
     r"""Alternative method for getting DDM matrix.
     
@@ -200,7 +285,7 @@ def _new_ddm_matrix(imageArray):
 
 
 def computeDDMMatrix(imageArray, dts, use_BH_windowing=False, quiet=False,
-                     overlap_method=2, **kwargs):
+                     overlap_method=2, return_stderr=False, **kwargs):
     r'''Calculates DDM matrix
     
     This function calculates the DDM matrix at the lag times provided by `dts`.  
@@ -217,10 +302,18 @@ def computeDDMMatrix(imageArray, dts, use_BH_windowing=False, quiet=False,
         Default is 2.
     quiet : {True, False}, optional
         If True, prints updates as the computation proceeds
+    return_stderr : {False, True}, optional
+        If True, also returns the standard error of the DDM matrix. The mean and 
+        variance over image pairs are accumulated together (Welford's method). 
     **number_differences_max : optional keyword argument
         For `overlap_method` of 1, sets the maximum number of differences 
         to find for a given lag time. If `overlap_method`=1 and this 
         keyword argument is not given, defaults to 300
+    **frame_numbers : optional keyword argument
+        1D array with the frame number of each image (e.g., the camera's 
+        framestamps), increasing. If given, images are paired by frame number 
+        rather than by position in `imageArray`, so that lag times stay correct 
+        when frames were dropped during acquisition. 
         
     Returns
     -------
@@ -230,6 +323,13 @@ def computeDDMMatrix(imageArray, dts, use_BH_windowing=False, quiet=False,
     num_pairs_per_dt : array
         1D array. Contains the number of image pairs that went into calculating the 
         DDM matrix for each lag time. Used for weighting fits to the DDM matrix.
+        If no pairs of images are found for a lag time (possible if `frame_numbers`
+        is given), the DDM matrix at that lag time is NaN. 
+    ddm_mat_stderr : array
+        Only returned if `return_stderr` is True. Standard error of the mean of 
+        the Fourier transformed image differences, same shape as `ddm_mat`. NaN 
+        for lag times with only one pair of images. Pairs of images that overlap 
+        in time are treated as independent, so this may underestimate the error. 
     
     '''
     
@@ -239,6 +339,9 @@ def computeDDMMatrix(imageArray, dts, use_BH_windowing=False, quiet=False,
             num_dif_max = 300
     else:
         num_dif_max = 300
+    frame_numbers = kwargs.get('frame_numbers', None)
+    if frame_numbers is not None:
+        frame_numbers = np.asarray(frame_numbers).astype(np.int64)
 
     if imageArray.ndim != 3:
         print("Images passed to `computeDDMMatrix` must be 3D array.")
@@ -253,6 +356,8 @@ def computeDDMMatrix(imageArray, dts, use_BH_windowing=False, quiet=False,
 
     #Initializes array for Fourier transforms of differences
     ddm_mat = np.zeros((len(dts), ndx, ndy),dtype=float)
+    if return_stderr:
+        ddm_mat_stderr = np.zeros((len(dts), ndx, ndy),dtype=float)
 
     #We *don't* necessarily want to take the Fourier transform of *every* possible difference
     #of images separated by a given lag time. 
@@ -278,32 +383,381 @@ def computeDDMMatrix(imageArray, dts, use_BH_windowing=False, quiet=False,
                 #print("Running dt=%i...\n" % dt)
                 logger.info("Running dt = %i..." % dt)
 
-        #Calculates all differences of images with a delay time dt
-        all_diffs = (imageArray[dt:] - imageArray[0:(-1*dt)].astype(float))
-        if use_BH_windowing:
-            all_diffs = filterfunction*all_diffs
-
-        #Rather than FT all image differences of a given lag time, only select a subset
-        all_diffs_new = all_diffs[0::steps_in_diffs[k],:,:]
-
-        #Loop through each image difference and take the fourier transform
+        if frame_numbers is None:
+            #Rather than FT all image differences of a given lag time, only select a subset
+            #(and only those differences are calculated)
+            all_diffs_new = (imageArray[dt::steps_in_diffs[k]] - imageArray[0:(-1*dt):steps_in_diffs[k]].astype(float))
+            if use_BH_windowing:
+                all_diffs_new = filterfunction*all_diffs_new
+        else:
+            #Pairs of images whose frame numbers differ by dt (a subset, as above)
+            first, second = _pairs_separated_by(frame_numbers, dt)
+            first = first[0::steps_in_diffs[k]]
+            second = second[0::steps_in_diffs[k]]
+            all_diffs_new = (imageArray[second] - imageArray[first].astype(float))
+            if use_BH_windowing:
+                all_diffs_new = filterfunction*all_diffs_new
+
+        #Loop through each image difference and take the fourier transform. The
+        #running mean (and sum of squared deviations, if needed) is updated with 
+        #Welford's method.
+        if return_stderr:
+            sum_sq_deviations = np.zeros((ndx, ndy), dtype=float)
         for i in range(0,all_diffs_new.shape[0]):
             temp = np.fft.fft2(all_diffs_new[i]) # - all_diffs_new[i].mean())
-            ddm_mat[j] = ddm_mat[j] + abs(temp*np.conj(temp))/(ndx*ndy)
-
-        num_pairs_per_dt.append(all_diffs_new.shape[0])
-
-        #Divide the running sum of FTs to get the average FT of the image differences of that lag time
-        ddm_mat[j] = ddm_mat[j] / (all_diffs_new.shape[0])
+            ft_of_diff = abs(temp*np.conj(temp))/(ndx*ndy)
+            if return_stderr:
+                deviation = ft_of_diff - ddm_mat[j]
+                ddm_mat[j] += deviation / (i+1)
+                sum_sq_deviations += deviation * (ft_of_diff - ddm_mat[j])
+            else:
+                ddm_mat[j] = ddm_mat[j] + ft_of_diff
+
+        num_pairs = all_diffs_new.shape[0]
+        num_pairs_per_dt.append(num_pairs)
+
+        if num_pairs == 0:
+            ddm_mat[j] = np.nan
+            if return_stderr:
+                ddm_mat_stderr[j] = np.nan
+        elif return_stderr:
+            if num_pairs > 1:
+                ddm_mat_stderr[j] = np.fft.fftshift(np.sqrt(sum_sq_deviations / (num_pairs-1) / num_pairs))
+            else:
+                ddm_mat_stderr[j] = np.nan
+        else:
+            #Divide the running sum of FTs to get the average FT of the image differences of that lag time
+            ddm_mat[j] = ddm_mat[j] / num_pairs
         ddm_mat[j] = np.fft.fftshift(ddm_mat[j])
 
         j = j+1
         
     num_pairs_per_dt = np.array(num_pairs_per_dt)
 
+    if return_stderr:
+        return ddm_mat, num_pairs_per_dt, ddm_mat_stderr
     return ddm_mat, num_pairs_per_dt
 
 
+def _full_spectrum_from_half(half, ndy):
+    #Rebuilds a (..., ndx, ndy) array of a real image's |FT|^2 from the half given by rfft2,
+    #using |F(-qx,-qy)| = |F(qx,qy)|
+    ndx = half.shape[-2]
+    flipped_rows = (-np.arange(ndx)) % ndx
+    full = np.empty(half.shape[:-2] + (ndx, ndy), dtype=half.dtype)
+    full[..., :half.shape[-1]] = half
+    full[..., half.shape[-1]:] = half[..., flipped_rows, ndy-half.shape[-1]:0:-1]
+    return full
+
+
+def _steps_in_diffs(dts, ntimes, overlap_method, num_dif_max):
+    #Step between the image pairs used for each lag time (see `computeDDMMatrix`)
+    if overlap_method == 0:
+        return dts
+    elif overlap_method == 1:
+        return np.ceil((ntimes - dts) / num_dif_max).astype(int)
+    elif overlap_method == 2:
+        return np.ceil(dts/3.0).astype(int)
+    return np.ones_like(dts)
+
+
+def _put_unless_stopped(blocks_queue, item, stop):
+    #Puts item on the queue, waiting while it is full, unless the consumer has stopped
+    #(and so will not take anything more off the queue). Returns True if the item was put.
+    while not stop.is_set():
+        try:
+            blocks_queue.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _prefetch_blocks(frame_blocks, preprocess, blocks_queue, stop, stage_times):
+    #Producer stage: reads (and preprocesses) blocks of frames, putting them on the queue.
+    #Blocks while the queue is full. An exception is passed on to the consumer. Nothing
+    #more is put on the queue once the consumer has stopped.
+    try:
+        blocks = iter(frame_blocks)
+        while not stop.is_set():
+            start = time.perf_counter()
+            block = next(blocks, None)
+            if block is None:
+                break
+            if preprocess is not None:
+                block = preprocess(block)
+            ready = time.perf_counter()
+            stage_times['read_busy'] += ready - start
+            _put_unless_stopped(blocks_queue, block, stop)
+            stage_times['read_waiting'] += time.perf_counter() - ready
+    except Exception as e:
+        _put_unless_stopped(blocks_queue, e, stop)
+    _put_unless_stopped(blocks_queue, None, stop)
+
+
+class _PairDifferenceAccumulator(object):
+    #Mean (and sum of squared deviations) over pairs of frames of |FT of their difference|^2,
+    #for each lag time, found from the (half) Fourier transforms of the frames. Pairs are
+    #added as the second frame of the pair is transformed, so only the transforms of the
+    #last `max_lag` frames (and those of the current block) need to be kept, in a ring buffer.
+    #With `max_lag` of None, all transforms are kept and pairs are found in `finish`.
+
+    def __init__(self, dts, steps_in_diffs, frame_numbers, max_lag, return_stderr, pairs_per_chunk=16):
+        self.dts = dts
+        self.steps_in_diffs = steps_in_diffs
+        self.frame_numbers = frame_numbers
+        self.max_lag = max_lag
+        self.return_stderr = return_stderr
+        self.pairs_per_chunk = pairs_per_chunk
+        self.ring = None
+        self.ntimes = 0
+        self.pairs_seen = np.zeros(len(dts), dtype=int)
+        self.num_pairs = np.zeros(len(dts), dtype=int)
+
+    def _store(self, fts):
+        #Puts the block of transforms in the ring buffer, growing it if needed
+        keep = self.ntimes if self.max_lag is None else min(self.max_lag, self.ntimes)
+        if (self.ring is None) or (keep + len(fts) > len(self.ring)):
+            size = keep + len(fts)
+            if (self.max_lag is None) and (self.ring is not None):
+                size = max(size, 2*len(self.ring))
+            ring = np.empty((size,) + fts.shape[1:], dtype=fts.dtype)
+            if self.ring is not None:
+                kept = np.arange(self.ntimes - keep, self.ntimes)
+                ring[kept % size] = self.ring[kept % len(self.ring)]
+            else:
+                self.mean = np.zeros((len(self.dts),) + fts.shape[1:], dtype=float)
+                self.sum_sq_deviations = np.zeros_like(self.mean)
+            self.ring = ring
+        self.ring[np.arange(self.ntimes, self.ntimes+len(fts)) % len(self.ring)] = fts
+        self.ntimes += len(fts)
+
+    def _add_pairs(self, b0, b1):
+        #Adds the pairs of frames whose second frame is one of frames b0 to b1-1
+        ndx = self.ring.shape[1]
+        for k,dt in enumerate(self.dts):
+            if self.frame_numbers is None:
+                second = np.arange(max(b0, dt), b1)
+                first = second - dt
+                selected = (first % self.steps_in_diffs[k]) == 0
+            else:
+                frame_numbers = self.frame_numbers[:b1]
+                second = np.arange(b0, b1)
+                target = frame_numbers[second] - dt
+                first = np.minimum(np.searchsorted(frame_numbers, target), b1-1)
+                paired = frame_numbers[first] == target
+                first, second = first[paired], second[paired]
+                selected = ((self.pairs_seen[k] + np.arange(len(first))) % self.steps_in_diffs[k]) == 0
+                self.pairs_seen[k] += len(first)
+            first, second = first[selected], second[selected]
+            for i in range(0, len(first), self.pairs_per_chunk):
+                diffs = (self.ring[second[i:i+self.pairs_per_chunk] % len(self.ring)] -
+                         self.ring[first[i:i+self.pairs_per_chunk] % len(self.ring)])
+                ft_of_diffs = (diffs.real**2 + diffs.imag**2)/(ndx*self.ndy)
+                n_before = self.num_pairs[k]
+                n_chunk = len(ft_of_diffs)
+                chunk_mean = ft_of_diffs.mean(axis=0)
+                delta = chunk_mean - self.mean[k]
+                self.mean[k] += delta * n_chunk / (n_before + n_chunk)
+                if self.return_stderr:
+                    self.sum_sq_deviations[k] += ((ft_of_diffs - chunk_mean)**2).sum(axis=0) + delta**2 * n_before * n_chunk / (n_before + n_chunk)
+                self.num_pairs[k] += n_chunk
+
+    def add(self, fts, ndy):
+        self.ndy = ndy
+        b0 = self.ntimes
+        self._store(fts)
+        if self.max_lag is not None:
+            self._add_pairs(b0, self.ntimes)
+
+    def finish(self, steps_in_diffs=None):
+        #Returns the DDM matrix, number of pairs for each lag time and standard error
+        if self.max_lag is None:
+            if steps_in_diffs is not None:
+                self.steps_in_diffs = steps_in_diffs
+            self._add_pairs(0, self.ntimes)
+        ndx = self.ring.shape[1]
+        ddm_mat = np.zeros((len(self.dts), ndx, self.ndy), dtype=float)
+        ddm_mat_stderr = np.zeros_like(ddm_mat) if self.return_stderr else None
+        for k in range(len(self.dts)):
+            if self.num_pairs[k] == 0:
+                ddm_mat[k] = np.nan
+                if self.return_stderr:
+                    ddm_mat_stderr[k] = np.nan
+                continue
+            ddm_mat[k] = np.fft.fftshift(_full_spectrum_from_half(self.mean[k], self.ndy))
+            if self.return_stderr:
+                if self.num_pairs[k] > 1:
+                    stderr = np.sqrt(self.sum_sq_deviations[k] / (self.num_pairs[k]-1) / self.num_pairs[k])
+                    ddm_mat_stderr[k] = np.fft.fftshift(_full_spectrum_from_half(stderr, self.ndy))
+                else:
+                    ddm_mat_stderr[k] = np.nan
+        return ddm_mat, self.num_pairs.copy(), ddm_mat_stderr
+
+
+def computeDDMMatrix_pipelined(frame_blocks, dts, preprocess=None, use_BH_windowing=False, quiet=False,
+                               overlap_method=2, return_stderr=False, queue_size=4, keep_frames=True, **kwargs):
+    r'''Calculates DDM matrix while the images are being read
+    
+    Reading the images and Fourier transforming them are done at the same time, as two 
+    stages of a pipeline. A background thread takes blocks of frames from `frame_blocks` 
+    (e.g., a generator reading them from disk), applies `preprocess` (e.g., windowing 
+    and binning) and puts them on a queue holding at most `queue_size` blocks. Meanwhile, 
+    each frame taken from the queue is Fourier transformed. Since the Fourier transform is 
+    linear, the transform of the difference of two images is the difference of their 
+    transforms, so each frame is transformed only once. The DDM matrix is then found as 
+    with `computeDDMMatrix`, using the same pairs of images. 
+    
+    Pairs of images are added to the DDM matrix as the second image of the pair is 
+    transformed, so only the transforms of the last max(`dts`) frames are kept (each 
+    taking about 8 bytes per pixel), along with a running mean and, if `return_stderr` 
+    is True, a running sum of squared deviations for each lag time (8 bytes per pixel 
+    each). With `overlap_method` of 1, which pairs are used depends on the total number 
+    of frames. Unless `number_of_frames` is given, the transforms of all frames are then 
+    kept until every frame has been read. If `keep_frames` is True, the frames themselves 
+    are kept as well. 
+    
+    Parameters
+    ----------
+    frame_blocks : iterable
+        Iterable (e.g., a generator) of 3D arrays of images, with the first dimension 
+        being time. Consecutive blocks of the movie. 
+    dts : array
+        1D array of the lag times for which to calculate the DDM matrix
+    preprocess : function or None, optional
+        Applied to each block of frames before it is put on the queue. Should take and 
+        return a 3D array. Default is None. 
+    use_BH_windowing : {True, False}, optional
+        Apply Blackman-Harris windowing to the images if True. Windowing is done in the 
+        Fourier transform stage, so the frames kept are not windowed. Default is False. 
+    quiet : {True, False}, optional
+        If True, prints updates as the computation proceeds
+    overlap_method : {0,1,2,3}, optional
+        Default is 2. See `computeDDMMatrix`. 
+    return_stderr : {False, True}, optional
+        If True, also returns the standard error of the DDM matrix. 
+    queue_size : int, optional
+        Maximum number of blocks read ahead of the block being Fourier transformed. Default is 4. 
+    keep_frames : {True, False}, optional
+        If True (default), the preprocessed frames are also returned. These are kept 
+        in memory (at the size of the preprocessed frames) until the end. 
+    **number_differences_max : optional keyword argument
+        For `overlap_method` of 1, sets the maximum number of differences 
+        to find for a given lag time. Defaults to 300. 
+    **frame_numbers : optional keyword argument
+        1D array with the frame number of each image. See `computeDDMMatrix`. If there 
+        are more frame numbers than frames read, only the first ones are used. 
+    **number_of_frames : optional keyword argument
+        Number of frames that will be read. Only used for `overlap_method` of 1 (see above). 
+        
+    Returns
+    -------
+    ddm_mat : array
+        The DDM matrix. First dimension is time lag. Other two are the x and y
+        wavevectors.
+    num_pairs_per_dt : array
+        1D array. Contains the number of image pairs that went into calculating the 
+        DDM matrix for each lag time. 
+    ddm_mat_stderr : array
+        Only returned if `return_stderr` is True. See `computeDDMMatrix`. 
+    pipeline_output : dict
+        With keys 'frames' (3D array of the preprocessed, unwindowed frames, or None if 
+        `keep_frames` is False), 'av_fftsq_of_each_frame' (average of the squared Fourier transforms of 
+        the frames, divided by the number of pixels, as in `determining_A_and_B`), and 
+        'stage_occupancy' (dict with the fraction of the time that the read stage and the 
+        Fourier transform stage were busy, rather than waiting on each other, and the 
+        total time 'seconds' the two stages took). 
+    
+    '''
+    num_dif_max = kwargs.get('number_differences_max', None)
+    if num_dif_max is None:
+        num_dif_max = 300
+    frame_numbers = kwargs.get('frame_numbers', None)
+    if frame_numbers is not None:
+        frame_numbers = np.asarray(frame_numbers).astype(np.int64)
+
+    stage_times = {'read_busy':0., 'read_waiting':0., 'fft_busy':0., 'fft_waiting':0.}
+    blocks_queue = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    producer = threading.Thread(target=_prefetch_blocks, args=(frame_blocks, preprocess, blocks_queue,
+                                                               stop, stage_times), daemon=True)
+
+    #Pairs of frames are added as the frames are Fourier transformed. Only half of each
+    #transform is found (the images are real), and only those still needed for the longest
+    #lag time are kept. With `overlap_method` of 1, the pairs used depend on the number of
+    #frames, so unless that is known all transforms are kept until every frame is read.
+    number_of_frames = kwargs.get('number_of_frames', None)
+    streaming = (overlap_method != 1) or (number_of_frames is not None)
+    steps_in_diffs = _steps_in_diffs(dts, number_of_frames if streaming else 0, overlap_method, num_dif_max)
+    accumulator = _PairDifferenceAccumulator(dts, steps_in_diffs, frame_numbers, int(np.max(dts)) if streaming else None,
+                                             return_stderr)
+    frames = []
+    fftsq_sum = None
+    frames_shape = None
+    number_of_blocks = 0
+    pipeline_start = time.perf_counter()
+    producer.start()
+    try:
+        while True:
+            start = time.perf_counter()
+            block = blocks_queue.get()
+            got_block = time.perf_counter()
+            stage_times['fft_waiting'] += got_block - start
+            if block is None:
+                break
+            if isinstance(block, Exception):
+                raise block
+            if block.ndim != 3:
+                print("Blocks of images passed to `computeDDMMatrix_pipelined` must be 3D arrays.")
+                return
+            if (frames_shape is not None) and (block.shape[1:] != frames_shape):
+                print("All frames must be the same size. Frames of %i-by-%i found after frames of %i-by-%i." % (block.shape[1:] + frames_shape))
+                return
+            if (frame_numbers is not None) and (accumulator.ntimes + len(block) > len(frame_numbers)):
+                print("More frames read than frame numbers given.")
+                return
+            frames_shape = block.shape[1:]
+            ndy = block.shape[2]
+            if use_BH_windowing:
+                ft = np.fft.rfft2(window_function(block)*block)
+            else:
+                ft = np.fft.rfft2(block)
+            sq = ft.real**2 + ft.imag**2
+            fftsq_sum = sq.sum(axis=0) if fftsq_sum is None else fftsq_sum + sq.sum(axis=0)
+            accumulator.add(ft, ndy)
+            number_of_blocks += 1
+            if keep_frames:
+                frames.append(block)
+            stage_times['fft_busy'] += time.perf_counter() - got_block
+            if (not quiet) and (number_of_blocks%4 == 0):
+                logger.info("Fourier transformed %i frames..." % accumulator.ntimes)
+    finally:
+        stop.set()
+        producer.join()
+    pipeline_seconds = time.perf_counter() - pipeline_start
+
+    if accumulator.ntimes == 0:
+        print("No images were read.")
+        return
+    ntimes, ndx = accumulator.ntimes, frames_shape[0]
+    if keep_frames:
+        frames = np.concatenate(frames)
+
+    ddm_mat, num_pairs_per_dt, ddm_mat_stderr = accumulator.finish(None if streaming else _steps_in_diffs(dts, ntimes, overlap_method, num_dif_max))
+
+    av_fftsq_of_each_frame = np.fft.fftshift(_full_spectrum_from_half(fftsq_sum, ndy)) / (1.0*ntimes*ndx*ndy)
+    stage_occupancy = {'read': (stage_times['read_busy'] / pipeline_seconds) if pipeline_seconds > 0 else 0.,
+                       'fft': (stage_times['fft_busy'] / pipeline_seconds) if pipeline_seconds > 0 else 0.,
+                       'seconds': pipeline_seconds}
+    pipeline_output = {'frames': frames if keep_frames else None,
+                       'av_fftsq_of_each_frame': av_fftsq_of_each_frame,
+                       'stage_occupancy': stage_occupancy}
+
+    if return_stderr:
+        return ddm_mat, num_pairs_per_dt, ddm_mat_stderr, pipeline_output
+    return ddm_mat, num_pairs_per_dt, pipeline_output
+
+
 def computeDDMMatrix_correctVelocityPhase(imageArray, dts, velocity, pixel_size, 
                                           use_BH_windowing=False, 
                                           quiet=False, overlap_method=2, **kwargs):
@@ -406,8 +860,8 @@ def computeDDMMatrix_correctVelocityPhase(imageArray, dts, velocity, pixel_size,
 
         #Loop through each image difference and take the fourier transform
         for i in range(0,len(indices_im1)):
-            temp1 = np.fft.fftshift(np.fft.fft2(imageArray[indices_im1[i]])) * np.exp(-1j * phase)
-            temp2 = np.fft.fftshift(np.fft.fft2(imageArray[indices_im2[i]]))
+            temp1 = np.fft.fftshift(np.fft.fft2(imageArray[indices_im1[i]]*filterfunction)) * np.exp(-1j * phase)
+            temp2 = np.fft.fftshift(np.fft.fft2(imageArray[indices_im2[i]]*filterfunction))
             temp = temp1 - temp2
             ddm_mat[j] = ddm_mat[j] + abs(temp*np.conj(temp))/(ndx*ndy)
 
@@ -512,8 +966,8 @@ def temporalVarianceDDMMatrix(imageArray, dt, use_BH_windowing=False, quiet=Fals
         indices_im2 = indices_ims[0:(-1*dt)]
         
         for i in range(0,len(indices_im1)):
-            temp1 = np.fft.fftshift(np.fft.fft2(imageArray[indices_im1[i]])) * np.exp(-1j * phase)
-            temp2 = np.fft.fftshift(np.fft.fft2(imageArray[indices_im2[i]]))
+            temp1 = np.fft.fftshift(np.fft.fft2(imageArray[indices_im1[i]]*filterfunction)) * np.exp(-1j * phase)
+            temp2 = np.fft.fftshift(np.fft.fft2(imageArray[indices_im2[i]]*filterfunction))
             temp = temp1 - temp2
             ddm_mat[i] = ddm_mat[i] + abs(temp*np.conj(temp))/(ndx*ndy)
         
@@ -611,6 +1065,7 @@ def fit_ddm_all_qs(dData, times, param_dictionary,
                    estimated_velocity2=None,
                    update_limits_on_tau=False,
                    updated_lims_on_tau_fraction=0.1,
+                   estimated_taus=None,
                    use_A_from_images_as_guess=False,
                    update_limits_on_A=False,
                    updated_lims_on_A_fraction=0.1,
@@ -618,6 +1073,11 @@ def fit_ddm_all_qs(dData, times, param_dictionary,
                    factor=1e-3, quiet=False, quiet_on_method=True,
                    last_times = None, given_fit_method = None,
                    update_initial_guess_each_q = False,
+                   q_indices=None, fill_unfit_qs='nan',
+                   number_of_starts=1, number_of_starts_to_refine=None,
+                   random_seed=None, number_of_workers=1,
+                   coarse_to_fine=False, number_of_coarse_times=20,
+                   return_fit_info=False,
                    debug=False):
     r"""Function to fit the DDM matrix or ISF for all wavevectors.
     
@@ -639,7 +1099,8 @@ def fit_ddm_all_qs(dData, times, param_dictionary,
         Dictionary corresponding to the model we will fit to. This dictionary
         contains the parameters, the initial guess for their values, their bounds,
         and the function of the model to fit to. See the module 
-        :py:mod:`PyDDM.fit_parameters_dictionaries`
+        :py:mod:`PyDDM.fit_parameters_dictionaries`. This can also be a 
+        :py:class:`PyDDM.fit_parameters_dictionaries.ModelSpec` (with one row per q).
     amplitude_from_ims : array_like
         The DDM matrix is usually fit to something like 
         DDM_matrix = A(1-f)+B where A is the amplitude. But this A parameter can
@@ -655,7 +1116,39 @@ def fit_ddm_all_qs(dData, times, param_dictionary,
     sigma : {None}, optional
         If `scipy.optimize.curve_fit` is used, we can weight the data points by
         this array. If passed, it will need to be a 1D array of length equal to 
-        the number of lag times. 
+        the number of lag times or a 2D array of the same shape as `dData` (e.g., 
+        the standard error of the DDM matrix at each lag time and q). 
+    estimated_taus : {None}, optional
+        1D array with an estimate of 'Tau' for each wavevector (for example, from 
+        :py:func:`estimate_tau_from_isf_crossing`). If passed, used as the initial
+        guess for 'Tau' at every wavevector where it is finite. This takes precedence
+        over `update_tau_based_on_estimated_diffcoeff` and `update_tau_based_on_estimated_velocity`. 
+        The bounds are updated if `update_limits_on_tau` is True. 
+    q_indices : {None}, optional
+        If given, only the wavevectors with these indices are fit. 
+    fill_unfit_qs : {'nan', 'guess'}, optional
+        For wavevectors not fit (see `q_indices`), the parameters are either
+        NaN ('nan', the default) or the initial guesses ('guess'). 
+    number_of_starts : {1}, optional
+        If greater than 1, each wavevector is fit starting from the initial guess
+        and from `number_of_starts`-1 other points drawn by Latin hypercube sampling
+        within the bounds (see :py:func:`generate_starting_points`). The solution with
+        the lowest cost is kept. Useful for models prone to local minima (e.g., 
+        those with two decay times). 
+    number_of_starts_to_refine : {None}, optional
+        See :py:func:`fit_ddm`. 
+    random_seed : {None}, optional
+        Seed used to generate the starting points. 
+    number_of_workers : {1}, optional
+        If greater than 1, wavevectors are fit in parallel with this many threads. 
+    coarse_to_fine : {False}, optional
+        If True, each wavevector is first fit using a logarithmically spaced subset 
+        of lag times. See :py:func:`fit_ddm`. 
+    number_of_coarse_times : {20}, optional
+        Number of lag times used for the coarse fit. 
+    return_fit_info : {False}, optional
+        If True, also returns a dictionary with the cost of each fit and, if 
+        `number_of_starts` is greater than 1, the statistics of the multiple starts. 
     
     Returns
     -------
@@ -664,6 +1157,11 @@ def fit_ddm_all_qs(dData, times, param_dictionary,
     theory : array
         Model evaluated using the best fit values. Will be of the same size as
         the passed parameter `dData`. 
+    fit_info : dict
+        Only returned if `return_fit_info` is True. Has 'cost' (one value per q) and, 
+        with multiple starts, 'multistart_costs' (shape of number of q by `number_of_starts`), 
+        'best_start' and 'number_near_best' (see :py:func:`fit_ddm`). Entries are NaN 
+        for wavevectors not fit. 
     
     """
 
@@ -671,113 +1169,237 @@ def fit_ddm_all_qs(dData, times, param_dictionary,
     #based on shape of the data passed to the function
     num_times, num_qs = dData.shape
 
+    #Compile the parameter dictionary once. The initial guesses and bounds for
+    #every wavevector are rows of the arrays held by `spec`; the dictionary
+    #passed to this function is not modified.
+    if isinstance(param_dictionary, fpd.ModelSpec):
+        spec = param_dictionary.copy()
+    else:
+        spec = fpd.ModelSpec(param_dictionary, num_qs)
+
     #Initialize dictionary to store fitted values for parameters
     best_fit_params = {}
+    for param_name in spec.names:
+        best_fit_params[param_name] = np.zeros((num_qs))
+
+    #For basing initial guess for 'Tau' on expected diffusion coefficient or velocity.
+    #As before, the guesses for the first wavevector are left as they are.
+    qvalues = np.asarray(dData.q.values, dtype=float)
+    not_first_q = np.arange(num_qs) > 0
+    with np.errstate(divide='ignore'):
+        if update_tau_based_on_estimated_diffcoeff and (estimated_diffcoeff is not None):
+            spec.set_guesses_per_q('Tau', 1./(qvalues*qvalues*estimated_diffcoeff), q_mask=not_first_q,
+                                   update_limits=update_limits_on_tau, limits_fraction=updated_lims_on_tau_fraction)
+        elif update_tau_based_on_estimated_velocity and (estimated_velocity is not None):
+            spec.set_guesses_per_q('Tau', 1./(qvalues*estimated_velocity), q_mask=not_first_q,
+                                   update_limits=update_limits_on_tau, limits_fraction=updated_lims_on_tau_fraction)
+        if update_tau2_based_on_estimated_diffcoeff and (estimated_diffcoeff2 is not None):
+            spec.set_guesses_per_q('Tau2', 1./(qvalues*qvalues*estimated_diffcoeff2), q_mask=not_first_q,
+                                   update_limits=update_limits_on_tau, limits_fraction=updated_lims_on_tau_fraction)
+        elif update_tau2_based_on_estimated_velocity and (estimated_velocity2 is not None):
+            spec.set_guesses_per_q('Tau2', 1./(qvalues*estimated_velocity2), q_mask=not_first_q,
+                                   update_limits=update_limits_on_tau, limits_fraction=updated_lims_on_tau_fraction)
+    if estimated_taus is not None:
+        spec.set_guesses_per_q('Tau', estimated_taus,
+                               update_limits=update_limits_on_tau, limits_fraction=updated_lims_on_tau_fraction)
+    if use_A_from_images_as_guess:
+        new_A = np.array(amplitude_from_ims, dtype=float)
+        new_A[new_A<0] = 1
+        spec.set_guesses_per_q('Amplitude', new_A, q_mask=not_first_q,
+                               update_limits=update_limits_on_A, limits_fraction=updated_lims_on_A_fraction)
+
+    data_values = np.asarray(dData)
+    times = np.asarray(times)
+
+    if q_indices is None:
+        q_indices = np.arange(num_qs)
+    else:
+        q_indices = np.asarray(q_indices, dtype=int)
+        unfit_qs = np.setdiff1d(np.arange(num_qs), q_indices)
+        for j, param_name in enumerate(best_fit_params):
+            if fill_unfit_qs == 'guess':
+                best_fit_params[param_name][unfit_qs] = spec.guesses[unfit_qs,j]
+            else:
+                best_fit_params[param_name][unfit_qs] = np.nan
 
-    #Find the number of parameters we will fit for
-    number_of_parameters = len(param_dictionary['parameter_info'])
-
-    for param in param_dictionary['parameter_info']:
-        best_fit_params[param['parname']] = np.zeros((num_qs))
-
-    theory = np.empty((num_times, num_qs)) #Empty array to store theoretical models calculated with best fits
-    theory.fill(np.nan)
+    #Starting points for multi-start fitting. Generated here, before any fitting,
+    #so that the results do not depend on the order in which q are fit.
+    starting_points = {}
+    if number_of_starts > 1:
+        rng = np.random.default_rng(random_seed)
+        for i in q_indices:
+            starting_points[i] = generate_starting_points(spec, number_of_starts-1, q_index=i, seed=rng)
 
-    #Loop through each wavevector
-    for i in range(num_qs):
+    def fit_one_q(i):
         if debug:
             print("Fitting for q index of %i..." % i)
-            
+
         #If one does not want data for the longer lag times to be included
         #when fitting, one can pass the optional parameter `last_times`
         if last_times is not None:
             if np.isscalar(last_times):
-                data_to_fit = dData[:last_times,i]
-                times_to_fit = times[:last_times]
+                number_of_times_to_fit = int(last_times)
             else:
-                data_to_fit = dData[:int(last_times[i]),i]
-                times_to_fit = times[:int(last_times[i])]
+                number_of_times_to_fit = int(last_times[i])
         else:
-            data_to_fit = dData[:,i]
-            times_to_fit = times
-
-        #For basing initial guess for 'Tau' on expected diffusion coefficient or velocity
-        qvalue = dData.q[i].values
-        if update_tau_based_on_estimated_diffcoeff and (estimated_diffcoeff is not None):
-            for element in param_dictionary['parameter_info']:
-                if (element['parname']=='Tau') and (i>0):
-                    new_tau = 1./(qvalue*qvalue*estimated_diffcoeff)
-                    if update_limits_on_tau:
-                        element['limits'][0] = new_tau * (1-updated_lims_on_tau_fraction)
-                        element['limits'][1] = new_tau * (1+updated_lims_on_tau_fraction)
-                        element['value'] = new_tau
-                    if (new_tau>=element['limits'][0]) and (new_tau<=element['limits'][1]):
-                        element['value'] = new_tau
-        elif update_tau_based_on_estimated_velocity and (estimated_velocity is not None):
-            for element in param_dictionary['parameter_info']:
-                if (element['parname']=='Tau') and (i>0):
-                    new_tau = 1./(qvalue*estimated_velocity)
-                    if update_limits_on_tau:
-                        element['limits'][0] = new_tau * (1-updated_lims_on_tau_fraction)
-                        element['limits'][1] = new_tau * (1+updated_lims_on_tau_fraction)
-                        element['value'] = new_tau
-                    elif (new_tau>=element['limits'][0]) and (new_tau<=element['limits'][1]):
-                        element['value'] = new_tau
-        if update_tau2_based_on_estimated_diffcoeff and (estimated_diffcoeff2 is not None):
-            for element in param_dictionary['parameter_info']:
-                if (element['parname']=='Tau2') and (i>0):
-                    new_tau2 = 1./(qvalue*qvalue*estimated_diffcoeff2)
-                    if update_limits_on_tau:
-                        element['limits'][0] = new_tau2 * (1-updated_lims_on_tau_fraction)
-                        element['limits'][1] = new_tau2 * (1+updated_lims_on_tau_fraction)
-                        element['value'] = new_tau2
-                    elif (new_tau2>=element['limits'][0]) and (new_tau2<=element['limits'][1]):
-                        element['value'] = new_tau2
-        elif update_tau2_based_on_estimated_velocity and (estimated_velocity2 is not None):
-            for element in param_dictionary['parameter_info']:
-                if (element['parname']=='Tau2') and (i>0):
-                    new_tau2 = 1./(qvalue*estimated_velocity2)
-                    if update_limits_on_tau:
-                        element['limits'][0] = new_tau2 * (1-updated_lims_on_tau_fraction)
-                        element['limits'][1] = new_tau2 * (1+updated_lims_on_tau_fraction)
-                        element['value'] = new_tau2
-                    elif (new_tau2>=element['limits'][0]) and (new_tau2<=element['limits'][1]):
-                        element['value'] = new_tau2
-        if use_A_from_images_as_guess:
-            for element in param_dictionary['parameter_info']:
-                if (element['parname']=='Amplitude') and (i>0):
-                    new_A = amplitude_from_ims[i]
-                    if new_A<0:
-                        new_A=1
-                    if update_limits_on_A:
-                        element['limits'][0] = new_A * (1-updated_lims_on_A_fraction)
-                        element['limits'][1] = new_A * (1+updated_lims_on_A_fraction)
-                        element['value'] = new_A
-                    elif (new_A>=element['limits'][0]) and (new_A<=element['limits'][1]):
-                        element['value'] = new_A
-
-
-        ret_params, theory[:len(times_to_fit),i], error, chi2 = fit_ddm(data_to_fit, times_to_fit, param_dictionary,
-                                                                        first_use_leastsq=first_use_leastsq,
-                                                                        use_curvefit_method=use_curvefit_method,
-                                                                        sigma=sigma,
-                                                                        err=err, logfit=logfit,maxiter=maxiter,
-                                                                        factor=factor, quiet=quiet,
-                                                                        quiet_on_method=quiet_on_method)
+            number_of_times_to_fit = num_times
+        data_to_fit = data_values[:number_of_times_to_fit,i]
+        times_to_fit = times[:number_of_times_to_fit]
+        sigma_to_use = sigma
+        if (sigma is not None) and (np.ndim(sigma)==1) and (len(sigma)==num_times):
+            sigma_to_use = np.asarray(sigma)[:len(times_to_fit)]
+        elif (sigma is not None) and (np.ndim(sigma)==2):
+            sigma_to_use = np.asarray(sigma)[:len(times_to_fit),i]
+
+        ret_params, _, error, q_fit_info = fit_ddm(data_to_fit, times_to_fit, spec,
+                                                   first_use_leastsq=first_use_leastsq,
+                                                   use_curvefit_method=use_curvefit_method,
+                                                   sigma=sigma_to_use,
+                                                   err=err, logfit=logfit,maxiter=maxiter,
+                                                   factor=factor, quiet=quiet,
+                                                   quiet_on_method=quiet_on_method,
+                                                   q_index=i,
+                                                   starting_points=starting_points.get(i),
+                                                   number_of_starts_to_refine=number_of_starts_to_refine,
+                                                   coarse_to_fine=coarse_to_fine,
+                                                   number_of_coarse_times=number_of_coarse_times)
+        return ret_params, q_fit_info
 
+    #Loop through each wavevector
+    if number_of_workers > 1:
+        with ThreadPoolExecutor(max_workers=number_of_workers) as executor:
+            results_for_each_q = list(executor.map(fit_one_q, q_indices))
+    else:
+        results_for_each_q = [fit_one_q(i) for i in q_indices]
+
+    fit_info = {'cost': np.full(num_qs, np.nan)}
+    if number_of_starts > 1:
+        fit_info['multistart_costs'] = np.full((num_qs, number_of_starts), np.nan)
+        fit_info['best_start'] = np.full(num_qs, np.nan)
+        fit_info['number_near_best'] = np.full(num_qs, np.nan)
+    for i, (ret_params, q_fit_info) in zip(q_indices, results_for_each_q):
         for j, bf_param in enumerate(best_fit_params):
             best_fit_params[bf_param][i] = ret_params[j]
-
+        for key in fit_info:
+            fit_info[key][i] = q_fit_info[key]
+
+    #Theoretical models calculated with best fits, for all q in one call. Lag
+    #times beyond those used for fitting (see `last_times`) are left as NaN.
+    theory = models.theory_surface(spec.model_function, times, [*best_fit_params.values()])
+    if last_times is not None:
+        number_fit_per_q = np.broadcast_to(np.asarray(last_times, dtype=int), (num_qs,))
+        theory[np.arange(num_times)[:,np.newaxis] >= number_fit_per_q[np.newaxis,:]] = np.nan
+
+    if return_fit_info:
+        return best_fit_params, theory, fit_info
     return best_fit_params, theory
 
 
+def fit_ddm_series(dData_series, times, param_dictionary, warm_start=True,
+                   sigma=None, last_times=None, q_indices=None,
+                   first_use_leastsq=True, use_curvefit_method=False,
+                   number_of_workers=1, quiet=True):
+    r"""Fits a series of DDM matrices (or ISFs), e.g. from consecutive time windows.
+
+    Each window is fit at all q with :py:func:`fit_ddm_all_qs`. With `warm_start`,
+    the windows are fit in order and the initial guesses for each window (at each q)
+    are the best fit values of the previous window. For a slowly evolving sample these
+    are close to the solution, so the fits converge in fewer iterations. Without
+    `warm_start`, all windows start from the same initial guesses and can be fit in
+    parallel.
+
+    Parameters
+    ----------
+    dData_series : xarray DataArray
+        DDM matrix or ISF with dimensions (window, lagtime, q), and 'q' as a coordinate. 
+        Lag times with NaN at all q at the end of a window (e.g., lag times longer 
+        than the window) are not fit.
+    times : array_like
+        1D array of the lagtimes
+    param_dictionary : dict
+        Dictionary (or :py:class:`PyDDM.fit_parameters_dictionaries.ModelSpec`) of the model
+    warm_start : bool, optional
+        Default is True.
+    sigma : array or None, optional
+        Uncertainty of the data, as for :py:func:`fit_ddm_all_qs` (same for all windows),
+        or a 3D array with one for each window. Default is None.
+    last_times : int, array or None, optional
+        As for :py:func:`fit_ddm_all_qs`. Default is None.
+    q_indices : array or None, optional
+        Indices of the wavevectors to fit. Default is None (all).
+    first_use_leastsq : bool, optional
+        Default is True.
+    use_curvefit_method : bool, optional
+        Default is False.
+    number_of_workers : int, optional
+        Number of windows fit at the same time, only used if `warm_start` is False. Default is 1.
+    quiet : bool, optional
+        Default is True.
+
+    Returns
+    -------
+    parameters : array
+        3D array of shape (window, parameter, q) of best fit values
+    theory : array
+        3D array of shape (window, lagtime, q)
+    parameter_names : list
+        Names of the parameters
+
+    """
+    data_values = np.asarray(dData_series, dtype=float)
+    num_windows, num_times, num_qs = data_values.shape
+    times = np.asarray(times)
+    spec = fpd.as_model_spec(param_dictionary, num_qs)
+    parameters = np.full((num_windows, spec.number_of_parameters, num_qs), np.nan)
+    theory = np.full(data_values.shape, np.nan)
+
+    def fit_one_window(w, spec_for_window):
+        #Only lag times before the first that is missing at all q
+        missing = np.all(~np.isfinite(data_values[w]), axis=1)
+        number_of_times = int(np.argmax(missing)) if np.any(missing) else num_times
+        if last_times is None:
+            times_to_fit = number_of_times
+        else:
+            times_to_fit = np.minimum(last_times, number_of_times)
+        sigma_for_window = sigma[w] if (sigma is not None) and (np.ndim(sigma)==3) else sigma
+        best_fits, window_theory = fit_ddm_all_qs(dData_series[w], times, spec_for_window, None,
+                                                  first_use_leastsq=first_use_leastsq,
+                                                  use_curvefit_method=use_curvefit_method,
+                                                  sigma=sigma_for_window, last_times=times_to_fit,
+                                                  q_indices=q_indices, quiet=quiet)
+        return np.array([*best_fits.values()]), window_theory
+
+    if warm_start:
+        spec_for_window = spec
+        for w in range(num_windows):
+            if not quiet:
+                print(f"Fitting window {w+1} of {num_windows}...")
+            parameters[w], theory[w] = fit_one_window(w, spec_for_window)
+            #Next window starts from these values (where the fit succeeded)
+            spec_for_window = spec.copy()
+            previous = parameters[w].T
+            usable = np.isfinite(previous) & ~spec.fixed
+            spec_for_window.guesses = np.where(usable, np.clip(previous, spec.lower, spec.upper), spec.guesses)
+    else:
+        if number_of_workers > 1:
+            with ThreadPoolExecutor(max_workers=number_of_workers) as executor:
+                results = list(executor.map(lambda w: fit_one_window(w, spec), range(num_windows)))
+        else:
+            results = [fit_one_window(w, spec) for w in range(num_windows)]
+        for w, (window_params, window_theory) in enumerate(results):
+            parameters[w], theory[w] = window_params, window_theory
+    return parameters, theory, list(spec.names)
+
+
 
 def fit_ddm(dData, times, param_dictionary,
             first_use_leastsq=True,
             use_curvefit_method=False,
             sigma=None,
             err=None, logfit=False,maxiter=600,
-            factor=1e-3, quiet=False, quiet_on_method=True):
+            factor=1e-3, quiet=False, quiet_on_method=True, q_index=0,
+            initial_guesses=None, starting_points=None, number_of_starts_to_refine=None,
+            coarse_to_fine=False, number_of_coarse_times=20):
     r"""Function to fit the DDM matrix or ISF for one wavevector.
     
     This function fits the data from DDM (either the DDM matrix or the
@@ -816,6 +1438,28 @@ def fit_ddm(dData, times, param_dictionary,
         If `scipy.optimize.curve_fit` is used, we can weight the data points by
         this array. If passed, it will need to be a 1D array of length equal to 
         the number of lag times. 
+    q_index : {0}, optional
+        If `param_dictionary` is a :py:class:`PyDDM.fit_parameters_dictionaries.ModelSpec`, 
+        the initial guesses and bounds for the wavevector with this index are used.
+    initial_guesses : {None}, optional
+        If given, used as the initial guesses instead of those in `param_dictionary`.
+    starting_points : {None}, optional
+        2D array (number of points, number of parameters) of additional initial 
+        guesses. If given, the fit is started from the initial guesses and from each 
+        of these points (see :py:func:`generate_starting_points`) and the solution 
+        with the lowest cost is returned. 
+    number_of_starts_to_refine : {None}, optional
+        With `starting_points`, the cost of every starting point is first evaluated 
+        in one (vectorised) call. Only this many of the starting points with the lowest 
+        cost are then fit. If None (default), all are fit. 
+    coarse_to_fine : {False}, optional
+        If True, the data is first fit at a subset of `number_of_coarse_times` lag times, 
+        spaced logarithmically. This solution is then used as the initial guess for 
+        fitting all lag times. As the final fit starts close to the optimum, it takes 
+        fewer iterations. Only used if there are more than twice `number_of_coarse_times` 
+        lag times. 
+    number_of_coarse_times : {20}, optional
+        Number of lag times used for the coarse fit. 
     
     Returns
     -------
@@ -826,42 +1470,161 @@ def fit_ddm(dData, times, param_dictionary,
         the passed parameter `dData`. 
     error : array
         Error between the fit and model.
-    None
-        Last return is `None`.
+    fit_info : dict
+        Has key 'cost' (sum of squared residuals, divided by `sigma` if given). If 
+        `starting_points` is given, also 'multistart_costs' (cost of the solution 
+        found from each starting point; NaN if that point was not fit), 'best_start' 
+        (index of best starting point; 0 is the initial guess) and 'number_near_best' 
+        (number of starting points whose solution is within 0.1% of the lowest cost).
     
     """
-
-    parameter_values = fpd.extract_array_of_parameter_values(param_dictionary)
-    param_mins, param_maxs = fpd.extract_array_of_param_mins_maxes(param_dictionary)
-    #print(param_mins)
+    if (starting_points is not None) and (len(starting_points) > 0):
+        return _fit_ddm_multistart(dData, times, param_dictionary, starting_points,
+                                   number_of_starts_to_refine=number_of_starts_to_refine,
+                                   first_use_leastsq=first_use_leastsq,
+                                   use_curvefit_method=use_curvefit_method,
+                                   sigma=sigma, q_index=q_index, initial_guesses=initial_guesses,
+                                   coarse_to_fine=coarse_to_fine,
+                                   number_of_coarse_times=number_of_coarse_times)
+
+    if initial_guesses is None:
+        parameter_values = fpd.extract_array_of_parameter_values(param_dictionary, q_index)
+    else:
+        parameter_values = np.array(initial_guesses, dtype=float)
+
+    if coarse_to_fine and (len(times) > 2*number_of_coarse_times):
+        #Fit on logarithmically spaced subset of lag times first
+        coarse_indices = np.unique(np.geomspace(1, len(times), number_of_coarse_times).astype(int) - 1)
+        coarse_sigma = None if sigma is None else np.asarray(sigma)[coarse_indices]
+        coarse_params, _, _, _ = fit_ddm(np.asarray(dData)[coarse_indices], np.asarray(times)[coarse_indices],
+                                         param_dictionary,
+                                         first_use_leastsq=first_use_leastsq,
+                                         use_curvefit_method=use_curvefit_method,
+                                         sigma=coarse_sigma, q_index=q_index,
+                                         initial_guesses=parameter_values)
+        which_params_should_be_fixed = fpd.extract_array_of_fixed_or_not(param_dictionary, q_index)
+        parameter_values = np.where(which_params_should_be_fixed, parameter_values, coarse_params)
 
     #If 'first_use_leastsq' is true, we will use the scipy.optimize leastsquares fitting method
     #  first (just to get initial parameters).
     if first_use_leastsq:
-        lsqr_params, lsqr_theory, lsqr_error = execute_LSQ_fit(dData, times, param_dictionary, debug=False)
-        which_params_should_be_fixed = fpd.extract_array_of_fixed_or_not(param_dictionary)
-        for i,tofix in enumerate(which_params_should_be_fixed):
-            if not tofix:
-                parameter_values[i] = lsqr_params[i]
+        lsqr_params, lsqr_theory, lsqr_error = execute_LSQ_fit(dData, times, param_dictionary, debug=False,
+                                                               q_index=q_index, initial_guesses=parameter_values)
+        which_params_should_be_fixed = fpd.extract_array_of_fixed_or_not(param_dictionary, q_index)
+        parameter_values = np.where(which_params_should_be_fixed, parameter_values, lsqr_params)
 
-    #print(parameter_values)
     if use_curvefit_method:
-        if first_use_leastsq:
-            updated_param_dict = copy.deepcopy(param_dictionary)
-            fpd.populate_intial_guesses(updated_param_dict, parameter_values)
-            res = execute_ScipyCurveFit_fit(dData, times, updated_param_dict, sigma=sigma, debug=False)
-        else:
-            res = execute_ScipyCurveFit_fit(dData, times, param_dictionary, sigma=sigma, debug=False)
-        return res[0], res[1], res[2], None
+        res = execute_ScipyCurveFit_fit(dData, times, param_dictionary, sigma=sigma, debug=False,
+                                        q_index=q_index, initial_guesses=parameter_values)
+        return res[0], res[1], res[2], {'cost': _weighted_cost(dData, res[1], sigma)}
 
 
     else:
-        return lsqr_params, lsqr_theory, lsqr_error, None
+        return lsqr_params, lsqr_theory, lsqr_error, {'cost': _weighted_cost(dData, lsqr_theory, sigma)}
+
+
+def _weighted_cost(dData, theory, sigma=None):
+    #Sum of squared residuals (divided by sigma if given) along the first axis
+    residuals = np.asarray(dData) - np.asarray(theory)
+    if sigma is not None:
+        sigma = np.asarray(sigma)
+        residuals = residuals / (sigma if residuals.ndim==sigma.ndim else sigma.reshape(-1,1))
+    cost = np.sum(residuals**2, axis=0)
+    return np.where(np.isfinite(cost), cost, np.inf)
+
 
+def generate_starting_points(param_dictionary, number_of_points, q_index=0, seed=None):
+    r"""Generates initial guesses spread over the bounds of the parameters.
 
+    Points are drawn with Latin hypercube sampling within the bounds of the 
+    parameters. For parameters whose bounds are both positive and span more than
+    two orders of magnitude (e.g., decay times), the sampling is uniform in the 
+    logarithm of the parameter. Infinite bounds are replaced by a factor of 10 
+    around the initial guess. Fixed parameters are kept at their initial guess. 
 
+    Parameters
+    ----------
+    param_dictionary : dict or ModelSpec
+        Dictionary (or :py:class:`PyDDM.fit_parameters_dictionaries.ModelSpec`) for the model
+    number_of_points : int
+        Number of points
+    q_index : int, optional
+        Index of the wavevector, used if `param_dictionary` is a ModelSpec. Default is 0.
+    seed : None, int, or numpy.random.Generator, optional
+        Seed for the random number generator
+
+    Returns
+    -------
+    starting_points : array
+        Array of shape (number_of_points, number of parameters)
 
-def execute_LSQ_fit(dData, times, param_dict, debug=True):
+    """
+    guesses = fpd.extract_array_of_parameter_values(param_dictionary, q_index).astype(float)
+    lower, upper = fpd.extract_array_of_param_mins_maxes(param_dictionary, q_index)
+    lower = np.array(lower, dtype=float)
+    upper = np.array(upper, dtype=float)
+    fixed = np.asarray(fpd.extract_array_of_fixed_or_not(param_dictionary, q_index), dtype=bool)
+
+    scale = np.where(guesses != 0, np.abs(guesses), 1.0)
+    lower = np.where(np.isfinite(lower), lower, guesses - 10*scale)
+    upper = np.where(np.isfinite(upper), upper, guesses + 10*scale)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        use_log = (lower > 0) & (upper/lower > 100)
+
+    sampler = qmc.LatinHypercube(d=len(guesses), seed=seed)
+    unit_points = sampler.random(number_of_points)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        linear_points = lower + unit_points*(upper - lower)
+        log_points = np.exp(np.log(lower) + unit_points*(np.log(upper) - np.log(lower)))
+    starting_points = np.where(use_log, log_points, linear_points)
+    starting_points[:,fixed] = guesses[fixed]
+    return starting_points
+
+
+def _fit_ddm_multistart(dData, times, param_dictionary, starting_points,
+                        number_of_starts_to_refine=None, first_use_leastsq=True,
+                        use_curvefit_method=False, sigma=None, q_index=0,
+                        initial_guesses=None, coarse_to_fine=False, number_of_coarse_times=20):
+    #Fits from the initial guesses and from each of the starting points; keeps the best
+    if initial_guesses is None:
+        initial_guesses = fpd.extract_array_of_parameter_values(param_dictionary, q_index)
+    candidates = np.vstack((np.asarray(initial_guesses, dtype=float)[np.newaxis,:], starting_points))
+    number_of_candidates = candidates.shape[0]
+
+    #Cost of all starting points in one call
+    model_function = param_dictionary['model_function']
+    initial_theory = models.theory_surface(model_function, times, candidates.T)
+    initial_costs = _weighted_cost(np.asarray(dData)[:,np.newaxis], initial_theory, sigma)
+    order = np.argsort(initial_costs, kind='stable')
+    if number_of_starts_to_refine is not None:
+        order = order[:max(1, number_of_starts_to_refine)]
+
+    final_costs = np.full(number_of_candidates, np.nan)
+    results = {}
+    for k in order:
+        params, theory, error, info = fit_ddm(dData, times, param_dictionary,
+                                              first_use_leastsq=first_use_leastsq,
+                                              use_curvefit_method=use_curvefit_method,
+                                              sigma=sigma, q_index=q_index,
+                                              initial_guesses=candidates[k],
+                                              coarse_to_fine=coarse_to_fine,
+                                              number_of_coarse_times=number_of_coarse_times)
+        final_costs[k] = info['cost']
+        results[k] = (params, theory, error)
+
+    best = int(np.nanargmin(np.where(np.isnan(final_costs), np.inf, final_costs)))
+    best_cost = final_costs[best]
+    fit_info = {'cost': best_cost,
+                'multistart_costs': final_costs,
+                'best_start': best,
+                'number_near_best': int(np.sum(final_costs <= best_cost*(1+1e-3) + 1e-300))}
+    return results[best][0], results[best][1], results[best][2], fit_info
+
+
+
+
+def execute_LSQ_fit(dData, times, param_dict, debug=True,
+                    q_index=0, initial_guesses=None):
     r"""Performs least_squares fit.
     
     Using the `scipy.optimize.least_squares` function, the data is fit to 
@@ -884,6 +1647,11 @@ def execute_LSQ_fit(dData, times, param_dict, debug=True):
     debug : {True}, optional
         If True, will print out values of initial guesses and bounds (and other
         info).
+    q_index : {0}, optional
+        If `param_dict` is a :py:class:`PyDDM.fit_parameters_dictionaries.ModelSpec`, 
+        the initial guesses and bounds for the wavevector with this index are used.
+    initial_guesses : {None}, optional
+        If given, used as the initial guesses instead of those in `param_dict`.
         
     Returns
     -------
@@ -903,8 +1671,11 @@ def execute_LSQ_fit(dData, times, param_dict, debug=True):
 
     theory_function = param_dict['model_function']
 
-    params_to_pass_to_lsqr = fpd.extract_array_of_parameter_values(param_dict)
-    minimum_of_parameters, maximum_of_parameters = fpd.extract_array_of_param_mins_maxes(param_dict)
+    if initial_guesses is None:
+        params_to_pass_to_lsqr = fpd.extract_array_of_parameter_values(param_dict, q_index)
+    else:
+        params_to_pass_to_lsqr = np.array(initial_guesses, dtype=float)
+    minimum_of_parameters, maximum_of_parameters = fpd.extract_array_of_param_mins_maxes(param_dict, q_index)
 
     #define the error function (difference between data and the model)
     error_function = lambda parameters: dData-theory_function(times,*parameters)
@@ -921,7 +1692,8 @@ def execute_LSQ_fit(dData, times, param_dict, debug=True):
     return lsqr_params, theory_function(times,*lsqr_params), lsqr_results['fun']
 
 
-def execute_ScipyCurveFit_fit(dData, times, param_dict, sigma=None, debug=True, method=None):
+def execute_ScipyCurveFit_fit(dData, times, param_dict, sigma=None, debug=True, method=None,
+                              q_index=0, initial_guesses=None):
     r"""Performs curve_fit fit.
     
     Using the `scipy.optimize.curve_fit` function, the data is fit to 
@@ -949,6 +1721,11 @@ def execute_ScipyCurveFit_fit(dData, times, param_dict, sigma=None, debug=True,
     method : {None}, optional
         Passed as `method` to `scipy.optimize.curve_fit`. Can be `lm`, `trf`, 
         or `dogbox`. 
+    q_index : {0}, optional
+        If `param_dict` is a :py:class:`PyDDM.fit_parameters_dictionaries.ModelSpec`, 
+        the initial guesses and bounds for the wavevector with this index are used.
+    initial_guesses : {None}, optional
+        If given, used as the initial guesses instead of those in `param_dict`.
         
     Returns
     -------
@@ -966,8 +1743,11 @@ def execute_ScipyCurveFit_fit(dData, times, param_dict, sigma=None, debug=True,
     """
     theory_function = param_dict['model_function']
 
-    params_to_pass_to_cf = fpd.extract_array_of_parameter_values(param_dict)
-    minimum_of_parameters, maximum_of_parameters = fpd.extract_array_of_param_mins_maxes(param_dict)
+    if initial_guesses is None:
+        params_to_pass_to_cf = fpd.extract_array_of_parameter_values(param_dict, q_index)
+    else:
+        params_to_pass_to_cf = np.array(initial_guesses, dtype=float)
+    minimum_of_parameters, maximum_of_parameters = fpd.extract_array_of_param_mins_maxes(param_dict, q_index)
 
     if debug:
         print("Parameters going to CurveFit fitting: ", params_to_pass_to_cf)
@@ -997,6 +1777,981 @@ def execute_ScipyCurveFit_fit(dData, times, param_dict, sigma=None, debug=True,
     return cf_params, theory_function(times,*cf_params), errors_1stddev
 
 
+#For global fits: how a decay time may be tied to the wavevector. Each entry
+#gives the names of the global parameters and a function returning the decay
+#time given q and the global parameters.
+tau_vs_q_forms = {'diffusive': (['DiffusionCoeff'], lambda q, d: 1./(d*q*q)),
+                  'ballistic': (['Velocity'], lambda q, v: 1./(v*q)),
+                  'power_law': (['PowerLawCoeff', 'PowerLawExp'], lambda q, k, alpha: 1./(k*(q**alpha)))}
+
+def fit_ddm_global(dData, times, param_dictionary, tied_parameters,
+                   q_indices=None, sigma=None, last_times=None,
+                   global_initial_guesses=None, maxiter=None, debug=False):
+    r"""Fits the DDM matrix or ISF for all wavevectors at once with shared parameters.
+
+    Rather than fitting each wavevector independently, selected parameters are
+    tied across wavevectors. A decay time can be tied to q through a functional
+    form (e.g., :math:`\tau(q) = 1/(D q^2)`) and any other parameter can be shared
+    (a single value for all q). All other parameters (e.g., the amplitude and
+    background) are still fit separately for each q. The whole (lagtime, q) surface
+    is fit in a single call to `scipy.optimize.least_squares`. Because the
+    residuals at one q only depend on the global parameters and on the parameters
+    for that q, the Jacobian is sparse and block-structured; this sparsity is
+    passed to the optimizer.
+
+    Parameters
+    ----------
+    dData : xarray DataArray
+        DDM matrix or ISF. The first dimension is lag time, the second is q. Must
+        have 'q' as a coordinate.
+    times : array_like
+        1D array of the lagtimes
+    param_dictionary : dict or ModelSpec
+        Dictionary (or :py:class:`PyDDM.fit_parameters_dictionaries.ModelSpec`) for
+        the model. Initial guesses and bounds of the parameters which are not
+        tied are taken from here.
+    tied_parameters : dict
+        Keys are names of parameters. Values are either 'shared' or, for decay
+        times, one of 'diffusive' (:math:`\tau = 1/(D q^2)`), 'ballistic'
+        (:math:`\tau = 1/(v q)`) or 'power_law' (:math:`\tau = 1/(K q^{\alpha})`).
+        E.g., {'Tau': 'diffusive', 'StretchingExp': 'shared'}.
+    q_indices : array_like or None, optional
+        Indices of wavevectors to fit. If None (default), all but the first (q=0).
+    sigma : array or None, optional
+        Uncertainty of the data; either 1D (one value per lag time) or 2D (same
+        shape as `dData`). Residuals are divided by this. Default is None.
+    last_times : int, array or None, optional
+        Number of lag times to fit (single integer or one per q). Default is None.
+    global_initial_guesses : dict or None, optional
+        Initial guesses for the global parameters (e.g., {'DiffusionCoeff': 0.5}).
+        Those not given are estimated from the initial guesses of the tied parameters.
+    maxiter : int or None, optional
+        Passed as `max_nfev` to `scipy.optimize.least_squares`
+    debug : bool, optional
+        If True, prints information about the fit.
+
+    Returns
+    -------
+    best_fit_params : dict
+        Values of the parameters of the model for each q (NaN for q not fit)
+    theory : array
+        Model evaluated using the best fit values
+    global_params : dict
+        Best fit values of the global parameters
+    global_params_std : dict
+        Standard deviation of the global parameters, from the Jacobian at the solution
+
+    """
+    num_times, num_qs = dData.shape
+    qvalues = np.asarray(dData.q.values, dtype=float)
+    data_values = np.asarray(dData, dtype=float)
+    times = np.asarray(times, dtype=float)
+
+    if isinstance(param_dictionary, fpd.ModelSpec):
+        spec = param_dictionary
+    else:
+        spec = fpd.ModelSpec(param_dictionary, num_qs)
+    if q_indices is None:
+        q_indices = np.arange(1, num_qs)
+    q_indices = np.asarray(q_indices, dtype=int)
+    q_fit = qvalues[q_indices]
+    number_of_qs_to_fit = len(q_indices)
+    if global_initial_guesses is None:
+        global_initial_guesses = {}
+
+    #Set up the global parameters
+    global_names = []
+    global_guesses = []
+    global_lower = []
+    global_upper = []
+    tied_forms = {}
+    for param_name, tie in tied_parameters.items():
+        j = spec.index(param_name)
+        if j is None:
+            print(f"Parameter '{param_name}' not in model. Ignoring.")
+            continue
+        if tie == 'shared':
+            names = [param_name]
+            guesses = [global_initial_guesses.get(param_name, spec.guesses[q_indices[0],j])]
+            lower = [spec.lower[q_indices[0],j]]
+            upper = [spec.upper[q_indices[0],j]]
+        elif tie in tau_vs_q_forms:
+            suffix = param_name[len('Tau'):] if param_name.startswith('Tau') else "_"+param_name
+            names = [name+suffix for name in tau_vs_q_forms[tie][0]]
+            tau_guess = spec.guesses[q_indices,j]
+            exponent = {'diffusive':2., 'ballistic':1., 'power_law':2.}[tie]
+            guess_exp = global_initial_guesses.get(names[-1], exponent) if tie == 'power_law' else exponent
+            with np.errstate(divide='ignore', invalid='ignore'):
+                coeff = 1./(tau_guess * q_fit**guess_exp)
+            coeff = coeff[np.isfinite(coeff) & (coeff>0)]
+            coeff_guess = np.median(coeff) if len(coeff)>0 else 1.0
+            guesses = [global_initial_guesses.get(names[0], coeff_guess)]
+            lower = [0.]
+            upper = [np.inf]
+            if tie == 'power_law':
+                guesses.append(guess_exp)
+                lower.append(0.)
+                upper.append(4.)
+        else:
+            print(f"Unknown option '{tie}' for parameter '{param_name}'. Options are 'shared', " +
+                  ", ".join(["'%s'" % form for form in tau_vs_q_forms]) + ".")
+            continue
+        tied_forms[param_name] = (j, tie, slice(len(global_names), len(global_names)+len(names)))
+        global_names.extend(names)
+        global_guesses.extend(guesses)
+        global_lower.extend(lower)
+        global_upper.extend(upper)
+    number_of_globals = len(global_names)
+
+    #Parameters that are fit for each q
+    tied_indices = [tied_forms[param_name][0] for param_name in tied_forms]
+    per_q_indices = np.array([j for j in range(spec.number_of_parameters) if j not in tied_indices], dtype=int)
+    number_per_q = len(per_q_indices)
+
+    x0 = np.concatenate((global_guesses, spec.guesses[np.ix_(q_indices, per_q_indices)].ravel()))
+    lower_bounds = np.concatenate((global_lower, spec.lower[np.ix_(q_indices, per_q_indices)].ravel()))
+    upper_bounds = np.concatenate((global_upper, spec.upper[np.ix_(q_indices, per_q_indices)].ravel()))
+    x0 = np.clip(x0, lower_bounds, upper_bounds)
+
+    #Weights for the residuals (zero for lag times not fit)
+    if sigma is None:
+        weights = np.ones((num_times, number_of_qs_to_fit))
+    else:
+        sigma = np.asarray(sigma, dtype=float)
+        if sigma.ndim == 1:
+            sigma = sigma[:,np.newaxis]
+        weights = np.broadcast_to(1./sigma, (num_times, num_qs))[:,q_indices].copy()
+    if last_times is not None:
+        number_fit_per_q = np.broadcast_to(np.asarray(last_times, dtype=int), (num_qs,))[q_indices]
+        weights[np.arange(num_times)[:,np.newaxis] >= number_fit_per_q[np.newaxis,:]] = 0
+    weights[~np.isfinite(weights)] = 0
+    data_to_fit = np.nan_to_num(data_values[:,q_indices])
+
+    def parameters_for_all_qs(x):
+        all_params = np.empty((spec.number_of_parameters, number_of_qs_to_fit))
+        all_params[per_q_indices,:] = x[number_of_globals:].reshape(number_of_qs_to_fit, number_per_q).T
+        for param_name, (j, tie, global_slice) in tied_forms.items():
+            if tie == 'shared':
+                all_params[j,:] = x[global_slice][0]
+            else:
+                all_params[j,:] = tau_vs_q_forms[tie][1](q_fit, *x[global_slice])
+        return all_params
+
+    def residuals(x):
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            theory = models.theory_surface(spec.model_function, times, parameters_for_all_qs(x))
+            res = (data_to_fit - theory) * weights
+        #ordered by q, then lag time, to match the block structure of the Jacobian
+        return np.nan_to_num(res.T.ravel(), nan=1e10, posinf=1e10, neginf=-1e10)
+
+    #Sparsity structure of the Jacobian
+    jac_sparsity = sparse.lil_matrix((number_of_qs_to_fit*num_times, len(x0)), dtype=int)
+    jac_sparsity[:, :number_of_globals] = 1
+    for i in range(number_of_qs_to_fit):
+        jac_sparsity[i*num_times:(i+1)*num_times,
+                     number_of_globals+i*number_per_q:number_of_globals+(i+1)*number_per_q] = 1
+
+    if debug:
+        print("Global parameters: ", dict(zip(global_names, global_guesses)))
+        print("Number of parameters: %i; number of data points: %i" % (len(x0), number_of_qs_to_fit*num_times))
+
+    lsqr_results = least_squares(residuals, x0, bounds=(lower_bounds, upper_bounds),
+                                 jac_sparsity=jac_sparsity, x_scale='jac', max_nfev=maxiter)
+
+    #Covariance of parameters from the Jacobian at the solution
+    number_of_points = np.count_nonzero(weights)
+    jac = lsqr_results.jac
+    jtj = jac.T @ jac
+    if sparse.issparse(jtj):
+        jtj = jtj.toarray()
+    residual_variance = 2*lsqr_results.cost / max(number_of_points - len(x0), 1)
+    param_std = np.sqrt(np.abs(np.diag(np.linalg.pinv(jtj)))*residual_variance)
+
+    global_params = dict(zip(global_names, lsqr_results.x[:number_of_globals]))
+    global_params_std = dict(zip(global_names, param_std[:number_of_globals]))
+
+    best_fit_params = {}
+    fit_params = parameters_for_all_qs(lsqr_results.x)
+    for j, param_name in enumerate(spec.names):
+        best_fit_params[param_name] = np.full(num_qs, np.nan)
+        best_fit_params[param_name][q_indices] = fit_params[j]
+
+    theory = models.theory_surface(spec.model_function, times, [*best_fit_params.values()])
+    if last_times is not None:
+        number_fit_per_q = np.broadcast_to(np.asarray(last_times, dtype=int), (num_qs,))
+        theory[np.arange(num_times)[:,np.newaxis] >= number_fit_per_q[np.newaxis,:]] = np.nan
+
+    if debug:
+        print(lsqr_results.message)
+        print("Best fit global parameters: ", global_params)
+
+    return best_fit_params, theory, global_params, global_params_std
+
+
+def polar_bin_ddm_matrix(ddm_matrix_full, q_x, q_y, q_edges, number_of_angles=12):
+    r"""Averages the full DDM matrix over bins of wavevector magnitude and direction.
+
+    As the DDM matrix is symmetric (:math:`D(\vec{q}) = D(-\vec{q})`), wavevectors
+    are folded onto angles in :math:`[0, \pi)` before binning. The averaging is
+    done for all lag times with one sparse matrix product.
+
+    Parameters
+    ----------
+    ddm_matrix_full : array
+        3D array of shape (lagtime, q_y, q_x)
+    q_x : array
+        1D array, wavevectors along x
+    q_y : array
+        1D array, wavevectors along y
+    q_edges : array
+        1D array, edges of the bins of wavevector magnitude
+    number_of_angles : int, optional
+        Number of bins of direction, over :math:`[0, \pi)`. Default is 12.
+
+    Returns
+    -------
+    binned : array
+        3D array of shape (lagtime, q bin, angle bin). NaN for empty bins.
+    qx_centers : array
+        2D array (q bin, angle bin), mean :math:`q_x` of the (folded) wavevectors in each bin
+    qy_centers : array
+        2D array (q bin, angle bin), mean :math:`q_y` of the (folded) wavevectors in each bin
+    counts : array
+        2D array (q bin, angle bin), number of wavevectors in each bin
+
+    """
+    ddm_matrix_full = np.asarray(ddm_matrix_full)
+    num_times = ddm_matrix_full.shape[0]
+    qx_grid, qy_grid = np.meshgrid(np.asarray(q_x, dtype=float), np.asarray(q_y, dtype=float))
+    #Fold onto the upper half plane
+    flip = (qy_grid < 0) | ((qy_grid == 0) & (qx_grid < 0))
+    qx_grid = np.where(flip, -qx_grid, qx_grid).ravel()
+    qy_grid = np.where(flip, -qy_grid, qy_grid).ravel()
+    angles = np.mod(np.arctan2(qy_grid, qx_grid), np.pi)
+    magnitudes = np.hypot(qx_grid, qy_grid)
+
+    number_of_q_bins = len(q_edges) - 1
+    q_bin = np.digitize(magnitudes, q_edges) - 1
+    angle_bin = np.minimum((angles / np.pi * number_of_angles).astype(int), number_of_angles-1)
+    in_range = (q_bin >= 0) & (q_bin < number_of_q_bins) & (magnitudes > 0)
+    labels = q_bin[in_range]*number_of_angles + angle_bin[in_range]
+    pixels = np.nonzero(in_range)[0]
+    number_of_bins = number_of_q_bins*number_of_angles
+
+    counts = np.bincount(labels, minlength=number_of_bins).astype(float)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        weights = 1. / counts[labels]
+        averaging = sparse.csr_matrix((weights, (labels, pixels)), shape=(number_of_bins, qx_grid.size))
+        binned = (averaging @ ddm_matrix_full.reshape(num_times, -1).T).T
+        qx_centers = averaging @ qx_grid
+        qy_centers = averaging @ qy_grid
+    empty = counts == 0
+    binned[:, empty] = np.nan
+    qx_centers[empty] = np.nan
+    qy_centers[empty] = np.nan
+    shape = (number_of_q_bins, number_of_angles)
+    return (binned.reshape((num_times,) + shape), qx_centers.reshape(shape),
+            qy_centers.reshape(shape), counts.reshape(shape))
+
+
+def _directional_isf(times, qx, qy, diffusion_coeff, velocity_x, velocity_y):
+    #ISF of diffusion plus uniform drift, exp(-D q^2 t) cos(q.v t), shape (lagtime, bins)
+    q_squared = qx**2 + qy**2
+    q_dot_v = qx*velocity_x + qy*velocity_y
+    return np.exp(-diffusion_coeff*q_squared[np.newaxis,:]*times[:,np.newaxis]) * np.cos(q_dot_v[np.newaxis,:]*times[:,np.newaxis])
+
+
+def _directional_amplitude_and_background(data, one_minus_isf, weights):
+    #For fixed D and v, the DDM matrix is linear in A and B: D = A(1-f) + B. The
+    #weighted least squares A and B are found for all bins at once.
+    w = weights[:,np.newaxis]
+    sum_w = np.sum(w)
+    mean_x = np.sum(w*one_minus_isf, axis=0) / sum_w
+    mean_y = np.sum(w*data, axis=0) / sum_w
+    dx = one_minus_isf - mean_x
+    covariance = np.sum(w*dx*(data - mean_y), axis=0)
+    variance = np.sum(w*dx**2, axis=0)
+    amplitude = covariance / np.where(variance > 0, variance, np.inf)
+    background = mean_y - amplitude*mean_x
+    return amplitude, background
+
+
+def fit_ddm_directional(dData, times, qx, qy, sigma=None, initial_guesses=None,
+                        fit_diffusion=True, number_of_speeds=24, number_of_angles=24,
+                        maxiter=None, debug=False):
+    r"""Fits the DDM matrix, binned by wavevector magnitude and direction, with a drift velocity vector.
+
+    The model is
+
+    .. math:: D(\vec{q},\Delta t) = A(\vec{q}) [1 - e^{-D q^2 \Delta t} \cos(\vec{q} \cdot \vec{v} \Delta t)] + B(\vec{q})
+
+    so the ballistic decay time is :math:`1/(\vec{q} \cdot \vec{v})`. A single diffusion
+    coefficient, :math:`D`, and velocity, :math:`\vec{v} = (v_x, v_y)`, are fit to all bins.
+    For given :math:`D` and :math:`\vec{v}` the model is linear in the amplitude and
+    background of each bin, so these are found in closed form (vectorised over bins)
+    and only the 3 global parameters are optimized. Starting values for the velocity
+    are found by evaluating the cost over a grid of speeds and directions.
+
+    The DDM matrix does not change if :math:`\vec{v}` is replaced by :math:`-\vec{v}`, so the
+    direction of the velocity is only determined up to its sign. The velocity
+    returned has :math:`v_y \geq 0`.
+
+    Parameters
+    ----------
+    dData : array
+        DDM matrix, 2D array of shape (lagtime, bins) (e.g., the output of
+        :py:func:`polar_bin_ddm_matrix` reshaped). Bins with NaN are ignored.
+    times : array_like
+        1D array of the lagtimes
+    qx : array
+        1D array, :math:`q_x` of each bin
+    qy : array
+        1D array, :math:`q_y` of each bin
+    sigma : array or None, optional
+        1D array, uncertainty at each lag time. Default is None.
+    initial_guesses : dict or None, optional
+        Initial guesses, with keys from 'DiffusionCoeff', 'Velocity_x' and 'Velocity_y'.
+        If no velocity is given, a grid search is used.
+    fit_diffusion : bool, optional
+        If False, :math:`D` is fixed to its initial guess (default 0, pure drift). Default is True.
+    number_of_speeds : int, optional
+        Number of speeds in the grid search. Default is 24.
+    number_of_angles : int, optional
+        Number of directions in the grid search. Default is 24.
+    maxiter : int or None, optional
+        Passed as `max_nfev` to `scipy.optimize.least_squares`
+    debug : bool, optional
+        If True, prints information about the fit.
+
+    Returns
+    -------
+    global_params : dict
+        Best fit 'DiffusionCoeff', 'Velocity_x' and 'Velocity_y'
+    global_params_std : dict
+        Standard deviations of these, from the Jacobian at the solution
+    amplitude : array
+        1D array, amplitude for each bin
+    background : array
+        1D array, background for each bin
+    theory : array
+        2D array, same shape as `dData`
+
+    """
+    data_values = np.asarray(dData, dtype=float)
+    times = np.asarray(times, dtype=float)
+    qx = np.asarray(qx, dtype=float)
+    qy = np.asarray(qy, dtype=float)
+    bins = np.nonzero(np.all(np.isfinite(data_values), axis=0) & np.isfinite(qx) & np.isfinite(qy))[0]
+    data = data_values[:,bins]
+    qx_fit, qy_fit = qx[bins], qy[bins]
+    if sigma is None:
+        sigma = np.ones(len(times))
+    sigma = np.asarray(sigma, dtype=float).ravel()
+    weights = 1./sigma**2
+    #Each bin is scaled by its mean so that all bins contribute to the cost
+    scale = np.nanmean(np.abs(data), axis=0)
+    scale = np.where(scale > 0, scale, 1.)
+
+    if initial_guesses is None:
+        initial_guesses = {}
+    q_magnitudes = np.hypot(qx_fit, qy_fit)
+    positive_times = times[times > 0]
+
+    def residuals(params):
+        d, vx, vy = params
+        one_minus_isf = 1 - _directional_isf(times, qx_fit, qy_fit, d, vx, vy)
+        amplitude, background = _directional_amplitude_and_background(data, one_minus_isf, weights)
+        return ((data - (amplitude*one_minus_isf + background)) / (sigma[:,np.newaxis]*scale)).ravel()
+
+    if 'DiffusionCoeff' in initial_guesses:
+        d_guess = float(initial_guesses['DiffusionCoeff'])
+    elif fit_diffusion:
+        d_guess = 1./(np.median(q_magnitudes)**2 * np.median(positive_times))
+    else:
+        d_guess = 0.
+    if ('Velocity_x' in initial_guesses) or ('Velocity_y' in initial_guesses):
+        v_guess = [float(initial_guesses.get('Velocity_x', 0)), float(initial_guesses.get('Velocity_y', 0))]
+    else:
+        #Grid search over speed and direction (in [0, pi) as v and -v are equivalent)
+        speeds = np.geomspace(1./(q_magnitudes.max()*positive_times.max()),
+                              1./(q_magnitudes.min()*positive_times.min()), number_of_speeds)
+        directions = np.arange(number_of_angles) * np.pi / number_of_angles
+        candidates = [(speed*np.cos(angle), speed*np.sin(angle)) for speed in speeds for angle in directions]
+        costs = [np.sum(residuals([d_guess, vx, vy])**2) for vx, vy in candidates]
+        v_guess = list(candidates[int(np.argmin(costs))])
+    if debug:
+        print("Initial guesses: D = %.4g, v = (%.4g, %.4g)" % (d_guess, *v_guess))
+
+    if fit_diffusion:
+        x0 = np.array([d_guess, *v_guess])
+        lower = np.array([0, -np.inf, -np.inf])
+        upper = np.array([np.inf, np.inf, np.inf])
+        results = least_squares(residuals, x0, bounds=(lower, upper), x_scale='jac', max_nfev=maxiter)
+        params = results.x
+    else:
+        results = least_squares(lambda v: residuals([d_guess, *v]), np.array(v_guess), x_scale='jac', max_nfev=maxiter)
+        params = np.array([d_guess, *results.x])
+
+    #Standard deviations from the Jacobian
+    jacobian = results.jac
+    dof = max(1, jacobian.shape[0] - jacobian.shape[1])
+    covariance = np.linalg.pinv(jacobian.T @ jacobian) * 2*results.cost / dof
+    std = np.sqrt(np.abs(np.diag(covariance)))
+    if not fit_diffusion:
+        std = np.array([0., *std])
+
+    d, vx, vy = params
+    if (vy < 0) or ((vy == 0) and (vx < 0)):
+        vx, vy = -vx, -vy
+    global_params = {'DiffusionCoeff': d, 'Velocity_x': vx, 'Velocity_y': vy}
+    global_params_std = {'DiffusionCoeff': std[0], 'Velocity_x': std[1], 'Velocity_y': std[2]}
+    if debug:
+        print(results.message)
+        print(global_params)
+
+    num_bins = data_values.shape[1]
+    one_minus_isf = 1 - _directional_isf(times, qx_fit, qy_fit, d, vx, vy)
+    amplitude_fit, background_fit = _directional_amplitude_and_background(data, one_minus_isf, weights)
+    amplitude = np.full(num_bins, np.nan)
+    background = np.full(num_bins, np.nan)
+    theory = np.full(data_values.shape, np.nan)
+    amplitude[bins] = amplitude_fit
+    background[bins] = background_fit
+    theory[:,bins] = amplitude_fit*one_minus_isf + background_fit
+    return global_params, global_params_std, amplitude, background, theory
+
+
+def bootstrap_fit_ddm(dData, times, param_dictionary, best_fit_params, theory,
+                      number_of_resamples=100, q_indices=None, sigma=None,
+                      random_seed=None, number_of_workers=1,
+                      first_use_leastsq=False, use_curvefit_method=True):
+    r"""Residual bootstrap of the fits to the DDM matrix or ISF.
+
+    For each wavevector, the residuals between the data and the best fit theory
+    are resampled (with replacement) and added back to the theory. Each of these
+    `number_of_resamples` synthetic data sets is then fit, starting from the
+    best fit parameters (so the fits converge in a few iterations). The spread of
+    the parameters over the resampled fits gives their uncertainty.
+
+    Parameters
+    ----------
+    dData : array
+        DDM matrix or ISF that was fit, 2D array of shape (lagtime, q)
+    times : array_like
+        1D array of the lagtimes
+    param_dictionary : dict
+        Dictionary (or :py:class:`PyDDM.fit_parameters_dictionaries.ModelSpec`)
+        of the model that was fit. Bounds are widened, where needed, to include the
+        best fit parameters.
+    best_fit_params : array
+        2D array of shape (parameter, q) of the best fit parameters
+    theory : array
+        Best fit theory, 2D array of shape (lagtime, q). Only lag times before the
+        first NaN in the theory (see `last_times` of :py:func:`fit_ddm_all_qs`) are used.
+    number_of_resamples : {100}, optional
+        Number of resampled data sets fit at each q
+    q_indices : {None}, optional
+        Indices of the wavevectors to use. If None (default), all q where the best
+        fit parameters are finite.
+    sigma : {None}, optional
+        Uncertainty of the data, either a 1D array for each lag time or a 2D array 
+        of shape (lagtime, q) (e.g., the standard error of the DDM matrix). If given, 
+        the residuals divided by `sigma` are resampled (then multiplied by `sigma` 
+        at the lag time they are placed at), as the noise depends on the lag time. 
+        Also used to weight the fits.
+    random_seed : {None}, optional
+        Seed for the random number generator
+    number_of_workers : {1}, optional
+        Number of threads used. If greater than 1, the wavevectors are fit in parallel.
+    first_use_leastsq : {False}, optional
+        Passed to :py:func:`fit_ddm`
+    use_curvefit_method : {True}, optional
+        Passed to :py:func:`fit_ddm`
+
+    Returns
+    -------
+    bootstrap_params : array
+        3D array of shape (resample, parameter, q). NaN for wavevectors not used.
+
+    """
+    data_values = np.asarray(dData, dtype=float)
+    theory = np.asarray(theory, dtype=float)
+    times = np.asarray(times)
+    best_fit_params = np.asarray(best_fit_params, dtype=float)
+    num_times, num_qs = data_values.shape
+    spec = fpd.as_model_spec(param_dictionary, num_qs).copy()
+    spec.lower = np.minimum(spec.lower, best_fit_params.T)
+    spec.upper = np.maximum(spec.upper, best_fit_params.T)
+
+    if q_indices is None:
+        q_indices = np.nonzero(np.all(np.isfinite(best_fit_params), axis=0))[0]
+    if sigma is None:
+        sigma = np.ones(num_times)
+    sigma = np.asarray(sigma, dtype=float)
+    if sigma.ndim == 1:
+        sigma = sigma[:,np.newaxis]
+    sigma = np.broadcast_to(sigma, (num_times, num_qs))
+
+    #Resampled data generated before fitting, so results do not depend on number_of_workers
+    rng = np.random.default_rng(random_seed)
+    resampled_data = {}
+    for i in q_indices:
+        number_fit = np.argmax(~np.isfinite(theory[:,i])) if not np.all(np.isfinite(theory[:,i])) else num_times
+        scaled_residuals = (data_values[:number_fit,i] - theory[:number_fit,i]) / sigma[:number_fit,i]
+        picks = rng.integers(0, number_fit, size=(number_of_resamples, number_fit))
+        resampled_data[i] = theory[:number_fit,i] + scaled_residuals[picks] * sigma[:number_fit,i]
+
+    def fit_one_q(i):
+        params = np.full((number_of_resamples, len(spec.names)), np.nan)
+        number_fit = resampled_data[i].shape[1]
+        for b in range(number_of_resamples):
+            params[b], _, _, _ = fit_ddm(resampled_data[i][b], times[:number_fit], spec,
+                                         first_use_leastsq=first_use_leastsq,
+                                         use_curvefit_method=use_curvefit_method,
+                                         sigma=sigma[:number_fit,i], quiet=True, q_index=i,
+                                         initial_guesses=best_fit_params[:,i])
+        return params
+
+    if number_of_workers > 1:
+        with ThreadPoolExecutor(max_workers=number_of_workers) as executor:
+            results_for_each_q = list(executor.map(fit_one_q, q_indices))
+    else:
+        results_for_each_q = [fit_one_q(i) for i in q_indices]
+
+    bootstrap_params = np.full((number_of_resamples, len(spec.names), num_qs), np.nan)
+    for i, params in zip(q_indices, results_for_each_q):
+        bootstrap_params[:,:,i] = params
+    return bootstrap_params
+
+
+def estimate_tau_from_isf_crossing(isf, times, level=np.exp(-1)):
+    r"""Estimates the decay time at all wavevectors without fitting.
+
+    For each wavevector, finds the first lag time at which the ISF drops below
+    `level` (by default, 1/e). The crossing is found by linear interpolation of
+    the ISF versus the logarithm of the lag time. For a (stretched) exponential
+    ISF, :math:`f = \exp[-(\Delta t/\tau)^s]`, the 1/e crossing equals
+    :math:`\tau` regardless of the stretching exponent.
+
+    Parameters
+    ----------
+    isf : array
+        2D array of the ISF; first dimension is lag time, second is wavevector
+    times : array_like
+        1D array of the lagtimes
+    level : float, optional
+        Value of the ISF where the crossing is found. Default is 1/e.
+
+    Returns
+    -------
+    tau : array
+        Estimated decay time for each wavevector. Is NaN where the ISF does not
+        cross `level` or is already below it at the first lag time.
+
+    """
+    isf = np.asarray(isf, dtype=float)
+    log_times = np.log(np.asarray(times, dtype=float))
+    num_qs = isf.shape[1]
+
+    below = isf < level
+    crosses = below.any(axis=0)
+    k = np.argmax(below, axis=0) #index of first lag time below 'level'
+    valid = crosses & (k > 0)
+    k_prev = np.clip(k-1, 0, None)
+    q_indices = np.arange(num_qs)
+    f_prev = isf[k_prev, q_indices]
+    f_next = isf[k, q_indices]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fraction = (f_prev - level) / (f_prev - f_next)
+    log_tau = log_times[k_prev] + fraction * (log_times[k] - log_times[k_prev])
+    tau = np.where(valid, np.exp(log_tau), np.nan)
+    return tau
+
+
+def estimate_tau_from_isf_integral(isf, times):
+    r"""Estimates the mean decay time at all wavevectors without fitting.
+
+    The integral of the ISF over lag time gives the mean relaxation time. For
+    a stretched exponential,
+
+    .. math:: \int_0^\infty e^{-(\Delta t/\tau)^s} d\Delta t = \frac{1}{s} \Gamma \left( \frac{1}{s} \right) \tau
+
+    which is what the function `newt` returns. The integral is evaluated with
+    the trapezoid rule, using :math:`f(q, 0) = 1`, and is truncated at the
+    first lag time where the ISF drops below zero (where it is dominated by noise).
+
+    Parameters
+    ----------
+    isf : array
+        2D array of the ISF; first dimension is lag time, second is wavevector
+    times : array_like
+        1D array of the lagtimes
+
+    Returns
+    -------
+    mean_tau : array
+        Estimated mean decay time for each wavevector. Is NaN if the ISF does
+        not decay to below 1/e within the range of lag times.
+
+    """
+    isf = np.asarray(isf, dtype=float)
+    times = np.asarray(times, dtype=float)
+    num_qs = isf.shape[1]
+
+    #Include the point f(q, 0) = 1
+    isf = np.concatenate((np.ones((1,num_qs)), isf), axis=0)
+    times = np.concatenate(([0.], times))
+
+    #Only integrate up to where the ISF first goes negative
+    negative = np.concatenate((np.zeros((1,num_qs),dtype=bool), isf[1:] < 0), axis=0)
+    after_first_negative = np.cumsum(negative, axis=0) > 0
+    isf = np.where(after_first_negative | np.isnan(isf), 0, isf)
+
+    dt = np.diff(times)[:,np.newaxis]
+    mean_tau = np.sum(0.5 * (isf[1:] + isf[:-1]) * dt, axis=0)
+
+    #If the ISF has not decayed much, the integral underestimates the mean decay time
+    decayed = np.any(isf[1:] < np.exp(-1), axis=0)
+    return np.where(decayed, mean_tau, np.nan)
+
+
+def find_last_times_from_isf_plateau(isf, times, num_sigma=2.0, tail_fraction=0.2,
+                                     extend_factor=3.0, min_number_of_times=10):
+    r"""Finds, for each wavevector, how many lag times are worth fitting.
+
+    At high wavevectors the ISF decays to a plateau within a few lag times; the
+    remaining lag times add little but noise (and time) to the fit. Here, the
+    plateau value and its noise are taken as the mean and standard deviation of
+    the ISF over the longest lag times. The ISF is taken to have reached the
+    plateau at the first lag time where it is within `num_sigma` standard
+    deviations of the plateau value. Lag times up to `extend_factor` times that
+    lag time are kept so that the plateau is still represented in the fit.
+
+    Parameters
+    ----------
+    isf : array
+        2D array of the ISF; first dimension is lag time, second is wavevector
+    times : array_like
+        1D array of the lagtimes
+    num_sigma : float, optional
+        Number of standard deviations from the plateau value. Default is 2.
+    tail_fraction : float, optional
+        Fraction of lag times (the longest ones) used to find the plateau value
+        and noise. Default is 0.2.
+    extend_factor : float, optional
+        Keep lag times up to this factor times the lag time at which the
+        plateau is reached. Default is 3.
+    min_number_of_times : int, optional
+        Minimum number of lag times kept for any wavevector. Default is 10.
+
+    Returns
+    -------
+    last_times : array
+        For each wavevector, the number of lag times to fit. Can be passed as
+        `last_times` to :py:func:`fit_ddm_all_qs`.
+
+    """
+    isf = np.asarray(isf, dtype=float)
+    times = np.asarray(times, dtype=float)
+    num_times = isf.shape[0]
+
+    number_in_tail = max(3, int(np.ceil(tail_fraction*num_times)))
+    tail = isf[-number_in_tail:]
+    plateau = np.nanmean(tail, axis=0)
+    noise = np.nanstd(tail, axis=0)
+
+    within_noise = np.abs(isf - plateau) <= (num_sigma * noise)
+    reached = within_noise.any(axis=0)
+    first_index = np.where(reached, np.argmax(within_noise, axis=0), num_times-1)
+
+    last_times = np.searchsorted(times, extend_factor*times[first_index], side='right')
+    last_times = np.clip(last_times, min(min_number_of_times, num_times), num_times)
+    return last_times.astype(int)
+
+
+def find_informative_q_range(amplitude, background, estimated_taus,
+                             min_amplitude_over_background=1.0):
+    r"""Finds the range of wavevectors worth fitting.
+
+    A wavevector is considered informative if the amplitude, :math:`A(q)`, is
+    at least `min_amplitude_over_background` times the background, :math:`B(q)`,
+    and if the estimated decay time is finite (i.e., the ISF decays through 1/e
+    within the range of lag times; see :py:func:`estimate_tau_from_isf_crossing`).
+    The longest contiguous run of informative wavevectors is returned. The
+    wavevector with index 0 is never included.
+
+    Parameters
+    ----------
+    amplitude : array
+        1D array of the amplitude, A(q)
+    background : array or float
+        Background, B(q), either 1D array or a single value
+    estimated_taus : array
+        1D array of estimated decay times
+    min_amplitude_over_background : float, optional
+        Default is 1.
+
+    Returns
+    -------
+    q_range : list or None
+        Lower and upper index of the wavevectors. As for the 'Good_q_range', the
+        upper index is not included (i.e., use as q[q_range[0]:q_range[1]]). Returns
+        None if no wavevector is informative.
+
+    """
+    amplitude = np.asarray(amplitude, dtype=float)
+    background = np.broadcast_to(np.asarray(background, dtype=float), amplitude.shape)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        informative = (amplitude / background) >= min_amplitude_over_background
+    informative = informative & np.isfinite(np.asarray(estimated_taus, dtype=float))
+    informative[0] = False
+
+    #Find the longest run of informative wavevectors
+    padded = np.concatenate(([0], informative.astype(int), [0]))
+    edges = np.flatnonzero(np.diff(padded))
+    if len(edges) == 0:
+        return None
+    starts, ends = edges[0::2], edges[1::2]
+    longest = np.argmax(ends - starts)
+    return [int(starts[longest]), int(ends[longest])]
+
+
+def estimate_diffusion_coeff_from_taus(q, tau, q_range=None):
+    r"""Estimates the diffusion coefficient from decay times
+
+    Assuming :math:`\tau = 1/(D q^2)`, returns the median over the wavevectors
+    of :math:`1/(\tau q^2)`.
+
+    Parameters
+    ----------
+    q : array
+        1D array of wavevectors
+    tau : array
+        1D array of decay times
+    q_range : list or None, optional
+        If given, two integers indicating the lower and upper index of the
+        wavevectors to use (upper index not included, as with 'Good_q_range').
+        Default is None (use all with a finite decay time).
+
+    Returns
+    -------
+    diffusion_coeff : float
+        Estimated diffusion coefficient. NaN if no decay times are usable.
+
+    """
+    q = np.asarray(q, dtype=float)
+    tau = np.asarray(tau, dtype=float)
+    if q_range is not None:
+        q = q[q_range[0]:q_range[1]]
+        tau = tau[q_range[0]:q_range[1]]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        d_values = 1./(tau * q * q)
+    d_values = d_values[np.isfinite(d_values) & (d_values > 0)]
+    if len(d_values) == 0:
+        return np.nan
+    return np.median(d_values)
+
+
+def information_criteria(data, theory, number_of_free_parameters):
+    r"""Akaike and Bayesian information criteria of the fit at each wavevector
+
+    With :math:`n` the number of lag times fit, :math:`RSS` the residual sum
+    of squares and :math:`k` the number of free parameters,
+    :math:`AIC = n \ln(RSS/n) + 2k` and :math:`BIC = n \ln(RSS/n) + k \ln(n)`.
+    Lag times where the theory is NaN (e.g., beyond the last time fit) are not
+    counted. Differences of these between models fit to the same data
+    indicate which model is preferred (lower is better).
+
+    Parameters
+    ----------
+    data : array
+        DDM matrix or ISF, 2D array of shape (lagtime, q)
+    theory : array
+        Best fit theory, same shape as `data`
+    number_of_free_parameters : int
+        Number of parameters that were not fixed in the fit
+
+    Returns
+    -------
+    aic : array
+        1D array, AIC for each q (NaN where nothing was fit)
+    bic : array
+        1D array, BIC for each q (NaN where nothing was fit)
+    number_of_points : array
+        1D array, number of lag times fit for each q
+
+    """
+    data = np.asarray(data, dtype=float)
+    theory = np.asarray(theory, dtype=float)
+    valid = np.isfinite(data) & np.isfinite(theory)
+    number_of_points = valid.sum(axis=0)
+    rss = np.where(valid, (data - theory)**2, 0).sum(axis=0)
+    k = number_of_free_parameters
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_likelihood_term = number_of_points * np.log(rss / number_of_points)
+        aic = log_likelihood_term + 2*k
+        bic = log_likelihood_term + k*np.log(number_of_points)
+    unusable = (number_of_points <= k) | (rss <= 0)
+    aic[unusable] = np.nan
+    bic[unusable] = np.nan
+    return aic, bic, number_of_points
+
+
+def relaxation_time_distribution(isf, times, tau_grid=None, number_of_taus=100,
+                                 regularization=None, regularization_method='gcv',
+                                 number_of_regularizations=40, fit_baseline=True,
+                                 q_indices=None):
+    r"""Distribution of relaxation times from the ISF (CONTIN-like inverse Laplace transform)
+
+    At each wavevector, the ISF is written as a non-negative combination of
+    exponential decays over a fixed, logarithmically spaced, grid of decay times
+
+    .. math:: f(q,\Delta t) = \sum_j P_j(q) \exp(-\Delta t/\tau_j) + c(q)
+
+    where :math:`c` is an optional baseline. The :math:`P_j \geq 0` are found by
+    non-negative least squares with a Tikhonov penalty, :math:`\lambda^2 ||L P||^2`,
+    on the second differences of :math:`P` (so the distribution is smooth). As the
+    kernel, :math:`\exp(-\Delta t/\tau_j)`, is the same at all q it is computed once.
+    The regularization parameter, :math:`\lambda`, is chosen at each q by generalized
+    cross validation ('gcv') or the corner of the L-curve ('lcurve'). For this, the
+    unconstrained solutions for all q and all candidate :math:`\lambda` are found
+    with a few matrix products.
+
+    Parameters
+    ----------
+    isf : array
+        ISF, 2D array of shape (lagtime, q)
+    times : array
+        1D array of lag times
+    tau_grid : array or None, optional
+        Decay times of the distribution. If None (default), `number_of_taus` values
+        logarithmically spaced from half the shortest to twice the longest lag time.
+    number_of_taus : int, optional
+        Default is 100.
+    regularization : float or None, optional
+        If given, this value of :math:`\lambda` (relative to the largest singular
+        value of the kernel) is used at all q. Default is None.
+    regularization_method : {'gcv', 'lcurve'}, optional
+        How :math:`\lambda` is chosen if `regularization` is None. Default is 'gcv'.
+    number_of_regularizations : int, optional
+        Number of candidate values of :math:`\lambda` (from 1e-4 to 10, relative
+        to the largest singular value of the kernel). Default is 40.
+    fit_baseline : bool, optional
+        If True (default), a constant baseline :math:`c(q)` is also fit.
+    q_indices : array or None, optional
+        Indices of the wavevectors to use. Default is None (all). Wavevectors 
+        where the ISF is not finite at any lag time are skipped.
+
+    Returns
+    -------
+    distribution : array or None
+        2D array of shape (q, tau). NaN for wavevectors not used. The function 
+        returns None if there are not enough lag times with data at all q used.
+    tau_grid : array
+        1D array of the decay times
+    regularization : array
+        1D array, :math:`\lambda` used at each q (relative to the largest singular
+        value of the kernel)
+    baseline : array
+        1D array, the baseline at each q (0 if `fit_baseline` is False)
+    isf_fit : array
+        2D array of shape (lagtime, q), the ISF from the distribution
+
+    """
+    isf = np.asarray(isf, dtype=float)
+    times = np.asarray(times, dtype=float)
+    num_times, num_qs = isf.shape
+    if q_indices is None:
+        q_indices = np.arange(num_qs)
+    q_indices = np.asarray(q_indices, dtype=int)
+    if tau_grid is None:
+        tau_grid = np.geomspace(times[times>0].min()/2, times.max()*2, number_of_taus)
+    tau_grid = np.asarray(tau_grid, dtype=float)
+    number_of_taus = len(tau_grid)
+
+    #Wavevectors without any data (e.g., q=0, where the ISF is NaN) would leave no lag times
+    q_indices = q_indices[np.any(np.isfinite(isf[:,q_indices]), axis=0)]
+    #Lag times with data at all q used
+    rows = np.all(np.isfinite(isf[:,q_indices]), axis=1)
+    if (len(q_indices) == 0) or (np.sum(rows) < 2):
+        print("Not enough lag times where the ISF is finite at all q used.")
+        return None
+    data = isf[rows][:,q_indices]
+
+    #Kernel (shared by all q) and second-difference operator
+    kernel = np.exp(-times[rows,np.newaxis] / tau_grid[np.newaxis,:])
+    if fit_baseline:
+        kernel = np.hstack([kernel, np.ones((kernel.shape[0],1))])
+    number_of_unknowns = kernel.shape[1]
+    second_difference = np.diff(np.eye(number_of_taus), n=2, axis=0)
+    smoothing = np.zeros((number_of_taus-2, number_of_unknowns))
+    smoothing[:,:number_of_taus] = second_difference
+    scale = np.linalg.norm(kernel, ord=2)
+
+    if regularization is not None:
+        regularization_at_each_q = np.full(len(q_indices), float(regularization))
+    else:
+        candidates = np.logspace(-4, 1, number_of_regularizations)
+        kernel_gram = kernel.T @ kernel
+        smoothing_gram = smoothing.T @ smoothing
+        kernel_t_data = kernel.T @ data
+        scores = np.empty((number_of_regularizations, len(q_indices)))
+        residual_norms = np.empty_like(scores)
+        solution_norms = np.empty_like(scores)
+        for k, lam in enumerate(candidates):
+            #Unconstrained solution for all q at once. The matrix is regularized
+            #so a pseudo-inverse is only needed for the baseline column.
+            inverse = np.linalg.pinv(kernel_gram + (lam*scale)**2 * smoothing_gram)
+            solutions = inverse @ kernel_t_data
+            residuals = data - kernel @ solutions
+            residual_norms[k] = np.sum(residuals**2, axis=0)
+            solution_norms[k] = np.sum((smoothing @ solutions)**2, axis=0)
+            if regularization_method == 'gcv':
+                effective_dof = data.shape[0] - np.trace(inverse @ kernel_gram)
+                scores[k] = data.shape[0] * residual_norms[k] / effective_dof**2
+        if regularization_method == 'gcv':
+            best = np.argmin(scores, axis=0)
+        elif regularization_method == 'lcurve':
+            #Corner of the L-curve: point of maximum curvature of (log residual norm, log solution norm)
+            x = np.log(residual_norms + 1e-300)
+            y = np.log(solution_norms + 1e-300)
+            s = np.log(candidates)[:,np.newaxis]
+            dx, dy = np.gradient(x, s[:,0], axis=0), np.gradient(y, s[:,0], axis=0)
+            ddx, ddy = np.gradient(dx, s[:,0], axis=0), np.gradient(dy, s[:,0], axis=0)
+            curvature = (dx*ddy - ddx*dy) / (dx**2 + dy**2 + 1e-300)**1.5
+            best = np.argmax(curvature, axis=0)
+        else:
+            print("regularization_method must be 'gcv' or 'lcurve'.")
+            return None
+        regularization_at_each_q = candidates[best]
+
+    #Non-negative least squares with the Tikhonov penalty as extra rows. The
+    #baseline may be negative, so it is split into positive and negative parts.
+    if fit_baseline:
+        kernel_nn = np.hstack([kernel, -kernel[:,-1:]])
+        smoothing_nn = np.hstack([smoothing, np.zeros((smoothing.shape[0],1))])
+    else:
+        kernel_nn = kernel
+        smoothing_nn = smoothing
+    distribution = np.full((num_qs, number_of_taus), np.nan)
+    baseline = np.zeros(num_qs)
+    regularization_out = np.full(num_qs, np.nan)
+    padding = np.zeros(smoothing_nn.shape[0])
+    for j, i in enumerate(q_indices):
+        lam = regularization_at_each_q[j]
+        solution, _ = nnls(np.vstack([kernel_nn, lam*scale*smoothing_nn]),
+                           np.concatenate([data[:,j], padding]))
+        distribution[i] = solution[:number_of_taus]
+        if fit_baseline:
+            baseline[i] = solution[number_of_taus] - solution[number_of_taus+1]
+        regularization_out[i] = lam
+
+    isf_fit = np.full((num_times, num_qs), np.nan)
+    full_kernel = np.exp(-times[:,np.newaxis] / tau_grid[np.newaxis,:])
+    isf_fit[:,q_indices] = full_kernel @ distribution[q_indices].T + baseline[q_indices]
+    return distribution, tau_grid, regularization_out, baseline, isf_fit
+
+
 def generate_mask(im, centralAngle, angRange):
     r"""Generates a mask of the same size as `im` to avoid radially averaging the 
     whole DDM matrix.
@@ -1093,7 +2848,8 @@ def find_radial_average(im, mask=None, centralAngle=None, angRange=None,
 def radial_avg_ddm_matrix(ddm_matrix, mask=None,
                           centralAngle=None, angRange=None,
                           remove_vert_line=True,
-                          remove_hor_line=False):
+                          remove_hor_line=False,
+                          return_counts=False):
     r"""Radially averages DDM matrix. 
     
     For DDM analysis, if we can assume isotropic dynamics, we radially average 
@@ -1114,6 +2870,8 @@ def radial_avg_ddm_matrix(ddm_matrix, mask=None,
         DESC
     remove_vert_line : {True}, optional
         DESC
+    return_counts : {False}, optional
+        If True, also returns the number of pixels averaged for each q.
         
     Return
     ------
@@ -1121,6 +2879,8 @@ def radial_avg_ddm_matrix(ddm_matrix, mask=None,
         Radially averaged DDM matrix. This will be a 2D array. The first dimension 
         corresponds to the lag time. The second dimension corresponds to the 
         magnitude of the wavevector. 
+    counts : array
+        Only if `return_counts` is True. Number of pixels averaged for each q.
     
     
     """
@@ -1154,9 +2914,45 @@ def radial_avg_ddm_matrix(ddm_matrix, mask=None,
         array_to_radial_avg = ddm_matrix[i].copy()
         h = np.histogram(dists[mask==1], bins, weights=array_to_radial_avg[mask==1])[0]
         ravs[i] = h/histo_of_bins
+    if return_counts:
+        return ravs, histo_of_bins
     return ravs
 
 
+def radial_avg_ddm_stderr(ddm_stderr, mask=None, centralAngle=None, angRange=None,
+                          remove_vert_line=True, remove_hor_line=False):
+    r"""Standard error of the radially averaged DDM matrix.
+
+    From the standard error at each pixel of the DDM matrix (see the `return_stderr`
+    option of :py:func:`computeDDMMatrix`), finds the standard error of the radial
+    average. Pixels at :math:`\vec{q}` and :math:`-\vec{q}` are not independent (the
+    Fourier transform of a real image is symmetric), so the number of independent
+    pixels at each q is taken to be half the number averaged.
+
+    Parameters
+    ----------
+    ddm_stderr : array
+        3D array, standard error of the DDM matrix (lag time, and the two
+        components of the wavevector)
+    mask, centralAngle, angRange, remove_vert_line, remove_hor_line : optional
+        As for :py:func:`radial_avg_ddm_matrix`
+
+    Returns
+    -------
+    ravs_stderr : array
+        2D array, standard error of the radially averaged DDM matrix (lag time, q).
+        NaN where not available.
+
+    """
+    variance_avg, counts = radial_avg_ddm_matrix(np.asarray(ddm_stderr)**2, mask=mask,
+                                                 centralAngle=centralAngle, angRange=angRange,
+                                                 remove_vert_line=remove_vert_line,
+                                                 remove_hor_line=remove_hor_line,
+                                                 return_counts=True)
+    number_independent = np.maximum(counts/2., 1.)
+    return np.sqrt(variance_avg / number_independent[np.newaxis,:])
+
+
 def get_MSD_from_DDM_data(q, A, D, B, qrange_to_avg):
     r"""
     Finds the mean squared displacement (MSD) from the DDM matrix as well as values
@@ -1200,7 +2996,7 @@ def get_MSD_from_DDM_data(q, A, D, B, qrange_to_avg):
     msd_stddev = msd[qrange_to_avg[0]:qrange_to_avg[1],:].std(axis=0)
     return msd_mean, msd_stddev
 
-def getPhase_phiDM(im, use_gf=True, gfsize=3):
+def getPhase_phiDM(im, use_gf=True, gfsize=3, window=None):
     r'''
     
 
@@ -1212,6 +3008,10 @@ def getPhase_phiDM(im, use_gf=True, gfsize=3):
         To use Gaussian filter on images or not. Default is True
     gfsize : int, optional
         Size of Gaussian filter. Default is 3. 
+    window : ndarray or None, optional
+        Windowing function (see :py:func:`window_function`) to multiply each image 
+        by before filtering. Applied one frame at a time, so the windowed stack is 
+        never held in memory. Default is None (no windowing). 
 
 
     Returns
@@ -1225,20 +3025,16 @@ def getPhase_phiDM(im, use_gf=True, gfsize=3):
     #get dimension of images
     nFrames,ndx,ndy = im.shape
     
-    #make empty array
-    fft_images = np.zeros((nFrames, ndx, ndy),dtype=np.complex128)
-    
     #make empty array for phase information
     phase = np.zeros((nFrames, ndx, ndy), dtype=np.float64)
     
     #loop over all frames in the stack of images
     for i in range(nFrames):
+        frame = im[i] if window is None else im[i]*window
         if use_gf:
-            frame = gf(im[i],gfsize) #do Gaussian filtering
-        else:
-            frame = im[i]
-        fft_images[i] = np.fft.fftshift(np.fft.fft2(frame-frame.mean()))/(ndx*ndy)
-        phase[i] = np.angle(fft_images[i]) #find phase of Fourier transformed image
+            frame = gf(frame,gfsize) #do Gaussian filtering
+        fft_image = np.fft.fftshift(np.fft.fft2(frame-frame.mean()))/(ndx*ndy)
+        phase[i] = np.angle(fft_image) #find phase of Fourier transformed image
         
     return phase
 
@@ -437,6 +437,179 @@ fitting_models['ISF - Ballistic'] = isf_ballistic
 fitting_models['ISF - Double Ballistic'] = isf_double_ballistic
 fitting_models['ISF - Single Exponential - NonErgodic'] = isf_single_exponential_nonerg
 
+###############################################################################
+# Compiled form of a model's parameter dictionary, used when fitting.         #
+###############################################################################
+
+class ModelSpec:
+    r"""
+    Compact, array-based form of a model's parameter dictionary.
+
+    The dictionaries in :py:data:`fitting_models` store the parameters as a list
+    of dictionaries (one per parameter). That is convenient for setting up a fit
+    but slow to walk over for every wavevector. A `ModelSpec` is built once from
+    such a dictionary and holds the initial guesses, the bounds and which
+    parameters are fixed as arrays of shape (number of q, number of parameters).
+    The guesses and bounds for a given q are then just rows of these arrays.
+
+    Parameters
+    ----------
+    parameter_dictionary : dict
+        Dictionary for a given model, e.g. an entry of :py:data:`fitting_models`
+    number_of_qs : int, optional
+        Number of wavevectors. The default is 1.
+
+    Attributes
+    ----------
+    names : list[str]
+        Names of the parameters
+    guesses : array
+        Initial guesses, shape (number_of_qs, number_of_parameters)
+    lower : array
+        Lower bounds, shape (number_of_qs, number_of_parameters)
+    upper : array
+        Upper bounds, shape (number_of_qs, number_of_parameters)
+    fixed : array
+        Boolean array, shape (number_of_qs, number_of_parameters)
+    model_function : function
+        Function for calculating the theoretical model
+    data_to_use : str
+        Either 'DDM Matrix' or 'ISF'
+
+    """
+    __slots__ = ('names', 'guesses', 'lower', 'upper', 'fixed',
+                 'model_function', 'data_to_use')
+
+    def __init__(self, parameter_dictionary, number_of_qs=1):
+        param_info = parameter_dictionary['parameter_info']
+        self.names = [param['parname'] for param in param_info]
+        values = np.array([param['value'] for param in param_info], dtype=float)
+        mins = np.array([param['limits'][0] for param in param_info], dtype=float)
+        maxs = np.array([param['limits'][1] for param in param_info], dtype=float)
+        fixed = np.array([bool(param['fixed']) for param in param_info])
+        self.guesses = np.tile(values, (number_of_qs, 1))
+        self.lower = np.tile(mins, (number_of_qs, 1))
+        self.upper = np.tile(maxs, (number_of_qs, 1))
+        self.fixed = np.tile(fixed, (number_of_qs, 1))
+        self.model_function = parameter_dictionary.get('model_function')
+        self.data_to_use = parameter_dictionary.get('data_to_use')
+
+    def __repr__(self):
+        return f"<ModelSpec parameters={self.names} number_of_qs={self.number_of_qs}>"
+
+    def __getitem__(self, key):
+        #Read-only view with the same keys as the model dictionaries. The
+        #'parameter_info' returned is the one for the first wavevector.
+        if key == 'model_function':
+            return self.model_function
+        elif key == 'data_to_use':
+            return self.data_to_use
+        elif key == 'parameter_info':
+            return self.parameter_info(0)
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in ('model_function', 'data_to_use', 'parameter_info')
+
+    @property
+    def number_of_qs(self):
+        return self.guesses.shape[0]
+
+    @property
+    def number_of_parameters(self):
+        return self.guesses.shape[1]
+
+    def copy(self):
+        r"""Returns a copy (arrays are copied, the model function is shared)."""
+        new_spec = ModelSpec.__new__(ModelSpec)
+        new_spec.names = list(self.names)
+        new_spec.guesses = self.guesses.copy()
+        new_spec.lower = self.lower.copy()
+        new_spec.upper = self.upper.copy()
+        new_spec.fixed = self.fixed.copy()
+        new_spec.model_function = self.model_function
+        new_spec.data_to_use = self.data_to_use
+        return new_spec
+
+    def index(self, param_name):
+        r"""
+        Index of the parameter `param_name`, or None if the model does not
+        have this parameter.
+        """
+        if param_name in self.names:
+            return self.names.index(param_name)
+        return None
+
+    def initial_guesses(self, q_index=0):
+        r"""Initial guesses for the wavevector with index `q_index`."""
+        return self.guesses[q_index]
+
+    def bounds(self, q_index=0):
+        r"""Lower and upper bounds for the wavevector with index `q_index`."""
+        return self.lower[q_index], self.upper[q_index]
+
+    def set_guesses_per_q(self, param_name, new_values, q_mask=None,
+                          update_limits=False, limits_fraction=0.1):
+        r"""
+        Sets the initial guess of one parameter for all wavevectors at once.
+
+        Parameters
+        ----------
+        param_name : str
+            Name of the parameter
+        new_values : array
+            1D array (one value per q) of the new initial guesses
+        q_mask : array, optional
+            Boolean array. Only the wavevectors where this is True are updated.
+            The default is None (all wavevectors are updated).
+        update_limits : bool, optional
+            If True, the bounds are set to `new_values` times (1 -/+ `limits_fraction`).
+            If False (the default), the initial guess is only updated where
+            the new value lies within the existing bounds.
+        limits_fraction : float, optional
+            See `update_limits`. The default is 0.1.
+
+        """
+        j = self.index(param_name)
+        if j is None:
+            return
+        new_values = np.broadcast_to(np.asarray(new_values, dtype=float), (self.number_of_qs,))
+        if q_mask is None:
+            q_mask = np.ones(self.number_of_qs, dtype=bool)
+        q_mask = q_mask & np.isfinite(new_values)
+        if update_limits:
+            self.lower[q_mask,j] = new_values[q_mask] * (1-limits_fraction)
+            self.upper[q_mask,j] = new_values[q_mask] * (1+limits_fraction)
+            self.guesses[q_mask,j] = new_values[q_mask]
+        else:
+            within_limits = q_mask & (new_values>=self.lower[:,j]) & (new_values<=self.upper[:,j])
+            self.guesses[within_limits,j] = new_values[within_limits]
+
+    def parameter_info(self, q_index=0):
+        r"""
+        List of dictionaries (in the style of the `parameter_info` key of the
+        dictionaries in :py:data:`fitting_models`) for the wavevector with
+        index `q_index`.
+        """
+        param_info = []
+        for j,name in enumerate(self.names):
+            param_info.append({'n': j, 'value': self.guesses[q_index,j],
+                               'limits': [self.lower[q_index,j], self.upper[q_index,j]],
+                               'limited': [True,True], 'fixed': bool(self.fixed[q_index,j]),
+                               'parname': name, 'error': 0, 'step':0})
+        return param_info
+
+
+def as_model_spec(parameter_dictionary, number_of_qs=1):
+    r"""
+    Returns `parameter_dictionary` compiled to a :py:class:`ModelSpec`. If it
+    already is a :py:class:`ModelSpec`, it is returned as is.
+    """
+    if isinstance(parameter_dictionary, ModelSpec):
+        return parameter_dictionary
+    return ModelSpec(parameter_dictionary, number_of_qs)
+
+
 ###############################################################################
 # Below are functions for working with the fitting.                           #
 ###############################################################################
@@ -715,7 +888,7 @@ def populate_min_and_max_of_paramters(parameter_dictionary, minp, maxp):
         print("Paramter dictionary must have key of 'parameter_info'")
         return 0
     
-def extract_array_of_parameter_values(parameter_dictionary):
+def extract_array_of_parameter_values(parameter_dictionary, q_index=0):
     r"""
     From a parameter dictionary, return array of the initial guesses for 
     the parameters. 
@@ -724,6 +897,9 @@ def extract_array_of_parameter_values(parameter_dictionary):
     ----------
     parameter_dictionary : dict
         Parameter dictionary for a given model.
+    q_index : int, optional
+        Only used if `parameter_dictionary` is a :py:class:`ModelSpec`. Index
+        of the wavevector. The default is 0.
 
     Returns
     -------
@@ -731,6 +907,8 @@ def extract_array_of_parameter_values(parameter_dictionary):
         Values of the parameters.
 
     """
+    if isinstance(parameter_dictionary, ModelSpec):
+        return parameter_dictionary.initial_guesses(q_index).copy()
     parameter_values = []
     if 'parameter_info' in parameter_dictionary:
         for i,param in enumerate(parameter_dictionary['parameter_info']):
@@ -740,7 +918,7 @@ def extract_array_of_parameter_values(parameter_dictionary):
         return 0
     return np.array(parameter_values)
 
-def extract_array_of_param_mins_maxes(parameter_dictionary):
+def extract_array_of_param_mins_maxes(parameter_dictionary, q_index=0):
     r"""
     From a parameter dictionary, return two arrays: first corresponds to 
     the lower bounds; second to upper bounds. 
@@ -749,6 +927,9 @@ def extract_array_of_param_mins_maxes(parameter_dictionary):
     ----------
     parameter_dictionary : dict
         Parameter dictionary for a given model.
+    q_index : int, optional
+        Only used if `parameter_dictionary` is a :py:class:`ModelSpec`. Index
+        of the wavevector. The default is 0.
 
     Returns
     -------
@@ -758,6 +939,8 @@ def extract_array_of_param_mins_maxes(parameter_dictionary):
         Upper bounds for all parameters
 
     """
+    if isinstance(parameter_dictionary, ModelSpec):
+        return tuple(b.copy() for b in parameter_dictionary.bounds(q_index))
     parameter_mins = []
     parameter_maxes = []
     if 'parameter_info' in parameter_dictionary:
@@ -770,7 +953,7 @@ def extract_array_of_param_mins_maxes(parameter_dictionary):
     return np.array(parameter_mins), np.array(parameter_maxes)
 
 
-def extract_array_of_fixed_or_not(parameter_dictionary):
+def extract_array_of_fixed_or_not(parameter_dictionary, q_index=0):
     r"""
     From a parameter dicionary, return an array specifying whether 
     the parameters are fixed (True) or not (False)
@@ -779,6 +962,9 @@ def extract_array_of_fixed_or_not(parameter_dictionary):
     ----------
     parameter_dictionary : dict
         Parameter dictionary for a given model.
+    q_index : int, optional
+        Only used if `parameter_dictionary` is a :py:class:`ModelSpec`. Index
+        of the wavevector. The default is 0.
 
     Returns
     -------
@@ -786,6 +972,8 @@ def extract_array_of_fixed_or_not(parameter_dictionary):
         Array of type bool
 
     """
+    if isinstance(parameter_dictionary, ModelSpec):
+        return parameter_dictionary.fixed[q_index].copy()
     fixed_parameters = []
     if 'parameter_info' in parameter_dictionary:
         for i,param in enumerate(parameter_dictionary['parameter_info']):
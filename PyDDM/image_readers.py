@@ -0,0 +1,883 @@
+"""
+Reading of image stacks for DDM analysis.
+
+The readers here only read the frames (and, where possible, the pixels) that will be
+analyzed rather than loading the whole movie and then selecting frames and cropping.
+"""
+import os
+import re
+import glob
+import itertools
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from skimage import io
+try:
+    import tifffile #use 'pip install tifffile' or 'conda install -c conda-forge tifffile'
+    able_to_use_tifffile = True
+except ModuleNotFoundError:
+    print("tifffile not installed. TIFF stacks will be fully loaded with skimage.")
+    able_to_use_tifffile = False
+try:
+    import imageio #use 'conda install -c conda-forge imageio' and 'conda install -c conda-forge imageio-ffmpeg'
+    able_to_use_imageio = True
+except ModuleNotFoundError:
+    print("imageio not installed. mp4 files cannot be read.")
+    able_to_use_imageio = False
+try:
+    from nd2reader import ND2Reader #https://github.com/Open-Science-Tools/nd2reader
+    able_to_use_nd2reader = True
+except ModuleNotFoundError:
+    able_to_use_nd2reader = False
+
+
+def _crop_slices(crop_region):
+    #Slices along y and x for a crop region given as [y1,y2,x1,x2] (or None)
+    if crop_region is None:
+        return slice(None), slice(None)
+    return slice(crop_region[0], crop_region[1]), slice(crop_region[2], crop_region[3])
+
+
+#File extensions of the frames of an image sequence, when given a directory
+image_sequence_extensions = ('.tif', '.tiff', '.png', '.jpg', '.jpeg', '.bmp')
+
+
+def _natural_sort_key(filename):
+    #So that, e.g., 'frame_2.png' comes before 'frame_10.png'
+    return [int(part) if part.isdigit() else part.lower() for part in re.split(r'(\d+)', filename)]
+
+
+def is_image_sequence(path):
+    r"""Whether `path` is a directory or glob pattern (rather than a single movie file)."""
+    return os.path.isdir(path) or (re.search(r'[\*\?\[]', path) is not None)
+
+
+def find_image_sequence(path):
+    r"""Finds the files of an image sequence, in natural sort order.
+
+    Parameters
+    ----------
+    path : str
+        Either a directory, in which case all image files in it are used, or a glob
+        pattern such as 'C:/Data/movie/frame_*.png'
+
+    Returns
+    -------
+    files : list
+        Paths of the image files. Numbers in the file names are sorted by value,
+        so 'frame_2.png' comes before 'frame_10.png'.
+
+    """
+    if os.path.isdir(path):
+        files = [os.path.join(path, f) for f in os.listdir(path) if f.lower().endswith(image_sequence_extensions)]
+    else:
+        files = glob.glob(path)
+    return sorted(files, key=_natural_sort_key)
+
+
+def name_for_saving(filename, data_dir=''):
+    r"""Name (without extension) under which to save results for a movie file or image sequence.
+
+    For a single file, this is the file name without its extension. For a directory,
+    it is the name of the directory. For a glob pattern, it is the pattern without
+    the wildcards, e.g., 'frame' for 'frame_*.png'. The file name is relative to `data_dir`.
+    """
+    path = data_dir + filename
+    if is_image_sequence(path):
+        name = os.path.basename(os.path.normpath(path))
+        if not os.path.isdir(path):
+            name = os.path.splitext(name)[0]
+        name = re.sub(r'\[.*?\]|[\*\?]', '', name).strip('_-. ')
+        return name if len(name) > 0 else 'image_sequence'
+    return filename[:-4]
+
+
+def select_frames(number_of_frames, first_frame=0, last_frame=None, frame_stride=1, frame_windows=None):
+    r"""Indices of the frames to read.
+
+    Every `frame_stride`-th frame from `first_frame` up to `last_frame`. If `frame_windows`
+    is given, only those of these frames that are within one of the windows are kept, so
+    all frames are on the same grid (and pairs of frames from different windows are still
+    a whole number of strides apart).
+
+    Parameters
+    ----------
+    number_of_frames : int
+        Number of frames in the movie
+    first_frame : int, optional
+        First frame. Default is 0.
+    last_frame : int or None, optional
+        Frames up to (but not including) this one. Default is None (to the end).
+    frame_stride : int, optional
+        Step between the frames. Default is 1.
+    frame_windows : list or None, optional
+        List of [start, stop] frame ranges (stop not included). Default is None.
+
+    Returns
+    -------
+    frames : array
+        1D array of the indices of the frames, increasing
+
+    """
+    frames = np.arange(number_of_frames)[first_frame:last_frame:frame_stride]
+    if frame_windows is not None:
+        in_window = np.zeros(len(frames), dtype=bool)
+        for start, stop in frame_windows:
+            in_window |= (frames >= start) & (frames < stop)
+        frames = frames[in_window]
+    return frames
+
+
+def check_frames_selected(frames, number_of_frames):
+    r"""Prints a message if no frames are selected (see `select_frames`).
+
+    Returns
+    -------
+    selected : bool
+        True if there are frames to read
+
+    """
+    if len(frames) == 0:
+        print("No frames to read: the first and last frame numbers and frame windows given select none of the %i frames." % number_of_frames)
+        return False
+    return True
+
+
+def frame_runs(frames, frame_stride=1):
+    r"""Splits increasing frame indices into runs of frames `frame_stride` apart.
+
+    Returns
+    -------
+    runs : list
+        List of (start, stop) for each run, with stop not included
+
+    """
+    frames = np.asarray(frames)
+    breaks = np.nonzero(np.diff(frames) != frame_stride)[0] + 1
+    return [(int(run[0]), int(run[-1])+1) for run in np.split(frames, breaks) if len(run) > 0]
+
+
+def bin_by_summing(im, binsize):
+    r"""Bins images by summing `binsize`-by-`binsize` blocks of pixels.
+
+    The last two dimensions are binned. If their size is not a multiple of `binsize`,
+    the images are padded with zeros (as with `skimage.transform.downscale_local_mean`).
+    Sums of 8- or 16-bit unsigned images are stored as uint32, of other unsigned integer
+    images as uint64, of other integer images as int64, and of float images as float64.
+
+    Parameters
+    ----------
+    im : array
+        Image or series of images, with y and x as the last two dimensions
+    binsize : int
+        Size of the blocks of pixels summed
+
+    Returns
+    -------
+    binned : array
+        Binned images
+
+    """
+    if im.dtype in (np.uint8, np.uint16):
+        sum_dtype = np.uint32
+    elif np.issubdtype(im.dtype, np.unsignedinteger):
+        sum_dtype = np.uint64
+    elif np.issubdtype(im.dtype, np.integer):
+        sum_dtype = np.int64
+    else:
+        sum_dtype = np.float64
+    ny, nx = im.shape[-2:]
+    pad_y = (-ny) % binsize
+    pad_x = (-nx) % binsize
+    if (pad_y > 0) or (pad_x > 0):
+        im = np.pad(im, ((0,0),)*(im.ndim-2) + ((0,pad_y), (0,pad_x)))
+    return im.reshape(im.shape[:-2] + ((ny+pad_y)//binsize, binsize, (nx+pad_x)//binsize, binsize)).sum(axis=(-3,-1), dtype=sum_dtype)
+
+
+def _crop_and_bin(frame, y_slice, x_slice, binsize=1, color_channel=0):
+    #Crops a frame, keeps one color channel (for RGB frames) and bins by an integer factor.
+    #Integer frames are binned by summing binsize-by-binsize blocks (see `bin_by_summing`),
+    #other frames by averaging them. Frames are padded with zeros to a multiple of binsize.
+    frame = frame[y_slice, x_slice]
+    if frame.ndim == 3:
+        frame = frame[:,:,color_channel]
+    if binsize > 1:
+        binned = bin_by_summing(frame, binsize)
+        frame = binned if np.issubdtype(frame.dtype, np.integer) else binned/binsize**2
+    return frame
+
+
+class _TiffFrameReader(object):
+    #Reads frames (cropped, for one or more channels) from an open TIFF file. The series,
+    #its pages and (if the image data is uncompressed and contiguous) the memory map are
+    #found once, so frames can be read a block at a time without parsing the file again.
+
+    def __init__(self, tif, filename, channels, crop_region):
+        series = tif.series[0]
+        self.tif = tif
+        self.shape = series.shape
+        self.keyframe_shape = series.keyframe.shape
+        self.leading_shape = self.shape[:-2]
+        self.number_of_frames = self.leading_shape[0] if len(self.leading_shape) > 0 else 1
+
+        #Index along each of the leading (non-image) dimensions: frames along the first,
+        #the channel along 'C' (or the second dimension), and 0 for any others.
+        self.channels = list(channels)
+        self.channel_axis = None
+        if len(self.leading_shape) > 1:
+            axes = series.axes
+            self.channel_axis = axes.index('C') if ('C' in axes[1:-2]) else 1
+            for i,c in enumerate(self.channels):
+                if c is None:
+                    self.channels[i] = 0
+                elif c >= self.leading_shape[self.channel_axis]:
+                    print("Channel outside of range. Only have %i channels." % self.leading_shape[self.channel_axis])
+                    self.channels[i] = 0
+        self.y_slice, self.x_slice = _crop_slices(crop_region)
+
+        try:
+            self.data = tifffile.memmap(filename, series=0, mode='r')
+            if self.data.shape != self.shape:
+                raise ValueError("Memory mapped shape differs from series shape")
+        except (ValueError, NotImplementedError):
+            self.data = None
+
+        #Pages may hold more than one plane (e.g., all channels of a frame), in which case the
+        #leading dimensions split into those that index pages and those within each page
+        self.number_of_page_dims = len(self.shape) - len(self.keyframe_shape)
+        if (self.data is None) and (self.number_of_page_dims < 1):
+            self.data = series.asarray()
+        self.within_page = [(slice(None),) + self._leading_index(0, c)[self.number_of_page_dims:] + (self.y_slice, self.x_slice)
+                            for c in self.channels]
+
+    def _leading_index(self, frame, c):
+        index = [0]*len(self.leading_shape)
+        if len(self.leading_shape) > 0:
+            index[0] = frame
+        if self.channel_axis is not None:
+            index[self.channel_axis] = c
+        return tuple(index)
+
+    def _page_index(self, frame, c):
+        return int(np.ravel_multi_index(self._leading_index(frame, c)[:self.number_of_page_dims],
+                                        self.shape[:self.number_of_page_dims]))
+
+    def read(self, frames, out=None):
+        #Reads the given (increasing) frames. Returns a list with a 3D array for each channel,
+        #or fills the arrays in `out` if given.
+        if self.data is not None:
+            ims = []
+            for c in self.channels:
+                selection = [slice(None)]*len(self.leading_shape)
+                if len(self.leading_shape) > 0:
+                    if (len(frames) > 0) and (frames[-1] - frames[0] == len(frames) - 1):
+                        selection[0] = slice(frames[0], frames[-1]+1)
+                    else:
+                        selection[0] = np.asarray(frames, dtype=int)
+                for axis in range(1, len(self.leading_shape)):
+                    selection[axis] = c if axis == self.channel_axis else 0
+                im = np.array(self.data[tuple(selection) + (self.y_slice, self.x_slice)])
+                if len(self.leading_shape) == 0:
+                    im = im[np.newaxis]
+                ims.append(im)
+        else:
+            #Decode only the pages that are needed. The pages for all channels of the frames
+            #are decoded together, so the file is only passed over once.
+            pages = sorted(set(self._page_index(frame, c) for frame in frames for c in self.channels))
+            position = {page:i for i,page in enumerate(pages)}
+            decoded = self.tif.asarray(key=pages, series=0).reshape((len(pages),)+self.keyframe_shape)
+            ims = [decoded[[position[self._page_index(frame, c)] for frame in frames]][w]
+                   for c,w in zip(self.channels, self.within_page)]
+        if out is None:
+            return ims
+        for o,im in zip(out, ims):
+            o[...] = im
+        return out
+
+    def close(self):
+        self.data = None
+
+
+def read_tiff_stack(filename, first_frame=0, last_frame=None, crop_region=None, channel=None,
+                    pages_per_chunk=64, frame_stride=1, frame_windows=None):
+    r"""Reads a range of frames from a TIFF stack, cropping as frames are read.
+
+    If the image data in the file is uncompressed and contiguous, the file is memory
+    mapped and only the requested frames and region are copied. Otherwise, only the
+    pages for the requested frames (and channels) are decoded, a chunk of pages at a
+    time, and each chunk is cropped before the next is decoded.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the TIFF file
+    first_frame : int, optional
+        First frame to read. Default is 0.
+    last_frame : int or None, optional
+        Frames up to (but not including) this one are read. Default is None (to the end).
+    crop_region : list or None, optional
+        Region to keep, as [y1,y2,x1,x2]. Default is None (the full frame).
+    channel : int, list, or None, optional
+        For stacks with more than one channel (4D stacks, with channel as the second
+        dimension unless the file's metadata says otherwise), the channel to read. If a
+        list of channels, each of those channels is read in the same pass over the file.
+        Default is None, which reads channel 0 of multi-channel stacks.
+    pages_per_chunk : int, optional
+        Number of frames decoded at once when the file cannot be memory mapped. Default is 64.
+    frame_stride : int, optional
+        Only every `frame_stride`-th frame (counting from `first_frame`) is read. Default is 1.
+    frame_windows : list or None, optional
+        List of [start, stop] frame ranges. If given, only frames within these ranges are
+        read (see `select_frames`). Default is None.
+
+    Returns
+    -------
+    im : array or list
+        3D array of shape (frame, y, x). If `channel` is a list, a list of such
+        arrays, one for each channel.
+
+    """
+    return_list = isinstance(channel, (list, tuple, np.ndarray))
+    channels = list(channel) if return_list else [channel]
+
+    with tifffile.TiffFile(filename) as tif:
+        reader = _TiffFrameReader(tif, filename, channels, crop_region)
+        frames = select_frames(reader.number_of_frames, first_frame, last_frame, frame_stride, frame_windows)
+        if not check_frames_selected(frames, reader.number_of_frames):
+            return None
+        if reader.data is not None:
+            ims = reader.read(frames)
+        else:
+            first = reader.read(frames[:1])
+            ims = [np.empty((len(frames),) + im.shape[1:], dtype=im.dtype) for im in first]
+            for start in range(0, len(frames), pages_per_chunk):
+                reader.read(frames[start:start+pages_per_chunk], out=[im[start:start+pages_per_chunk] for im in ims])
+        reader.close()
+    return ims if return_list else ims[0]
+
+
+def iter_tiff_blocks(filename, first_frame=0, last_frame=None, crop_region=None, channel=None,
+                     block_size=64, frame_stride=1, frame_windows=None):
+    r"""Yields consecutive blocks of frames from a TIFF stack (see `read_tiff_stack`).
+
+    The file is opened (and, if possible, memory mapped) once, and each block is read
+    from it in turn.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the TIFF file
+    first_frame : int, optional
+        First frame to read. Default is 0.
+    last_frame : int or None, optional
+        Frames up to (but not including) this one are read. Default is None (to the end).
+    crop_region : list or None, optional
+        Region to keep, as [y1,y2,x1,x2]. Default is None (the full frame).
+    channel : int or None, optional
+        For stacks with more than one channel, the channel to read. Default is None.
+    block_size : int, optional
+        Number of frames in each block. Default is 64.
+    frame_stride : int, optional
+        Only every `frame_stride`-th frame (counting from `first_frame`) is read. Default is 1.
+    frame_windows : list or None, optional
+        List of [start, stop] frame ranges. If given, only frames within these ranges are
+        read (see `select_frames`). Default is None.
+
+    Yields
+    ------
+    block : array
+        3D array of shape (frame, y, x), with up to `block_size` frames
+
+    """
+    with tifffile.TiffFile(filename) as tif:
+        reader = _TiffFrameReader(tif, filename, [channel], crop_region)
+        frames = select_frames(reader.number_of_frames, first_frame, last_frame, frame_stride, frame_windows)
+        check_frames_selected(frames, reader.number_of_frames)
+        try:
+            for start in range(0, len(frames), block_size):
+                yield reader.read(frames[start:start+block_size])[0]
+        finally:
+            reader.close()
+
+
+def _next_mp4_frame(vid, i, previous):
+    #Frame i, decoding the next frame if it follows the previous one read and seeking otherwise
+    #(imageio's ffmpeg reader skips over nearby frames without converting them)
+    if (previous is not None) and (i == previous + 1):
+        return vid.get_next_data()
+    return vid.get_data(int(i))
+
+
+def _read_mp4_frames(filename, out, frames, offset, y_slice, x_slice, binsize, color_channel):
+    #Decodes the (increasing) frames into out[offset:offset+len(frames)].
+    #Returns the number of frames read, which is less than requested if the video ends early.
+    with imageio.get_reader(filename) as vid:
+        previous = None
+        for n,i in enumerate(frames):
+            try:
+                frame = _next_mp4_frame(vid, i, previous)
+            except (IndexError, EOFError):
+                return n
+            out[offset+n] = _crop_and_bin(frame, y_slice, x_slice, binsize, color_channel)
+            previous = i
+    return len(frames)
+
+
+def read_mp4_stack(filename, first_frame=0, last_frame=None, crop_region=None, binsize=1,
+                   color_channel=0, number_of_workers=None, frame_stride=1, frame_windows=None):
+    r"""Reads a range of frames from a video (e.g., mp4), cropping and binning as frames are decoded.
+
+    The frame range is split into contiguous pieces that are decoded at the same time,
+    each by its own reader (with imageio's ffmpeg plugin, each runs its own ffmpeg process).
+    Each reader seeks to the start of its piece, so frames before `first_frame` are not
+    decoded where the container allows seeking.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the video file
+    first_frame : int, optional
+        First frame to read. Default is 0.
+    last_frame : int or None, optional
+        Frames up to (but not including) this one are read. Default is None (to the end).
+        The length of the video is then taken from its metadata, which may only be an 
+        estimate. If the video ends early, fewer frames are returned, and if it has more 
+        frames than estimated, the rest are decoded after the others.
+    crop_region : list or None, optional
+        Region to keep, as [y1,y2,x1,x2]. Default is None (the full frame).
+    binsize : int, optional
+        Frames are binned by summing `binsize`-by-`binsize` blocks of pixels (see
+        `bin_by_summing`). Default is 1 (no binning).
+    color_channel : int, optional
+        For color videos, the color channel to keep. Default is 0.
+    number_of_workers : int or None, optional
+        Number of frame ranges decoded at once. Default is None, which uses up to 4 (depending
+        on the number of CPUs).
+    frame_stride : int, optional
+        Only every `frame_stride`-th frame (counting from `first_frame`) is read. Frames in between
+        are skipped without being converted, or sought past. Default is 1.
+    frame_windows : list or None, optional
+        List of [start, stop] frame ranges. If given, only frames within these ranges are
+        read (see `select_frames`). Default is None.
+
+    Returns
+    -------
+    im : array
+        3D array of shape (frame, y, x). If binning integer frames, these hold the sums of
+        blocks of pixels (see `bin_by_summing`).
+
+    """
+    if number_of_workers is None:
+        number_of_workers = min(4, os.cpu_count() or 1)
+    y_slice, x_slice = _crop_slices(crop_region)
+
+    to_the_end = False
+    with imageio.get_reader(filename) as vid:
+        if (last_frame is None) and (frame_windows is not None):
+            last_frame = max(stop for start, stop in frame_windows)
+        elif last_frame is None:
+            #ffmpeg's reader estimates its length from the duration and frame rate, rather
+            #than decoding the whole video to count the frames (unless the length is unknown)
+            to_the_end = True
+            last_frame = vid.get_length()
+            if not np.isfinite(last_frame):
+                last_frame = vid.count_frames()
+            last_frame = int(last_frame)
+        frames = select_frames(last_frame, first_frame, last_frame, frame_stride, frame_windows)
+        if not check_frames_selected(frames, last_frame):
+            return None
+        first = _crop_and_bin(vid.get_data(int(frames[0])), y_slice, x_slice, binsize, color_channel)
+
+    number_of_frames = len(frames)
+    im = np.empty((number_of_frames,) + first.shape, dtype=first.dtype)
+    number_of_workers = max(1, min(number_of_workers, number_of_frames))
+    pieces = np.array_split(frames, number_of_workers)
+    offsets = np.cumsum([0] + [len(piece) for piece in pieces])
+
+    with ThreadPoolExecutor(max_workers=number_of_workers) as executor:
+        futures = [executor.submit(_read_mp4_frames, filename, im, pieces[i], offsets[i],
+                                   y_slice, x_slice, binsize, color_channel)
+                   for i in range(number_of_workers)]
+        frames_read = [f.result() for f in futures]
+
+    #If the video ended before the last frame, keep the frames up to the first one missing
+    for i,n in enumerate(frames_read):
+        if n < len(pieces[i]):
+            if not to_the_end:
+                print("Video ended early. Read %i frames." % (offsets[i] + n))
+            return im[:offsets[i] + n]
+
+    #The video may have more frames than its estimated length
+    if to_the_end:
+        remaining = list(iter_mp4_blocks(filename, first_frame=frames[-1]+frame_stride, crop_region=crop_region,
+                                         binsize=binsize, color_channel=color_channel, frame_stride=frame_stride))
+        if len(remaining) > 0:
+            im = np.concatenate([im] + remaining)
+    return im
+
+
+def iter_mp4_blocks(filename, first_frame=0, last_frame=None, crop_region=None, binsize=1,
+                    color_channel=0, block_size=64, frame_stride=1, frame_windows=None):
+    r"""Yields consecutive blocks of frames from a video, cropping and binning as frames are decoded.
+
+    Frames are decoded in order by a single reader (see `read_mp4_stack` to decode several
+    frame ranges at once).
+
+    Parameters
+    ----------
+    filename : str
+        Path to the video file
+    first_frame : int, optional
+        First frame to read. Default is 0.
+    last_frame : int or None, optional
+        Frames up to (but not including) this one are read. Default is None (to the end).
+    crop_region : list or None, optional
+        Region to keep, as [y1,y2,x1,x2]. Default is None (the full frame).
+    binsize : int, optional
+        Frames are binned by summing `binsize`-by-`binsize` blocks of pixels (see
+        `bin_by_summing`). Default is 1 (no binning).
+    color_channel : int, optional
+        For color videos, the color channel to keep. Default is 0.
+    block_size : int, optional
+        Number of frames in each block. Default is 64.
+    frame_stride : int, optional
+        Only every `frame_stride`-th frame (counting from `first_frame`) is read. Default is 1.
+    frame_windows : list or None, optional
+        List of [start, stop] frame ranges. If given, only frames within these ranges are
+        read (see `select_frames`). Default is None.
+
+    Yields
+    ------
+    block : array
+        3D array of shape (frame, y, x), with up to `block_size` frames
+
+    """
+    y_slice, x_slice = _crop_slices(crop_region)
+    if frame_windows is not None:
+        windows_stop = max(stop for start, stop in frame_windows)
+        last_frame = windows_stop if last_frame is None else min(last_frame, windows_stop)
+    if last_frame is None:
+        frames = itertools.count(first_frame, frame_stride)
+    else:
+        frames = range(first_frame, last_frame, frame_stride)
+    with imageio.get_reader(filename) as vid:
+        previous = None
+        block = []
+        for i in frames:
+            if (frame_windows is not None) and not any(start <= i < stop for start, stop in frame_windows):
+                continue
+            try:
+                frame = _next_mp4_frame(vid, i, previous)
+            except (IndexError, EOFError):
+                break
+            block.append(_crop_and_bin(frame, y_slice, x_slice, binsize, color_channel))
+            previous = i
+            if len(block) == block_size:
+                yield np.stack(block)
+                block = []
+        if len(block) > 0:
+            yield np.stack(block)
+
+
+class ND2Stack(object):
+    r"""Lazy access to a range of frames, for one channel, of a Nikon .nd2 file.
+
+    Frames are only read when asked for, either one at a time by indexing, or in
+    blocks with `read_block` or `iter_blocks`. When reading blocks, frames are
+    read (and decompressed) by several threads at once. Each thread has its own
+    `ND2Reader`, as a reader cannot be shared between threads.
+
+    >>> with ND2Stack('movie.nd2', first_frame=100, last_frame=1100, channel=1) as stack:
+    >>>     im = stack.read()
+
+    Parameters
+    ----------
+    filename : str
+        Path to the .nd2 file
+    first_frame : int, optional
+        First frame to read. Default is 0.
+    last_frame : int or None, optional
+        Frames up to (but not including) this one are read. Default is None (to the end).
+    channel : int, optional
+        Channel to read. Default is 0.
+    crop_region : list or None, optional
+        Region of each frame to keep, as [y1,y2,x1,x2]. Default is None (the full frame).
+    number_of_workers : int or None, optional
+        Number of threads reading frames. Default is None, which uses up to 4 (depending
+        on the number of CPUs).
+    frame_stride : int, optional
+        Only every `frame_stride`-th frame (counting from `first_frame`) is read. Default is 1.
+    frame_windows : list or None, optional
+        List of [start, stop] frame ranges. If given, only frames within these ranges are
+        read (see `select_frames`). Default is None.
+
+    """
+
+    def __init__(self, filename, first_frame=0, last_frame=None, channel=0, crop_region=None,
+                 number_of_workers=None, frame_stride=1, frame_windows=None):
+        self.filename = filename
+        self.channel = 0 if channel is None else channel
+        self.y_slice, self.x_slice = _crop_slices(crop_region)
+        if number_of_workers is None:
+            number_of_workers = min(4, os.cpu_count() or 1)
+        self.number_of_workers = number_of_workers
+
+        self._local = threading.local()
+        self._readers = []
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=self.number_of_workers)
+
+        sizes = self._reader().sizes
+        number_of_frames = sizes['t'] if 't' in sizes else 1
+        self.frames = select_frames(number_of_frames, first_frame, last_frame, frame_stride, frame_windows)
+        if check_frames_selected(self.frames, number_of_frames):
+            first = self[0]
+        else:
+            #The shape of a frame is still needed (the stack then has no frames)
+            first = np.asarray(self._reader().get_frame_2D(t=0, c=self.channel))[self.y_slice, self.x_slice]
+        self.shape = (len(self.frames),) + first.shape
+        self.dtype = first.dtype
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __getitem__(self, index):
+        return self.frame(index)
+
+    def _reader(self):
+        #The ND2Reader for the calling thread
+        reader = getattr(self._local, 'reader', None)
+        if reader is None:
+            reader = ND2Reader(self.filename)
+            self._local.reader = reader
+            with self._lock:
+                self._readers.append(reader)
+        return reader
+
+    def frame(self, index, crop=True):
+        r"""Reads a single frame.
+
+        Parameters
+        ----------
+        index : int
+            Index of the frame, counting from `first_frame`
+        crop : bool, optional
+            If True (default), only the crop region is returned
+
+        Returns
+        -------
+        frame : array
+            2D array
+
+        """
+        frame = np.asarray(self._reader().get_frame_2D(t=int(self.frames[index]), c=self.channel))
+        if crop:
+            frame = frame[self.y_slice, self.x_slice]
+        return frame
+
+    def read_block(self, start=0, stop=None, out=None):
+        r"""Reads a block of frames, with the frames read by several threads.
+
+        Parameters
+        ----------
+        start : int, optional
+            Index of the first frame of the block (counting from `first_frame`). Default is 0.
+        stop : int or None, optional
+            Frames up to (but not including) this index are read. Default is None (to the last frame).
+        out : array or None, optional
+            Array to read the frames into. If None (default), a new array is created.
+
+        Returns
+        -------
+        block : array
+            3D array of shape (frame, y, x)
+
+        """
+        indices = range(*slice(start, stop).indices(len(self)))
+        if out is None:
+            out = np.empty((len(indices),) + self.shape[1:], dtype=self.dtype)
+
+        def read_frame(i):
+            out[i] = self.frame(indices[i])
+
+        list(self._executor.map(read_frame, range(len(indices))))
+        return out
+
+    def read(self):
+        r"""Reads all the frames. Same as `read_block` with no arguments."""
+        return self.read_block()
+
+    def iter_blocks(self, block_size=64):
+        r"""Yields consecutive blocks of frames.
+
+        While one block is being used, the next is read in the background.
+
+        Parameters
+        ----------
+        block_size : int, optional
+            Number of frames in each block. Default is 64.
+
+        Yields
+        ------
+        block : array
+            3D array of shape (frame, y, x), with up to `block_size` frames
+
+        """
+        starts = range(0, len(self), block_size)
+        with ThreadPoolExecutor(max_workers=1) as prefetcher:
+            next_block = None
+            for start in starts:
+                block = self.read_block(start, start+block_size) if next_block is None else next_block.result()
+                if start + block_size < len(self):
+                    next_block = prefetcher.submit(self.read_block, start+block_size, start+2*block_size)
+                yield block
+
+    def close(self):
+        self._executor.shutdown()
+        with self._lock:
+            for reader in self._readers:
+                reader.close()
+            self._readers = []
+        self._local = threading.local()
+
+
+def _read_image_file(filename):
+    if able_to_use_tifffile and filename.lower().endswith(('.tif', '.tiff')):
+        return tifffile.imread(filename)
+    return io.imread(filename)
+
+
+def iter_image_sequence(files, crop_region=None, color_channel=0, number_of_workers=None, prefetch=None):
+    r"""Yields the frames of an image sequence, in order, decoding files in a thread pool.
+
+    At most `prefetch` files are decoded (or waiting to be used) at any time, so frames
+    can be consumed as they are decoded without holding the whole movie in memory.
+
+    Parameters
+    ----------
+    files : list
+        Paths of the image files, in order (see `find_image_sequence`)
+    crop_region : list or None, optional
+        Region of each frame to keep, as [y1,y2,x1,x2]. Default is None (the full frame).
+    color_channel : int, optional
+        For color images, the color channel to keep. Default is 0.
+    number_of_workers : int or None, optional
+        Number of threads decoding files. Default is None, which uses up to 4 (depending
+        on the number of CPUs).
+    prefetch : int or None, optional
+        Maximum number of files being decoded ahead of the frame being yielded. Default
+        is None, which uses 4 times `number_of_workers`.
+
+    Yields
+    ------
+    frame : array
+        2D array
+
+    """
+    if number_of_workers is None:
+        number_of_workers = min(4, os.cpu_count() or 1)
+    if prefetch is None:
+        prefetch = 4*number_of_workers
+    y_slice, x_slice = _crop_slices(crop_region)
+
+    def read_frame(filename):
+        return _crop_and_bin(_read_image_file(filename), y_slice, x_slice, color_channel=color_channel)
+
+    with ThreadPoolExecutor(max_workers=number_of_workers) as executor:
+        pending = deque()
+        files = iter(files)
+        for filename in files:
+            pending.append(executor.submit(read_frame, filename))
+            if len(pending) >= prefetch:
+                break
+        while len(pending) > 0:
+            frame = pending.popleft().result()
+            next_file = next(files, None)
+            if next_file is not None:
+                pending.append(executor.submit(read_frame, next_file))
+            yield frame
+
+
+def stack_in_blocks(frames, block_size=64):
+    r"""Groups the frames from an iterable (e.g., `iter_image_sequence`) into blocks.
+
+    Parameters
+    ----------
+    frames : iterable
+        Iterable of 2D arrays, all of the same shape
+    block_size : int, optional
+        Number of frames in each block. Default is 64.
+
+    Yields
+    ------
+    block : array
+        3D array of shape (frame, y, x), with up to `block_size` frames
+
+    """
+    block = []
+    for frame in frames:
+        block.append(frame)
+        if len(block) == block_size:
+            yield np.stack(block)
+            block = []
+    if len(block) > 0:
+        yield np.stack(block)
+
+
+def read_image_sequence(path, first_frame=0, last_frame=None, crop_region=None, color_channel=0,
+                        number_of_workers=None, prefetch=None, frame_stride=1, frame_windows=None):
+    r"""Reads a range of frames of an image sequence (a directory or glob pattern of image files).
+
+    Files are decoded in a thread pool (see `iter_image_sequence`) and each frame is
+    cropped and put into a preallocated stack as it is decoded.
+
+    Parameters
+    ----------
+    path : str
+        Directory or glob pattern of the image files (see `find_image_sequence`)
+    first_frame : int, optional
+        First frame to read. Default is 0.
+    last_frame : int or None, optional
+        Frames up to (but not including) this one are read. Default is None (to the end).
+    crop_region : list or None, optional
+        Region to keep, as [y1,y2,x1,x2]. Default is None (the full frame).
+    color_channel : int, optional
+        For color images, the color channel to keep. Default is 0.
+    number_of_workers : int or None, optional
+        Number of threads decoding files. Default is None (see `iter_image_sequence`).
+    prefetch : int or None, optional
+        Maximum number of files decoded ahead. Default is None (see `iter_image_sequence`).
+    frame_stride : int, optional
+        Only every `frame_stride`-th frame (counting from `first_frame`) is read. Default is 1.
+    frame_windows : list or None, optional
+        List of [start, stop] frame ranges. If given, only frames within these ranges are
+        read (see `select_frames`). Default is None.
+
+    Returns
+    -------
+    im : array
+        3D array of shape (frame, y, x)
+
+    """
+    files = find_image_sequence(path)
+    if len(files) == 0:
+        print("No image files found for %s." % path)
+        return None
+    frames = select_frames(len(files), first_frame, last_frame, frame_stride, frame_windows)
+    if not check_frames_selected(frames, len(files)):
+        return None
+    files = [files[i] for i in frames]
+    im = None
+    for i,frame in enumerate(iter_image_sequence(files, crop_region=crop_region, color_channel=color_channel,
+                                                 number_of_workers=number_of_workers, prefetch=prefetch)):
+        if im is None:
+            im = np.empty((len(files),) + frame.shape, dtype=frame.dtype)
+        im[i] = frame
+    return im
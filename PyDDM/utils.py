@@ -12,6 +12,8 @@ import matplotlib.pyplot as plt
 import xarray as xr
 import scipy
 from scipy.special import gamma
+import fit_parameters_dictionaries as fpd
+import ISF_and_DDMmatrix_theoretical_models as models
 
 #This function is used to determine a new time when a distribution
 # of decay times are present
@@ -531,9 +533,48 @@ def plot_amplitude_over_background(fit, plt_color = 'g'):
     
     return fig
 
+def get_dense_theory(fit, number_of_points=200):
+    r"""Theory evaluated on a finely spaced grid of lag times
+    
+    The 'theory' variable in the fit results is evaluated only at the lag times
+    of the data. This recomputes the model, for all wavevectors in one call, 
+    at `number_of_points` logarithmically spaced lag times spanning the same range. 
+    Useful for smooth curves in plots. 
+
+    Parameters
+    ----------
+    fit : xarray Dataset
+        Result of fit
+    number_of_points : int, optional
+        Number of lag times. Default is 200. 
+
+    Returns
+    -------
+    dense_theory : xarray DataArray
+        Theory with dimensions of 'lagtime' and 'q'. Returns None if the model
+        used for the fit is not found. 
+
+    """
+    if fit.attrs.get('model') not in fpd.fitting_models:
+        print("Model '%s' not found in available models." % fit.attrs.get('model'))
+        return None
+    model_function = fpd.fitting_models[fit.model]['model_function']
+    lagtimes = fit.lagtime.values
+    lagtimes = lagtimes[lagtimes>0]
+    dense_lagtimes = np.geomspace(lagtimes.min(), lagtimes.max(), number_of_points)
+    dense_theory = models.theory_surface(model_function, dense_lagtimes, fit.parameters.values)
+    if 'last_times' in fit.data_vars:
+        #Do not extend the theory beyond the lag times that were fit
+        last_lagtime_fit = fit.lagtime.values[fit.last_times.values-1]
+        dense_theory[dense_lagtimes[:,np.newaxis] > last_lagtime_fit[np.newaxis,:]] = np.nan
+    return xr.DataArray(dense_theory, dims=['lagtime', 'q'],
+                        coords={'lagtime': dense_lagtimes, 'q': fit.q.values},
+                        name='dense_theory')
+
+
 def plot_to_inspect_fit(q_index_to_plot, fit, axis_to_use = None, ylim=None, 
                         oneplotcolor='r', show_legend=True, scale_by_q_to_power=0,
-                        show_colorbar=False, print_params=True):
+                        show_colorbar=False, print_params=True, dense_theory=False):
     r"""Create plot of data and fit
     
     For inspecting fits to the data (either DDM matrix or the 
@@ -562,6 +603,9 @@ def plot_to_inspect_fit(q_index_to_plot, fit, axis_to_use = None, ylim=None,
         Default is False
     print_params : bool, optional
         Default is True
+    dense_theory : bool, optional
+        If True, the fit is drawn as a smooth curve evaluated at finely spaced 
+        lag times (see :py:func:`get_dense_theory`). Default is False. 
 
     Returns
     -------
@@ -581,6 +625,12 @@ def plot_to_inspect_fit(q_index_to_plot, fit, axis_to_use = None, ylim=None,
     cellText = []
     
     times = fit.lagtime
+    theory = fit.theory
+    if dense_theory:
+        dense = get_dense_theory(fit)
+        if dense is not None:
+            theory = dense
+    theory_times = theory.lagtime
     if fit.data_to_use == 'ISF':
         if 'isf_data' in fit.data_vars:
             data = fit.isf_data
@@ -601,7 +651,7 @@ def plot_to_inspect_fit(q_index_to_plot, fit, axis_to_use = None, ylim=None,
             
     if np.isscalar(q_index_to_plot):
         ax.semilogx(times, data[:,q_index_to_plot], 'o', color=oneplotcolor, label="Data for q index %i, q=%.4f μm$^{-1}$" % (q_index_to_plot, fit.q[q_index_to_plot]))
-        ax.semilogx(times, fit.theory[:,q_index_to_plot], '-k', lw=3, alpha=0.8, label="Fit for q_index %i" % q_index_to_plot)
+        ax.semilogx(theory_times, theory[:,q_index_to_plot], '-k', lw=3, alpha=0.8, label="Fit for q_index %i" % q_index_to_plot)
         if print_params:
             for param in fit.parameter:
                 print("For q_index %i, the '%s' paramter is %.4f" % (q_index_to_plot, param.values, fit.parameters.loc[param][q_index_to_plot]))
@@ -618,10 +668,11 @@ def plot_to_inspect_fit(q_index_to_plot, fit, axis_to_use = None, ylim=None,
             qv = int(qv)
             if scale_by_q_to_power:
                 times = fit.lagtime * (fit.q[qv]**scale_by_q_to_power)
+                theory_times = theory.lagtime * (fit.q[qv]**scale_by_q_to_power)
                 xlabel_str = "Lag time multiplied by q to power of %.1f" % scale_by_q_to_power
             ax.semilogx(times, data[:,qv], 'o', color=plt_color, label="Data for q index %i, q=%.4f" % (qv, fit.q[qv]))
-            ax.semilogx(times, fit.theory[:,qv], '-', color=plt_color, lw=3, alpha=0.8, label="Fit for q_index %i" % qv)
-            ax.semilogx(times, fit.theory[:,qv], color='k', linestyle=(0, (1, 1)), lw=1)
+            ax.semilogx(theory_times, theory[:,qv], '-', color=plt_color, lw=3, alpha=0.8, label="Fit for q_index %i" % qv)
+            ax.semilogx(theory_times, theory[:,qv], color='k', linestyle=(0, (1, 1)), lw=1)
             if print_params:
                 for param in fit.parameter:
                     print("For q_index %i, the '%s' paramter is %.4f" % (qv, param.values, fit.parameters.loc[param][qv]))
@@ -656,7 +707,7 @@ def plot_to_inspect_fit(q_index_to_plot, fit, axis_to_use = None, ylim=None,
 
 
 def plot_to_inspect_fit_2x2subplot(q_index_to_plot, fit, ylim=None,
-                                   oneplotcolor='r'):
+                                   oneplotcolor='r', dense_theory=False):
     r"""Create 2-by-2 suplot of fits
     
     For inspecting fits to the data (either DDM matrix or the 
@@ -675,6 +726,9 @@ def plot_to_inspect_fit_2x2subplot(q_index_to_plot, fit, ylim=None,
         Specify limits of y-axis
     oneplotcolor : optional
         Default is 'r' (red). 
+    dense_theory : bool, optional
+        If True, the fit is drawn as a smooth curve evaluated at finely spaced 
+        lag times (see :py:func:`get_dense_theory`). Default is False. 
 
     Returns
     -------
@@ -687,6 +741,11 @@ def plot_to_inspect_fit_2x2subplot(q_index_to_plot, fit, ylim=None,
         return 0
     
     times = fit.lagtime
+    theory = fit.theory
+    if dense_theory:
+        dense = get_dense_theory(fit)
+        if dense is not None:
+            theory = dense
     if fit.data_to_use == 'ISF':
         ISF = True
         ylabel_str = "ISF"
@@ -715,7 +774,7 @@ def plot_to_inspect_fit_2x2subplot(q_index_to_plot, fit, ylim=None,
             break
         ax= fig.add_subplot(2,2,n+1)
         ax.semilogx(times, data[:,q_at],'o', color=oneplotcolor)
-        ax.semilogx(times, fit.theory[:,q_at],'-k', lw=3)
+        ax.semilogx(theory.lagtime, theory[:,q_at],'-k', lw=3)
         ax.set_xlabel(xlabel_str)
         ax.set_ylabel(ylabel_str)
         if ISF and (ylim is None): 